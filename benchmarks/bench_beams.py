@@ -0,0 +1,48 @@
+"""Benchmarks of the beam generators of functions.py."""
+
+import numpy as np
+
+from temgymlite.functions import (
+    axial_point_beam,
+    circular_beam,
+    point_beam,
+    unit_disk_rings,
+    x_axial_point_beam,
+)
+
+
+def _empty_rays(num_rays):
+    rays = np.zeros((1, 5, num_rays))
+    rays[:, 4, :] = 1
+
+    return rays
+
+
+class TimeDiskBeams:
+    """Point and parallel beams, which sample a disk"""
+
+    params = [["point", "paralell"], ["rings", "fibonacci", "sobol", "halton"], [4096, 262144]]
+    param_names = ["beam_type", "sampler", "num_rays"]
+
+    def setup(self, beam_type, sampler, num_rays):
+        self.rays = _empty_rays(num_rays)
+        self.beam = point_beam if beam_type == "point" else circular_beam
+
+    def time_beam(self, beam_type, sampler, num_rays):
+        # The ring layout is cached between calls, so clear it to time building it too
+        unit_disk_rings.cache_clear()
+        self.beam(self.rays, 0.1, sampler, 0)
+
+
+class TimeAxialBeams:
+    """Cross and line shaped beams"""
+
+    params = [["axial", "x_axial"], [4096, 262144]]
+    param_names = ["beam_type", "num_rays"]
+
+    def setup(self, beam_type, num_rays):
+        self.rays = _empty_rays(num_rays)
+        self.beam = axial_point_beam if beam_type == "axial" else x_axial_point_beam
+
+    def time_beam(self, beam_type, num_rays):
+        self.beam(self.rays, 0.1)
@@ -0,0 +1,75 @@
+"""Benchmarks of forming detector images from rays."""
+
+import numpy as np
+
+from benchmarks.columns import make_model
+from temgymlite import components as comp
+from temgymlite.functions import bin_rays, get_image_from_rays, make_test_sample
+from temgymlite.model import Model
+
+
+class TimeImageFromRays:
+    """Detector ray and sample images of a million rays against the detector size"""
+
+    params = [[64, 256, 1024]]
+    param_names = ["detector_pixels"]
+
+    def setup(self, detector_pixels):
+        rng = np.random.default_rng(0)
+        self.rays = rng.normal(scale=0.1, size=(4, 1_000_000))
+        self.sample_image = np.abs(make_test_sample())
+        self.detector_pixels = detector_pixels
+
+    def time_get_image_from_rays(self, detector_pixels):
+        get_image_from_rays(
+            self.rays[0],
+            self.rays[1],
+            self.rays[2],
+            self.rays[3],
+            detector_size=0.5,
+            detector_pixels=detector_pixels,
+            sample_size=0.5,
+            sample_pixels=self.sample_image.shape[0],
+            sample_image=self.sample_image,
+        )
+
+    def time_bin_rays(self, detector_pixels):
+        bin_rays(self.rays[0], self.rays[1], 0.5, detector_pixels)
+
+
+class Time4DSTEMScan:
+    """A 4DSTEM scan of fixed size"""
+
+    timeout = 300
+
+    def setup(self):
+        components = [
+            comp.DoubleDeflector(name="Scan Coils", z_up=0.9, z_low=0.8),
+            comp.Lens(name="Lens", z=0.65),
+            comp.Sample(name="Sample", z=0.5, width=0.25),
+            comp.DoubleDeflector(name="Descan Coils", z_up=0.35, z_low=0.3),
+        ]
+        self.model = Model(
+            components,
+            beam_z=1,
+            beam_type="paralell",
+            num_rays=256,
+            experiment="4DSTEM",
+            detector_pixels=64,
+        )
+        self.model.scan_pixels = 64
+        self.sample_image = np.abs(make_test_sample())
+
+    def time_run_4dstem_scan(self):
+        self.model.run_4dstem_scan(sample_image=self.sample_image)
+
+
+class TimeSweepImages:
+    """Detector images of a focus series of the SEM column"""
+
+    def setup(self):
+        self.model = make_model("sem", 4096)
+        self.focal_lengths = np.linspace(-0.35, -0.25, 64)
+
+    def time_sweep_images(self):
+        self.model.sweep_images({"Objective Lens.f": self.focal_lengths})
@@ -0,0 +1,42 @@
+"""Benchmarks of drawing the column, with a backend that never opens a window."""
+
+import matplotlib
+
+from benchmarks.columns import make_model
+from temgymlite.functions import convert_rays_to_line_vertices, empty_line_vertices
+
+matplotlib.use("Agg")
+
+
+class TimeLineVertices:
+    """Line vertices of every ray for an interactive view"""
+
+    params = [["sem", "tem"], [64, 65536]]
+    param_names = ["column", "num_rays"]
+
+    def setup(self, column, num_rays):
+        self.model = make_model(column, num_rays)
+        self.model.step()
+        self.vertices = empty_line_vertices(self.model)
+
+    def time_convert_rays_to_line_vertices(self, column, num_rays):
+        convert_rays_to_line_vertices(self.model, out=self.vertices)
+
+
+class TimeShowMatplotlib:
+    """Building and drawing the whole figure of a column"""
+
+    params = [["sem", "tem"], ["x_axial", "point"]]
+    param_names = ["column", "beam_type"]
+
+    def setup(self, column, beam_type):
+        self.model = make_model(column, 65, beam_type=beam_type)
+
+    def time_show_matplotlib(self, column, beam_type):
+        import matplotlib.pyplot as plt
+
+        from temgymlite.run import show_matplotlib
+
+        fig, ax = show_matplotlib(self.model, label_fontsize=14)
+        fig.canvas.draw()
+        plt.close(fig)
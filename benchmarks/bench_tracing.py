@@ -0,0 +1,56 @@
+"""Benchmarks of tracing rays through the example columns."""
+
+from benchmarks.columns import make_model
+
+
+class TimeStep:
+    """Full retrace of a column after its first lens has changed, as when a slider moves"""
+
+    params = [["sem", "tem"], [64, 4096, 262144]]
+    param_names = ["column", "num_rays"]
+
+    def setup(self, column, num_rays):
+        self.model = make_model(column, num_rays)
+        self.model.step()
+        self.lens = self.model.components[0]
+        self.focal_lengths = (self.lens.f, self.lens.f * 1.01)
+        self.calls = 0
+
+    def time_step(self, column, num_rays):
+        # Change the first component so that the whole column is traced again
+        self.calls += 1
+        self.lens.f = self.focal_lengths[self.calls % 2]
+        self.model.step()
+
+
+class TimeStepComponents:
+    """Full retrace of the top of the TEM column against the number of components"""
+
+    params = [[2, 5, 10, 20]]
+    param_names = ["num_components"]
+
+    def setup(self, num_components):
+        self.model = make_model("tem", 65536, num_components=num_components)
+        self.model.step()
+        self.lens = self.model.components[0]
+        self.focal_lengths = (self.lens.f, self.lens.f * 1.01)
+        self.calls = 0
+
+    def time_step(self, num_components):
+        self.calls += 1
+        self.lens.f = self.focal_lengths[self.calls % 2]
+        self.model.step()
+
+
+class TimeStepCompiled:
+    """Tracing straight to the detector with the compiled column"""
+
+    params = [["sem", "tem"], [4096, 262144]]
+    param_names = ["column", "num_rays"]
+
+    def setup(self, column, num_rays):
+        self.model = make_model(column, num_rays)
+        self.model.step_compiled()
+
+    def time_step_compiled(self, column, num_rays):
+        self.model.step_compiled()
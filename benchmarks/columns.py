@@ -0,0 +1,79 @@
+"""Microscope columns shared by the benchmarks, taken from the TEM and SEM examples."""
+
+from temgymlite import components as comp
+from temgymlite.model import Model
+
+
+def tem_components():
+    return [
+        comp.Lens(name="Electrostatic Lens", z=3, f=-0.2),
+        comp.DoubleDeflector(name="Gun Beam Deflectors", z_up=2.8, z_low=2.7),
+        comp.Lens(name="1st Condenser Lens", z=2.6, f=-0.2),
+        comp.Lens(name="2nd Condenser Lens", z=2.5, f=-0.2),
+        comp.Aperture(name="Condenser Aperture", z=2.3, aperture_radius_inner=0.05),
+        comp.Quadrupole(name="Condenser Stig", z=2.2),
+        comp.DoubleDeflector(name="Condenser Deflectors", z_up=2.1, z_low=2.0),
+        comp.Lens(name="Condenser Mini Lens", z=1.8, f=-0.2),
+        comp.Aperture(name="Objective Aperture", z=1.7, aperture_radius_inner=0.05),
+        comp.Lens(name="Objective Lens", z=1.5, f=-0.2),
+        comp.Quadrupole(name="Objective Stig", z=1.4),
+        comp.Lens(name="Objective Mini Lens", z=1.3, f=-0.2),
+        comp.DoubleDeflector(name="Image Shifts", z_up=1.1, z_low=1.0),
+        comp.Aperture(name="Selected Area Aperture", z=0.9, aperture_radius_inner=0.05),
+        comp.Quadrupole(name="Intermediate Lens Stigmator", z=0.8),
+        comp.Lens(name="1st Intermediate Lens", z=0.7, f=-0.2),
+        comp.Lens(name="2nd Intermediate Lens", z=0.6, f=-0.2),
+        comp.Lens(name="3rd Intermediate Lens", z=0.5, f=-0.2),
+        comp.DoubleDeflector(name="Projector Lens Deflectors", z_up=0.4, z_low=0.3),
+        comp.Lens(name="Projector Lens", z=0.2, f=-0.2),
+    ]
+
+
+def sem_components():
+    return [
+        comp.Lens(name="1st Condenser Lens", z=1.5, f=-0.05),
+        comp.Aperture(name="Spray Aperture", z=1.2, aperture_radius_inner=0.05),
+        comp.Lens(name="2nd Condenser Lens", z=1.0, f=-0.15),
+        comp.DoubleDeflector(name="Deflection Coils", z_up=0.8, z_low=0.7),
+        comp.Lens(name="Objective Lens", z=0.5, f=-0.3),
+        comp.Aperture(name="Objective Aperture", z=0.4, aperture_radius_inner=0.05),
+        comp.Sample(name="Sample", z=0.1),
+    ]
+
+
+COLUMNS = {
+    "sem": (sem_components, 1.7),
+    "tem": (tem_components, 3.5),
+}
+
+
+def make_model(column, num_rays, beam_type="point", num_components=None, **kwargs):
+    """Model of one of the example columns
+
+    Parameters
+    ----------
+    column : str
+        "sem" or "tem"
+    num_rays : int
+        Number of rays
+    beam_type : str, optional
+        Type of beam, by default "point"
+    num_components : int, optional
+        Only keep this many components from the top of the column, by default all of them
+
+    Returns
+    -------
+    model : Model
+        Model of the column
+    """
+    make_components, beam_z = COLUMNS[column]
+    components = make_components()[:num_components]
+
+    return Model(
+        components,
+        beam_z=beam_z,
+        beam_type=beam_type,
+        num_rays=num_rays,
+        gun_beam_semi_angle=0.15,
+        **kwargs,
+    )
@@ -0,0 +1,253 @@
+"""Runs the benchmarks of this directory without any benchmarking package, and stores the results
+as JSON so that two runs, e.g. of two releases, can be compared. The benchmarks are written in the
+style of asv: classes with time_* methods, and optionally params, param_names, setup and teardown,
+so asv can also run them directly.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --output new.json --compare results.json
+"""
+
+import argparse
+import datetime
+import importlib
+import inspect
+import itertools
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_benchmarks(pattern=None):
+    """Find the benchmarks of every bench_*.py module of this directory
+
+    Parameters
+    ----------
+    pattern : str, optional
+        Regular expression which the full name of a benchmark must contain, e.g. "TimeStep"
+
+    Returns
+    -------
+    benchmarks : list
+        List of (name, class, method name) of every benchmark
+    """
+    benchmarks = []
+    for file_name in sorted(os.listdir(BENCHMARK_DIR)):
+        if not (file_name.startswith("bench_") and file_name.endswith(".py")):
+            continue
+
+        module_name = file_name[:-3]
+        module = importlib.import_module(f"{__package__ or 'benchmarks'}.{module_name}")
+
+        for class_name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+
+            for method_name in sorted(vars(cls)):
+                if not method_name.startswith("time_"):
+                    continue
+
+                name = f"{module_name}.{class_name}.{method_name}"
+                if pattern is None or re.search(pattern, name):
+                    benchmarks.append((name, cls, method_name))
+
+    return benchmarks
+
+
+def get_param_sets(cls):
+    """Every combination of the parameters of a benchmark class, as a list of dictionaries"""
+    params = getattr(cls, "params", [])
+    if not params:
+        return [{}]
+
+    # asv allows a single list of values for a benchmark with one parameter
+    if not isinstance(params[0], (list, tuple)):
+        params = [params]
+
+    param_names = getattr(cls, "param_names", [f"param{idx}" for idx in range(len(params))])
+
+    return [dict(zip(param_names, values)) for values in itertools.product(*params)]
+
+
+def time_benchmark(cls, method_name, params, repeat=5, min_sample_time=0.05):
+    """Time one benchmark for one set of parameters
+
+    Parameters
+    ----------
+    cls : class
+        Benchmark class
+    method_name : str
+        Name of the time_* method
+    params : dict
+        Parameters of the benchmark
+    repeat : int, optional
+        Number of samples to take, by default 5
+    min_sample_time : float, optional
+        Each sample calls the benchmark enough times to take at least this long in seconds,
+        by default 0.05
+
+    Returns
+    -------
+    result : dict
+        Best and median time of a single call in seconds, and how they were measured
+    """
+    instance = cls()
+    values = list(params.values())
+
+    if hasattr(instance, "setup"):
+        instance.setup(*values)
+
+    try:
+        method = getattr(instance, method_name)
+
+        # The first call warms up any caches, and tells us how many calls make a sample
+        start = time.perf_counter()
+        method(*values)
+        first_time = time.perf_counter() - start
+        number = max(1, int(min_sample_time / max(first_time, 1e-9)))
+
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                method(*values)
+            samples.append((time.perf_counter() - start) / number)
+    finally:
+        if hasattr(instance, "teardown"):
+            instance.teardown(*values)
+
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def get_environment():
+    """Versions of the package and its dependencies, and a description of the machine"""
+    import matplotlib
+    import numpy
+
+    import temgymlite
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "temgymlite": temgymlite.__version__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def get_result_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare_results(results, baseline, factor):
+    """Print the change in the median time of every benchmark found in both runs
+
+    Parameters
+    ----------
+    results : list
+        Results of this run
+    baseline : list
+        Results of the run to compare to
+    factor : float
+        Ratio of the median times above which a benchmark counts as a regression
+
+    Returns
+    -------
+    regressions : list
+        Keys of the benchmarks which have become slower by more than factor
+    """
+    baseline = {get_result_key(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        key = get_result_key(result)
+        if key not in baseline:
+            continue
+
+        ratio = result["median"] / baseline[key]["median"]
+        flag = ""
+        if ratio > factor:
+            flag = "  slower"
+            regressions.append(key)
+        elif ratio < 1 / factor:
+            flag = "  faster"
+
+        print(f"{ratio:7.2f}x  {key}{flag}")
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmarks of temgymlite")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare to")
+    parser.add_argument(
+        "--factor",
+        type=float,
+        default=1.2,
+        help="Slowdown against --compare that counts as a regression, by default 1.2",
+    )
+    parser.add_argument("--filter", help="Only run benchmarks whose name matches this regex")
+    parser.add_argument("--repeat", type=int, default=5, help="Samples per benchmark")
+    parser.add_argument(
+        "--quick", action="store_true", help="Take a single sample of a single call"
+    )
+    args = parser.parse_args(argv)
+
+    repeat, min_sample_time = (1, 0) if args.quick else (args.repeat, 0.05)
+
+    results = []
+    for name, cls, method_name in find_benchmarks(args.filter):
+        for params in get_param_sets(cls):
+            result = {"name": name, "params": params}
+            result.update(time_benchmark(cls, method_name, params, repeat, min_sample_time))
+            results.append(result)
+
+            print(f"{result['median'] * 1e3:12.3f} ms  {get_result_key(result)}", flush=True)
+
+    run = {"environment": get_environment(), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        print(f"\nCompared to {args.compare} ({baseline['environment'].get('commit')})")
+        if compare_results(results, baseline["results"], args.factor):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
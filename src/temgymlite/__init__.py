@@ -13,6 +13,27 @@ from temgymlite.components import (
     Sample,
 )
 from temgymlite.model import Model
-from temgymlite.run import show_matplotlib
 
 # fmt: on
+
+# The plotting layer imports matplotlib, so it is only loaded when one of its names is first used
+_lazy_attributes = {
+    "ModelRenderer": "temgymlite.run",
+    "export_sweep_frames": "temgymlite.export",
+    "show_matplotlib": "temgymlite.run",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
@@ -0,0 +1,94 @@
+"""Selects the array library a model traces its rays with. NumPy is the default. Any other library
+is used through its namespace of the Python array API standard, e.g. array_api_strict or
+jax.numpy, so the tracer only calls functions of the standard on it. The rays are generated with
+NumPy and moved to the namespace once, and the small transfer matrices of the components are
+always built with NumPy."""
+
+import importlib
+
+import numpy as np
+
+# Modules of the array API namespaces of libraries which keep it apart from their main module
+NAMESPACE_MODULES = {
+    "numpy": "numpy",
+    "strict": "array_api_strict",
+    "array_api_strict": "array_api_strict",
+    "jax": "jax.numpy",
+    "cupy": "cupy",
+    "torch": "array_api_compat.torch",
+}
+
+
+def get_namespace(array_namespace=None):
+    """Find the array API namespace to trace rays with
+
+    Parameters
+    ----------
+    array_namespace : module, str or None, optional
+        Namespace module, e.g. array_api_strict, the name of a library, e.g. "jax", or None
+        for NumPy, by default None
+
+    Returns
+    -------
+    xp : module
+        Array API namespace
+    """
+    if array_namespace is None:
+        return np
+
+    if isinstance(array_namespace, str):
+        module_name = NAMESPACE_MODULES.get(array_namespace, array_namespace)
+        try:
+            array_namespace = importlib.import_module(module_name)
+        except ImportError as error:
+            raise ImportError(
+                f"The array namespace {module_name!r} could not be imported"
+            ) from error
+
+    for name in ("asarray", "matmul", "stack", "where"):
+        if not hasattr(array_namespace, name):
+            raise TypeError(f"{array_namespace!r} is not an array API namespace")
+
+    return array_namespace
+
+
+def array_namespace(*arrays):
+    """Find the namespace of arrays, which is NumPy for NumPy arrays and for anything which
+    is not an array API array, such as a list or a float
+
+    Parameters
+    ----------
+    *arrays
+        Arrays of one namespace
+
+    Returns
+    -------
+    xp : module
+        Array API namespace of the arrays
+    """
+    for array in arrays:
+        if isinstance(array, np.ndarray) or not hasattr(array, "__array_namespace__"):
+            continue
+        return array.__array_namespace__()
+
+    return np
+
+
+def to_numpy(array):
+    """Convert an array of any namespace on the CPU to a NumPy array, without copying it
+    if it already is one
+
+    Parameters
+    ----------
+    array : array
+        Array to convert
+
+    Returns
+    -------
+    ndarray
+        NumPy array
+    """
+    if isinstance(array, np.ndarray) or not hasattr(array, "__dlpack__"):
+        return np.asarray(array)
+
+    return np.from_dlpack(array)
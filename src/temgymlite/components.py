@@ -1,11 +1,233 @@
 import numpy as np
 
+from temgymlite.backend import array_namespace
+from temgymlite.functions import transfer_rays
 
-class Lens:
+
+def _transfer_matrix(rows):
+    """Build a ray transfer matrix from nested rows of entries. If any of the entries is an
+    array, a stack of matrices is built instead, with the matrix axes last.
+
+    Parameters
+    ----------
+    rows : list
+        Rows of the matrix, each a list of floats or arrays
+
+    Returns
+    -------
+    ndarray
+        Ray transfer matrix of shape (5, 5), or (..., 5, 5) for array entries
+    """
+    # Entries are almost always floats, so try the quick way first
+    try:
+        return np.array(rows, dtype=np.float64)
+    except (ValueError, TypeError):
+        pass
+
+    shape = np.broadcast_shapes(*[np.shape(entry) for row in rows for entry in row])
+    matrix = np.empty(shape + (len(rows), len(rows[0])))
+    for i, row in enumerate(rows):
+        for j, entry in enumerate(row):
+            matrix[..., i, j] = entry
+
+    return matrix
+
+
+def _entry_derivative(*entries):
+    """Build the derivative of a transfer matrix which depends on a parameter only through
+    some of its entries
+
+    Parameters
+    ----------
+    *entries : tuple
+        (row, column, derivative) of each entry which depends on the parameter
+
+    Returns
+    -------
+    ndarray
+        Derivative of the matrix of shape (5, 5)
+    """
+    derivative = np.zeros((5, 5))
+    for row, column, value in entries:
+        derivative[row, column] = value
+
+    return derivative
+
+
+class Component:
+    """Base class of all components. Keeps count of every change to the parameters which
+    change the path of rays through the component, so that the model can tell which
+    components have been modified since the rays were last traced. Also flags when a
+    parameter has changed since the component matrix was last set, so the model knows
+    the matrix has to be set again.
+
+    Every component also describes how the model traces rays through it: the number of
+    ray planes it takes up, their z positions and transfer matrices, and whether it is
+    linear. A linear component acts on rays only through its transfer matrices, so the
+    model can fuse it with its neighbours into one matrix. Any other component acts on
+    rays through apply(). A new component, linear or not, can be added to a model by
+    subclassing Component without changing the model.
+    """
+
+    # Names of the attributes which change the path of rays through the component
+    tracked_parameters = ()
+
+    # Names of the attributes which hold the component matrices
+    matrix_attributes = ("matrix", "up_matrix", "low_matrix")
+
+    # Number of times a tracked parameter of this component has been set
+    modified_count = 0
+
+    # Whether a parameter has changed since the component matrix was last set
+    matrix_dirty = False
+
+    # Number of ray planes the component takes up in the column
+    num_planes = 1
+
+    # Whether the component acts on rays only through its transfer matrices
+    linear = True
+
+    # Whether a compiled column is split at the component, so that the rays which reach
+    # it are kept. This is always the case for components which are not linear.
+    compiled_stop = False
+
+    def __setattr__(self, name, value):
+        if name in self.tracked_parameters:
+            object.__setattr__(self, "modified_count", self.modified_count + 1)
+            object.__setattr__(
+                self, "matrix_dirty", name not in self.matrix_attributes
+            )
+        object.__setattr__(self, name, value)
+
+    def get_z_positions(self):
+        """Get the z position of each plane of the component
+
+        Returns
+        -------
+        list
+            z position of each plane, from the top of the column down
+        """
+        return [self.z]
+
+    def get_matrices(self):
+        """Get the transfer matrix of each plane of the component
+
+        Returns
+        -------
+        list
+            Transfer matrix of each plane, from the top of the column down
+        """
+        return [self.matrix]
+
+    def set_matrices(self):
+        """Set the transfer matrix of each plane of the component from its parameters"""
+        self.set_matrix()
+
+    def apply(self, rays, out=None, plane=0):
+        """Apply the component to rays at one of its planes. Linear components apply their
+        transfer matrix of that plane.
+
+        Parameters
+        ----------
+        rays : ndarray
+            Ray positions and slopes at the plane of shape (..., 5, num_rays), or
+            (..., 4, num_rays) for compact rays
+        out : ndarray, optional
+            Array to write the rays leaving the component to, by default the rays are
+            updated in place
+        plane : int, optional
+            Index of the plane of the component, by default 0
+
+        Returns
+        -------
+        blocked_ray_bools : ndarray or None
+            Boolean array of shape (..., num_rays) which is True for rays blocked by the
+            component, or None if the component blocks no rays
+        """
+        transfer_rays(self.get_matrices()[plane], rays, out=rays if out is None else out)
+
+        return None
+
+    def transfer(self, rays, plane=0):
+        """Apply the component to rays at one of its planes without changing them in place,
+        with the array namespace of the rays. This is how models with an array namespace
+        other than NumPy apply components which are not linear, see apply(). Components
+        which are not linear and do not override it apply themselves to a copy of the rays.
+
+        Parameters
+        ----------
+        rays : array
+            Ray positions and slopes at the plane of shape (..., 5, num_rays), or
+            (..., 4, num_rays) for compact rays
+        plane : int, optional
+            Index of the plane of the component, by default 0
+
+        Returns
+        -------
+        rays : array
+            Rays leaving the component
+        blocked_ray_bools : array or None
+            Boolean array of shape (..., num_rays) which is True for rays blocked by the
+            component, or None if the component blocks no rays
+        """
+        if self.linear:
+            return transfer_rays(self.get_matrices()[plane], rays), None
+
+        rays = array_namespace(rays).asarray(rays, copy=True)
+
+        return rays, self.apply(rays, plane=plane)
+
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """Get the derivative of the transfer matrix of each plane of the component with
+        respect to one of its parameters. Components give the derivatives of their own
+        parameters analytically, and any other parameter is differentiated by central
+        differences of set_matrices(). Parameters which move the component, such as z,
+        change the propagation around it rather than its matrices, so they cannot be
+        differentiated here.
+
+        Parameters
+        ----------
+        parameter : str
+            Name of the parameter, e.g. "f"
+        step : float, optional
+            Relative step of the central differences, by default 1e-6
+
+        Returns
+        -------
+        list
+            Derivative of the transfer matrix of each plane, from the top of the column down
+        """
+        value = getattr(self, parameter)
+        z_positions = self.get_z_positions()
+        h = step * max(abs(value), 1)
+
+        sides = []
+        try:
+            for shifted in (value + h, value - h):
+                setattr(self, parameter, shifted)
+                self.set_matrices()
+                if self.get_z_positions() != z_positions:
+                    raise ValueError(
+                        f"Parameter '{parameter}' moves component '{self.name}', so it "
+                        "cannot be differentiated"
+                    )
+                sides.append(
+                    [np.array(matrix, dtype=np.float64) for matrix in self.get_matrices()]
+                )
+        finally:
+            setattr(self, parameter, value)
+            self.set_matrices()
+
+        return [(upper - lower) / (2 * h) for upper, lower in zip(*sides)]
+
+
+class Lens(Component):
     """Creates a lens component and handles calls to GUI creation, updates to GUI
     and stores the component matrix.
     """
 
+    tracked_parameters = ("z", "f", "matrix")
+
     def __init__(self, z, name="", f=0.5, label_radius=0.3, radius=0.25, num_points=50):
         """
 
@@ -53,7 +275,7 @@ class Lens:
             Output Ray Transfer Matrix
         """
 
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [-1 / f, 1, 0, 0, 0],
@@ -69,12 +291,21 @@ class Lens:
         """ """
         self.matrix = self.lens_matrix(self.f)
 
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """See Component.get_matrix_derivatives()"""
+        if parameter == "f":
+            return [_entry_derivative((1, 0, 1 / self.f**2), (3, 2, 1 / self.f**2))]
+
+        return super().get_matrix_derivatives(parameter, step)
 
-class AstigmaticLens:
+
+class AstigmaticLens(Component):
     """Creates an Astigmatic lens component and handles calls to GUI creation, updates to GUI
     and stores the component matrix.
     """
 
+    tracked_parameters = ("z", "fx", "fy", "matrix")
+
     def __init__(
         self, z, name="", fx=-0.5, fy=-0.5, label_radius=0.3, radius=0.25, num_points=50
     ):
@@ -132,7 +363,7 @@ class AstigmaticLens:
             Output Ray Transfer Matrix
         """
 
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [-1 / fx, 1, 0, 0, 0],
@@ -148,12 +379,23 @@ class AstigmaticLens:
         """ """
         self.matrix = self.lens_matrix(self.fx, self.fy)
 
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """See Component.get_matrix_derivatives()"""
+        if parameter == "fx":
+            return [_entry_derivative((1, 0, 1 / self.fx**2))]
+        if parameter == "fy":
+            return [_entry_derivative((3, 2, 1 / self.fy**2))]
+
+        return super().get_matrix_derivatives(parameter, step)
 
-class Quadrupole:
+
+class Quadrupole(Component):
     """Creates a quadrupole component and handles calls to GUI creation, updates to GUI
     and stores the component matrix. Almost exactly the same as astigmatic lens component
     """
 
+    tracked_parameters = ("z", "fx", "fy", "matrix")
+
     def __init__(
         self, z, name="", fx=-0.5, fy=-0.5, label_radius=0.3, radius=0.25, num_points=50
     ):
@@ -211,7 +453,7 @@ class Quadrupole:
             Output Ray Transfer Matrix
         """
 
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [-1 / fx, 1, 0, 0, 0],
@@ -227,12 +469,23 @@ class Quadrupole:
         """ """
         self.matrix = self.lens_matrix(self.fx, self.fy)
 
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """See Component.get_matrix_derivatives()"""
+        if parameter == "fx":
+            return [_entry_derivative((1, 0, 1 / self.fx**2))]
+        if parameter == "fy":
+            return [_entry_derivative((3, 2, 1 / self.fy**2))]
+
+        return super().get_matrix_derivatives(parameter, step)
+
 
-class Deflector:
+class Deflector(Component):
     """Creates a single deflector component and handles calls to GUI creation, updates to GUI
     and stores the component matrix. See Double Deflector component for a more useful version
     """
 
+    tracked_parameters = ("z", "defx", "defy", "matrix")
+
     def __init__(
         self,
         z,
@@ -296,7 +549,7 @@ class Deflector:
             Output ray transfer matrix
         """
 
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [0, 1, 0, 0, def_x],
@@ -312,12 +565,35 @@ class Deflector:
         """ """
         self.matrix = self.deflector_matrix(self.defx, self.defy)
 
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """See Component.get_matrix_derivatives()"""
+        if parameter == "defx":
+            return [_entry_derivative((1, 4, 1))]
+        if parameter == "defy":
+            return [_entry_derivative((3, 4, 1))]
+
+        return super().get_matrix_derivatives(parameter, step)
 
-class DoubleDeflector:
+
+class DoubleDeflector(Component):
     """Creates a double deflector component and handles calls to GUI creation, updates to GUI
     and stores the component matrix. Primarily used in the Beam Tilt/Shift alignment.
     """
 
+    tracked_parameters = (
+        "z_up",
+        "z_low",
+        "updefx",
+        "updefy",
+        "lowdefx",
+        "lowdefy",
+        "scan_rotation",
+        "up_matrix",
+        "low_matrix",
+    )
+
+    num_planes = 2
+
     def __init__(
         self,
         z_up,
@@ -418,7 +694,7 @@ class DoubleDeflector:
         ndarray
             Output ray transfer matrix
         """
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [0, 1, 0, 0, def_x],
@@ -444,7 +720,7 @@ class DoubleDeflector:
             Output ray transfer matrix
         """
         rad = (scan_rotation / 180) * np.pi
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [np.cos(rad), 0, -np.sin(rad), 0, 0],
                 [0, 1, 0, 0, 0],
@@ -464,13 +740,47 @@ class DoubleDeflector:
             self.deflector_matrix(self.lowdefx, self.lowdefy),
         )  # self.deflector_matrix(self.lowdefx, self.lowdefy)
 
+    def get_z_positions(self):
+        """ """
+        return [self.z_up, self.z_low]
+
+    def get_matrices(self):
+        """ """
+        return [self.up_matrix, self.low_matrix]
+
+    def get_matrix_derivatives(self, parameter, step=1e-6):
+        """See Component.get_matrix_derivatives()"""
+        no_change = np.zeros((5, 5))
+        if parameter == "updefx":
+            return [_entry_derivative((1, 4, 1)), no_change]
+        if parameter == "updefy":
+            return [_entry_derivative((3, 4, 1)), no_change]
+
+        # The lower deflection is applied before the scan rotation, which leaves slopes as
+        # they are
+        if parameter == "lowdefx":
+            return [no_change, _entry_derivative((1, 4, 1))]
+        if parameter == "lowdefy":
+            return [no_change, _entry_derivative((3, 4, 1))]
+
+        return super().get_matrix_derivatives(parameter, step)
 
-class Biprism:
+
+class Biprism(Component):
     """Creates a biprism component and handles calls to GUI creation, updates to GUI and stores the component
     parameters. Important to note that the transfer matrix of the biprism is only cosmetic: It still
     need to be multiplied by the sign of the position of the ray to perform like a biprism.
+
+    After a step, blocked_ray_idcs holds the indices of the rays stopped by the biprism wire.
+    Rays already stopped by a component above it are not included, even if they would hit the
+    wire, so every stopped ray is counted by exactly one component, see Model.ray_fates.
     """
 
+    tracked_parameters = ("z", "deflection", "theta", "width", "radius", "matrix")
+
+    linear = False
+    compiled_stop = True
+
     def __init__(
         self,
         z,
@@ -531,7 +841,7 @@ class Biprism:
         ndarray
             Output transfer matrix
         """
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [0, 1, 0, 0, deflection * np.sin(self.theta)],
@@ -547,13 +857,84 @@ class Biprism:
         """ """
         self.matrix = self.biprism_matrix(self.deflection)
 
+    def apply(self, rays, out=None, plane=0):
+        """Deflect rays towards or away from the wire of the biprism, depending on which
+        side of it they pass, and find which rays hit the wire. See Component.apply().
+        """
+        if out is not None and out is not rays:
+            out[...] = rays
+            rays = out
+
+        blocked_ray_bools = self.get_blocked_ray_bools(rays)
+
+        # The matrix may be a stack of matrices during a parameter sweep
+        matrix = np.asarray(self.matrix)
+        rays[..., 1, :] += np.sign(rays[..., 0, :]) * matrix[..., 1, 4, None]
+        rays[..., 3, :] += np.sign(rays[..., 2, :]) * matrix[..., 3, 4, None]
+
+        return blocked_ray_bools
+
+    def transfer(self, rays, plane=0):
+        """Deflect rays as apply() does, into a new array. See Component.transfer()."""
+        xp = array_namespace(rays)
+
+        matrix = np.asarray(self.matrix)
+        deflection_x = xp.asarray(matrix[..., 1, 4, None], dtype=rays.dtype)
+        deflection_y = xp.asarray(matrix[..., 3, 4, None], dtype=rays.dtype)
+
+        slope_x = rays[..., 1, :] + xp.sign(rays[..., 0, :]) * deflection_x
+        slope_y = rays[..., 3, :] + xp.sign(rays[..., 2, :]) * deflection_y
+
+        rows = [rays[..., 0, :], slope_x, rays[..., 2, :], slope_y]
+        if rays.shape[-2] == 5:
+            rows.append(rays[..., 4, :])
+
+        return xp.stack(rows, axis=-2), self.get_blocked_ray_bools(rays)
+
+    def get_blocked_ray_bools(self, rays):
+        """Find which rays hit the wire of the biprism
 
-class Aperture:
+        Parameters
+        ----------
+        rays : array
+            Ray positions and slopes at the biprism of shape (..., 5, num_rays)
+
+        Returns
+        -------
+        blocked_ray_bools : array
+            Boolean array of shape (..., num_rays) which is True for rays that hit the wire
+        """
+        x = abs(rays[..., 0, :])
+        y = abs(rays[..., 2, :])
+
+        if self.theta != 0:
+            return (x < self.width) & (y < self.radius)
+
+        return (x < self.radius) & (y < self.width)
+
+
+class Aperture(Component):
     """Creates an aperture component and handles calls to GUI creation, updates to GUI and stores the component
     parameters. Important to note that the transfer matrix of the aperture only propagates rays. The logic of
-    blocking rays is handled inside the "model" function.
+    blocking rays is handled by apply().
+
+    After a step, blocked_ray_idcs holds the indices of the rays stopped by the aperture. Rays
+    already stopped by a component above it are not included, even if they would hit the
+    aperture, so every stopped ray is counted by exactly one component, see Model.ray_fates.
     """
 
+    tracked_parameters = (
+        "z",
+        "x",
+        "y",
+        "aperture_radius_inner",
+        "aperture_radius_outer",
+        "matrix",
+    )
+
+    linear = False
+    compiled_stop = True
+
     def __init__(
         self,
         z,
@@ -609,7 +990,52 @@ class Aperture:
 
     def set_matrix(self):
         """ """
-        self.matrix = self.aperture_matrix
+        self.matrix = self.aperture_matrix()
+
+    def apply(self, rays, out=None, plane=0):
+        """Find which rays are blocked by the aperture, whose parameters may be arrays of
+        one value per sweep point. The rays themselves pass unchanged. See
+        Component.apply().
+        """
+        if out is not None and out is not rays:
+            out[...] = rays
+
+        return self.get_blocked_ray_bools(rays)
+
+    def transfer(self, rays, plane=0):
+        """Find which rays are blocked by the aperture, which passes the rays unchanged.
+        See Component.transfer()."""
+        return rays, self.get_blocked_ray_bools(rays)
+
+    def get_blocked_ray_bools(self, rays):
+        """Find which rays are blocked by the aperture, in the array namespace of the rays
+
+        Parameters
+        ----------
+        rays : array
+            Ray positions and slopes at the aperture of shape (..., 5, num_rays)
+
+        Returns
+        -------
+        blocked_ray_bools : array
+            Boolean array of shape (..., num_rays) which is True for blocked rays
+        """
+        xp = array_namespace(rays)
+
+        # Give array parameters a ray axis to broadcast against
+        x, y = rays[..., 0, :], rays[..., 2, :]
+        xc, yc, radius_inner, radius_outer = (
+            xp.asarray(np.expand_dims(parameter, -1)) if np.ndim(parameter) else parameter
+            for parameter in (
+                self.x,
+                self.y,
+                self.aperture_radius_inner,
+                self.aperture_radius_outer,
+            )
+        )
+        distance = xp.sqrt((x - xc) ** 2 + (y - yc) ** 2)
+
+        return (distance >= radius_inner) & (distance < radius_outer)
 
     def aperture_matrix(self):
         """Aperture transfer matrix - simply a unit matrix of ones because
@@ -621,7 +1047,7 @@ class Aperture:
             unit matrix
         """
         # creates a placeholder aperture matrix
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [0, 1, 0, 0, 0],
@@ -634,9 +1060,13 @@ class Aperture:
         return matrix
 
 
-class Sample:
+class Sample(Component):
     """Creates a sample component which serves only as a visualisation on the 3D model."""
 
+    tracked_parameters = ("z", "matrix")
+
+    compiled_stop = True
+
     def __init__(
         self,
         z=0.0,
@@ -698,7 +1128,7 @@ class Sample:
         ndarray
             unit matrix
         """
-        matrix = np.array(
+        matrix = _transfer_matrix(
             [
                 [1, 0, 0, 0, 0],
                 [0, 1, 0, 0, 0],
@@ -0,0 +1,280 @@
+"""Renders the frames of an animation of a model over a schedule of component parameters, e.g. a
+focus series, with a pool of worker processes. Every worker keeps its own figure of the model and
+only redraws the rays for each frame it is given. The frames are written as numbered PNG files, or
+piped in order to ffmpeg to encode a video."""
+
+import io
+import os
+import shutil
+import subprocess
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# State of each worker process, set once by _init_worker so that it is not pickled for every frame
+_worker = {}
+
+
+def get_frame_schedule(model, parameters):
+    """Resolve the swept parameters of an animation to the components of the model
+
+    Parameters
+    ----------
+    model : Model
+        Model to animate
+    parameters : dict
+        Dictionary of "Component Name.attribute" or (component, "attribute") keys with an
+        array of one value per frame each, as for Model.sweep()
+
+    Returns
+    -------
+    schedule : list
+        List of (component index, attribute, values) for every swept parameter, which can
+        be applied to a pickled copy of the model
+    num_frames : int
+        Number of frames
+    """
+    schedule = []
+    num_frames = None
+    for key, values in parameters.items():
+        if isinstance(key, str):
+            name, attribute = key.rsplit(".", 1)
+            component = model.find_component(name)
+        else:
+            component, attribute = key
+
+        if not hasattr(component, attribute):
+            raise AttributeError(
+                f"Component '{component.name}' has no parameter '{attribute}' to animate"
+            )
+
+        values = np.asarray(values, dtype=np.float64)
+        if num_frames is None:
+            num_frames = len(values)
+        elif len(values) != num_frames:
+            raise ValueError("All animated parameters must have the same number of values")
+
+        schedule.append((model.components.index(component), attribute, values))
+
+    if num_frames is None:
+        raise ValueError("No parameters to animate")
+
+    return schedule, num_frames
+
+
+def _init_worker(model, schedule, figsize, dpi, out_dir, frame_name, render_kwargs):
+    """Set up a worker process with its own copy of the model and its own figure
+
+    Parameters
+    ----------
+    model : Model
+        Pickled copy of the model
+    schedule : list
+        Swept parameters, see get_frame_schedule
+    figsize : tuple
+        Size of the figure in inches
+    dpi : float
+        Resolution of the frames in dots per inch
+    out_dir : str
+        Directory to write the frames to, or None to return them as PNG data
+    frame_name : str
+        Format of the file name of each frame, e.g. "frame_{:05d}.png"
+    render_kwargs : dict
+        Keyword arguments of the ModelRenderer
+    """
+    # The figure is never shown, so draw it without pyplot or any GUI backend
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from temgymlite.run import ModelRenderer, plot_style
+
+    with plot_style():
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+
+    _worker["model"] = model
+    _worker["schedule"] = schedule
+    _worker["dpi"] = dpi
+    _worker["out_dir"] = out_dir
+    _worker["frame_name"] = frame_name
+    _worker["renderer"] = ModelRenderer(model, figax=(fig, ax), **render_kwargs)
+
+
+def _render_frame(frame):
+    """Render one frame in a worker process
+
+    Parameters
+    ----------
+    frame : int
+        Index of the frame
+
+    Returns
+    -------
+    frame : int
+        Index of the frame
+    data : bytes
+        PNG data of the frame if there is no output directory, otherwise None
+    frame_time : float
+        Time taken to trace, draw and write the frame in seconds
+    """
+    start = time.perf_counter()
+
+    model = _worker["model"]
+    for component_idx, attribute, values in _worker["schedule"]:
+        setattr(model.components[component_idx], attribute, values[frame])
+
+    renderer = _worker["renderer"]
+    renderer.update(draw=False)
+
+    data = None
+    if _worker["out_dir"] is None:
+        buffer = io.BytesIO()
+        renderer.fig.savefig(buffer, format="png", dpi=_worker["dpi"])
+        data = buffer.getvalue()
+    elif _worker["out_dir"] is not False:
+        path = os.path.join(_worker["out_dir"], _worker["frame_name"].format(frame))
+        renderer.fig.savefig(path, dpi=_worker["dpi"])
+    else:
+        # A dry run draws the frame without writing it anywhere
+        renderer.fig.canvas.draw()
+
+    return frame, data, time.perf_counter() - start
+
+
+def export_sweep_frames(
+    model,
+    parameters,
+    out_dir=None,
+    video_path=None,
+    fps=25,
+    figsize=(12, 20),
+    dpi=72,
+    frame_name="frame_{:05d}.png",
+    max_workers=None,
+    dry_run=False,
+    **render_kwargs,
+):
+    """Render an animation of a model over a schedule of component parameters with a pool of
+    worker processes. The model is pickled once per worker, and every worker redraws the
+    rays of its own figure for each frame, see ModelRenderer.
+
+    The frames are written to out_dir as numbered PNG files, and/or piped in order to a
+    local ffmpeg to encode video_path. If ffmpeg cannot be found, a warning is given and
+    only the PNG files are written.
+
+    Parameters
+    ----------
+    model : Model
+        Model to animate. It is left unchanged
+    parameters : dict
+        Dictionary of "Component Name.attribute" or (component, "attribute") keys with an
+        array of one value per frame each, e.g. {"Objective Lens.f": np.linspace(-0.25,
+        -0.15, 600)}
+    out_dir : str, optional
+        Directory to write the numbered PNG frames to, which is created if needed
+    video_path : str, optional
+        Path of a video to encode the frames into with ffmpeg, e.g. "focus.mp4"
+    fps : float, optional
+        Frame rate of the video, by default 25
+    figsize : tuple, optional
+        Size of the figure in inches, by default (12, 20) as in show_matplotlib
+    dpi : float, optional
+        Resolution of the frames in dots per inch, by default 72
+    frame_name : str, optional
+        Format of the file name of each frame, by default "frame_{:05d}.png"
+    max_workers : int, optional
+        Number of worker processes, by default the number of CPUs
+    dry_run : bool, optional
+        Trace and draw every frame without writing anything, to time the frames, by
+        default False
+    **render_kwargs
+        Keyword arguments of show_matplotlib for the appearance of the frames
+
+    Returns
+    -------
+    frame_times : ndarray
+        Time taken by a worker to trace, draw and write each frame in seconds
+    """
+    schedule, num_frames = get_frame_schedule(model, parameters)
+
+    if dry_run:
+        out_dir, video_path = False, None
+    elif out_dir is None and video_path is None:
+        raise ValueError("Give an out_dir for the frames and/or a video_path")
+
+    ffmpeg = None
+    if video_path is not None:
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            if out_dir is None:
+                out_dir = os.path.splitext(video_path)[0] + "_frames"
+            warnings.warn(f"ffmpeg was not found, so the frames are written to {out_dir}")
+
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    encoder = None
+    if ffmpeg is not None:
+        encoder = subprocess.Popen(
+            [
+                ffmpeg,
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                str(fps),
+                "-c:v",
+                "png",
+                "-i",
+                "-",
+                # Most players need an even width and height
+                "-vf",
+                "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-pix_fmt",
+                "yuv420p",
+                video_path,
+            ],
+            stdin=subprocess.PIPE,
+        )
+
+    frame_times = np.zeros(num_frames)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(
+                model,
+                schedule,
+                figsize,
+                dpi,
+                # Workers send the PNG data back to be piped to ffmpeg in order, and also
+                # write it to out_dir if one is given
+                None if encoder is not None else out_dir,
+                frame_name,
+                render_kwargs,
+            ),
+        ) as executor:
+            # Results arrive in the order of the frames, so they can be piped straight on
+            for frame, data, frame_time in executor.map(_render_frame, range(num_frames)):
+                frame_times[frame] = frame_time
+
+                if data is not None:
+                    encoder.stdin.write(data)
+                    if out_dir:
+                        with open(os.path.join(out_dir, frame_name.format(frame)), "wb") as f:
+                            f.write(data)
+    finally:
+        if encoder is not None:
+            encoder.stdin.close()
+            encoder.wait()
+
+    if encoder is not None and encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {video_path}")
+
+    return frame_times
@@ -1,5 +1,12 @@
+import json
+import math
+import os
+from functools import lru_cache
+
 import numpy as np
 
+from temgymlite.backend import array_namespace, to_numpy
+
 
 def make_test_sample(size=256):
     # Code From Dieter Weber
@@ -47,26 +54,29 @@ def make_test_sample(size=256):
     return np.abs(obj)
 
 
-# FIXME resolve code duplication between circular_beam() and point_beam()
-def circular_beam(r, outer_radius):
-    """Generates a circular paralell initial beam
+def _read_only(*arrays):
+    """Protect arrays which are shared between calls of a memoized function from being changed"""
+    for array in arrays:
+        array.flags.writeable = False
+
+    return arrays
+
+
+@lru_cache(maxsize=32)
+def ring_point_counts(num_rays):
+    """Number of rays on each of the concentric rings that evenly fill the unit disk, with
+    one ray at the centre. Memoized for the most recently used ray counts.
 
     Parameters
     ----------
-    r : ndarray
-        Ray position and slope matrix
-    outer_radius : float
-        Outer radius of the circular beam
+    num_rays : int
+        Number of rays to lay out
 
     Returns
     -------
-    r : ndarray
-        Updated ray position & slope matrix which create a circular beam
     num_points_kth_ring: ndarray
-        Array of the number of points on each ring of our circular beam
+        Array of the number of points on each ring
     """
-    num_rays = r.shape[2]
-
     # Use the equation from stack overflow about ukrainian graves from 2014
     # to calculate the number of even rings including decimal remainder
     num_circles_dec = (-1 + np.sqrt(1 + 4 * (num_rays) / (np.pi))) / 2
@@ -117,103 +127,405 @@ def circular_beam(r, outer_radius):
     num_points_kth_ring[0] = 1
     num_points_kth_ring[-1] = num_points_kth_ring[-1] - 1
 
+    return _read_only(num_points_kth_ring)[0]
+
+
+def _unit_disk_rings_at(num_rays, indices):
+    """Ring layout of the rays with the given indices, see unit_disk_rings"""
+    num_points_kth_ring = ring_point_counts(num_rays)
+
     # Make get the radii for the number of circles of rays we need
-    radii = np.linspace(0, outer_radius, num_circles_int + 1)
+    radii = np.linspace(0, 1, len(num_points_kth_ring))
 
-    # fill in the x and y coordinates to our ray array
-    idx = 0
-    for i in range(len(radii)):
-        for j in range(num_points_kth_ring[i]):
-            radius = radii[i]
-            t = j * (2 * np.pi / num_points_kth_ring[i])
-            r[0, 0, idx] = radius * np.cos(t)
-            r[0, 2, idx] = radius * np.sin(t)
-            idx += 1
+    # Find the ring of every ray, and its position j along that ring
+    ring_ends = np.cumsum(num_points_kth_ring)
+    ring_idcs = np.searchsorted(ring_ends, indices, side="right")
+    j = indices - (ring_ends - num_points_kth_ring)[ring_idcs]
 
-    return r, num_points_kth_ring
+    t = j * (2 * np.pi / num_points_kth_ring[ring_idcs])
 
+    return radii[ring_idcs], np.cos(t), np.sin(t)
 
-def point_beam(r, gun_beam_semi_angle):
-    """Generates a point initial beam that spreads out with semi angle 'gun_beam_semi_angle'
+
+@lru_cache(maxsize=32)
+def unit_disk_rings(num_rays):
+    """Lays out rays on concentric rings that evenly fill the unit disk, with one ray at
+    the centre. The layout only depends on the number of rays, so it is memoized for the
+    most recently used ray counts.
 
     Parameters
     ----------
-    r : ndarray
-        Ray position and slope matrix
-    gun_beam_semi_angle : float
-        Beam semi angle in radians
+    num_rays : int
+        Number of rays to lay out
 
     Returns
     -------
-    r : ndarray
-        Updated ray position & slope matrix which create a circular beam
+    radius : ndarray
+        Radius of the ring of each ray, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray around its ring
+    sin_t : ndarray
+        Sine of the angle of each ray around its ring
     num_points_kth_ring: ndarray
-        Array of the number of points on each ring of our circular beam
+        Array of the number of points on each ring
     """
-    num_rays = r.shape[2]
+    layout = _unit_disk_rings_at(num_rays, np.arange(num_rays))
 
-    # Use the equation from stack overflow about ukrainian graves
-    # to calculate the number of even rings including decimal remainder
-    num_circles_dec = (-1 + np.sqrt(1 + 4 * (num_rays) / (np.pi))) / 2
+    return _read_only(*layout) + (ring_point_counts(num_rays),)
 
-    # Get the number of integer rings
-    num_circles_int = int(np.floor(num_circles_dec))
 
-    # Calculate the number of points per ring with the integer amoung of rings
-    num_points_kth_ring = np.round(
-        2 * np.pi * (np.arange(0, num_circles_int + 1))
-    ).astype(np.int32)
+# Angle between successive rays of a sunflower spiral
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
 
-    # get the remainding amount of rays
-    remainder_rays = num_rays - np.sum(num_points_kth_ring)
+# Samplers of the unit disk which can be chosen for the point and paralell beams
+DISK_SAMPLERS = ("rings", "fibonacci", "sobol", "halton")
 
-    # Get the proportion of points in each rung
-    proportion = num_points_kth_ring / np.sum(num_points_kth_ring)
 
-    # resolve this proportion to an integer value, and reverse it
-    num_rays_to_each_ring = np.ceil(proportion * remainder_rays)[::-1].astype(np.int32)
+def _polar_from_unit_square(u, v):
+    """Map points of the unit square onto the unit disk with equal area, so that an evenly
+    spread set of points in the square stays evenly spread in the disk."""
+    t = 2 * np.pi * v
 
-    # We need to decide on where to stop adding the remainder of rays to the
-    # rest of the rings. We find this point by summing the rays in each ring
-    # from outside to inside, and then getting the index where it is greater
-    # than or equal to the remainder
-    index_to_stop_adding_rays = np.where(
-        np.cumsum(num_rays_to_each_ring) >= remainder_rays
-    )[0][0]
+    return np.sqrt(u), np.cos(t), np.sin(t)
 
-    # We then get the total number of rays to add
-    rays_to_add = np.cumsum(num_rays_to_each_ring)[index_to_stop_adding_rays].astype(
-        np.int32
+
+def _unit_disk_fibonacci_at(num_rays, indices):
+    """Sunflower layout of the rays with the given indices, see unit_disk_fibonacci"""
+    t = indices * GOLDEN_ANGLE
+
+    return np.sqrt((indices + 0.5) / num_rays), np.cos(t), np.sin(t)
+
+
+@lru_cache(maxsize=32)
+def unit_disk_fibonacci(num_rays):
+    """Lays out rays on the unit disk along a Fibonacci (sunflower) spiral, where each
+    ray is turned by the golden angle from the last and the radius grows so that every
+    ray covers an equal area of the disk. Memoized for the most recently used ray counts.
+
+    Parameters
+    ----------
+    num_rays : int
+        Number of rays to lay out
+
+    Returns
+    -------
+    radius : ndarray
+        Radius of each ray, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray
+    sin_t : ndarray
+        Sine of the angle of each ray
+    """
+    return _read_only(*_unit_disk_fibonacci_at(num_rays, np.arange(num_rays)))
+
+
+def radical_inverse(indices, base, rng=None):
+    """Van der Corput radical inverse of integer indices, which mirrors the digits of
+    each index in the given base about the decimal point. If a random generator is given,
+    the nonzero digits at each position are scrambled with a random permutation.
+
+    Parameters
+    ----------
+    indices : ndarray
+        Non-negative integer indices
+    base : int
+        Base of the digit expansion
+    rng : numpy.random.Generator, optional
+        Random generator used to scramble the digits, by default None
+
+    Returns
+    -------
+    points : ndarray
+        Points in [0, 1) for each index
+    """
+    indices = np.array(indices, dtype=np.int64)
+    points = np.zeros(indices.shape)
+    scale = 1 / base
+
+    while np.any(indices > 0):
+        digits = indices % base
+        if rng is not None:
+            # Keep zero fixed so that the leading zeros of an index still add nothing
+            permutation = np.concatenate(([0], rng.permutation(np.arange(1, base))))
+            digits = permutation[digits]
+
+        points += digits * scale
+        indices //= base
+        scale /= base
+
+    return points
+
+
+def _unit_disk_halton_at(indices, seed=None):
+    """Halton layout of the rays with the given indices, see unit_disk_halton"""
+    # Each base has its own generator, so that the permutations of a digit position do
+    # not depend on how many digits the indices of the other base have
+    rng_u, rng_v = (
+        (None, None)
+        if seed is None
+        else (np.random.default_rng([seed, 2]), np.random.default_rng([seed, 3]))
     )
 
-    # The number of rays to add isn't always matching the remainder, so we
-    # collect them here with this line
-    final_sub = rays_to_add - remainder_rays
+    u = radical_inverse(indices, 2, rng_u)
+    v = radical_inverse(indices, 3, rng_v)
 
-    # Here we take them away so we get the number of rays we want
-    num_rays_to_each_ring[index_to_stop_adding_rays] -= final_sub
+    return _polar_from_unit_square(u, v)
 
-    # Then we add all of these rays to the correct ring
-    num_points_kth_ring[::-1][: index_to_stop_adding_rays + 1] += num_rays_to_each_ring[
-        : index_to_stop_adding_rays + 1
-    ]
 
-    # Add one point for the centre, and take one away from the end
-    num_points_kth_ring[0] = 1
-    num_points_kth_ring[-1] = num_points_kth_ring[-1] - 1
+@lru_cache(maxsize=32)
+def unit_disk_halton(num_rays, seed=None):
+    """Lays out rays on the unit disk with the 2D Halton sequence in bases 2 and 3.
+    Memoized for the most recently used ray counts and seeds.
 
-    # Make get the radii for the number of circles of rays we need
-    radii = np.linspace(0, 1, num_circles_int + 1)
+    Parameters
+    ----------
+    num_rays : int
+        Number of rays to lay out
+    seed : int, optional
+        Seed of the random digit permutations that scramble the sequence. By default the
+        sequence is not scrambled.
+
+    Returns
+    -------
+    radius : ndarray
+        Radius of each ray, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray
+    sin_t : ndarray
+        Sine of the angle of each ray
+    """
+    return _read_only(*_unit_disk_halton_at(np.arange(num_rays), seed))
+
+
+# Number of bits of each Sobol point
+SOBOL_BITS = 32
+
+
+def sobol_2d(indices, seed=None):
+    """First two dimensions of the Sobol sequence. The first dimension is the van der
+    Corput sequence in base 2 and the second uses the direction numbers of the primitive
+    polynomial x + 1. If a seed is given, the sequence is scrambled with a random digital
+    shift, which keeps its low discrepancy.
+
+    Parameters
+    ----------
+    indices : ndarray
+        Non-negative integer indices of the points in the sequence
+    seed : int, optional
+        Seed of the random digital shift. By default the sequence is not scrambled.
+
+    Returns
+    -------
+    u : ndarray
+        First coordinate of each point, in [0, 1)
+    v : ndarray
+        Second coordinate of each point, in [0, 1)
+    """
+    bits = np.arange(SOBOL_BITS, dtype=np.uint64)
+
+    # Direction numbers m_i of x + 1 follow m_i = 2 * m_(i-1) ^ m_(i-1), with m_1 = 1
+    m = np.ones(SOBOL_BITS, dtype=np.uint64)
+    for i in range(1, SOBOL_BITS):
+        m[i] = (m[i - 1] << np.uint64(1)) ^ m[i - 1]
+
+    directions_u = np.uint64(1) << (np.uint64(SOBOL_BITS - 1) - bits)
+    directions_v = m << (np.uint64(SOBOL_BITS - 1) - bits)
+
+    k = np.asarray(indices, dtype=np.uint64)
+    u = np.zeros(k.shape, dtype=np.uint64)
+    v = np.zeros(k.shape, dtype=np.uint64)
+
+    for bit in range(int(k.max(initial=0)).bit_length()):
+        # Add the direction number of every set bit of the index
+        set_bit = ((k >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        u[set_bit] ^= directions_u[bit]
+        v[set_bit] ^= directions_v[bit]
+
+    if seed is not None:
+        shift_u, shift_v = np.random.default_rng(seed).integers(
+            0, 2**SOBOL_BITS, size=2, dtype=np.uint64
+        )
+        u ^= shift_u
+        v ^= shift_v
+
+    return u / 2**SOBOL_BITS, v / 2**SOBOL_BITS
+
+
+@lru_cache(maxsize=32)
+def unit_disk_sobol(num_rays, seed=None):
+    """Lays out rays on the unit disk with the 2D Sobol sequence. Memoized for the most
+    recently used ray counts and seeds.
+
+    Parameters
+    ----------
+    num_rays : int
+        Number of rays to lay out
+    seed : int, optional
+        Seed of the random digital shift that scrambles the sequence. By default the
+        sequence is not scrambled.
+
+    Returns
+    -------
+    radius : ndarray
+        Radius of each ray, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray
+    sin_t : ndarray
+        Sine of the angle of each ray
+    """
+    return _read_only(*_polar_from_unit_square(*sobol_2d(np.arange(num_rays), seed)))
+
+
+def unit_disk_samples(num_rays, sampler="rings", seed=None):
+    """Lays out rays on the unit disk with one of the samplers in DISK_SAMPLERS:
+        - 'rings' places the rays on concentric rings, with one ray at the centre.
+        - 'fibonacci' places the rays along a sunflower spiral.
+        - 'sobol' and 'halton' place the rays with low discrepancy sequences, which are
+        scrambled if a seed is given.
+
+    Parameters
+    ----------
+    num_rays : int
+        Number of rays to lay out
+    sampler : str, optional
+        Name of the sampler, by default 'rings'
+    seed : int, optional
+        Seed used to scramble the 'sobol' and 'halton' samplers, by default None
+
+    Returns
+    -------
+    radius : ndarray
+        Radius of each ray, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray
+    sin_t : ndarray
+        Sine of the angle of each ray
+    num_points_kth_ring: ndarray or None
+        Array of the number of points on each ring for the 'rings' sampler, else None
+    """
+    if sampler == "rings":
+        return unit_disk_rings(num_rays)
+    elif sampler == "fibonacci":
+        return unit_disk_fibonacci(num_rays) + (None,)
+    elif sampler == "sobol":
+        return unit_disk_sobol(num_rays, seed) + (None,)
+    elif sampler == "halton":
+        return unit_disk_halton(num_rays, seed) + (None,)
+
+    raise ValueError(f"Unknown sampler {sampler!r}, expected one of {DISK_SAMPLERS}")
+
+
+def unit_disk_chunk(num_rays, start, stop, sampler="rings", seed=None):
+    """Lays out only the rays from start to stop of a layout of num_rays rays on the unit
+    disk, see unit_disk_samples. The whole layout is never built, so a very large number
+    of rays can be generated chunk by chunk. The layout is not memoized.
+
+    Parameters
+    ----------
+    num_rays : int
+        Number of rays in the whole layout
+    start : int
+        Index of the first ray of the chunk
+    stop : int
+        Index after the last ray of the chunk
+    sampler : str, optional
+        Name of the sampler, by default 'rings'
+    seed : int, optional
+        Seed used to scramble the 'sobol' and 'halton' samplers, by default None
+
+    Returns
+    -------
+    radius : ndarray
+        Radius of each ray of the chunk, between 0 and 1
+    cos_t : ndarray
+        Cosine of the angle of each ray of the chunk
+    sin_t : ndarray
+        Sine of the angle of each ray of the chunk
+    """
+    indices = np.arange(start, stop)
+
+    if sampler == "rings":
+        return _unit_disk_rings_at(num_rays, indices)
+    elif sampler == "fibonacci":
+        return _unit_disk_fibonacci_at(num_rays, indices)
+    elif sampler == "sobol":
+        return _polar_from_unit_square(*sobol_2d(indices, seed))
+    elif sampler == "halton":
+        return _unit_disk_halton_at(indices, seed)
+
+    raise ValueError(f"Unknown sampler {sampler!r}, expected one of {DISK_SAMPLERS}")
+
+
+def circular_beam(r, outer_radius, sampler="rings", seed=None):
+    """Generates a circular paralell initial beam
+
+    Parameters
+    ----------
+    r : ndarray
+        Ray position and slope matrix
+    outer_radius : float
+        Outer radius of the circular beam
+    sampler : str, optional
+        How the rays are spread over the beam, see unit_disk_samples, by default 'rings'
+    seed : int, optional
+        Seed used to scramble the 'sobol' and 'halton' samplers, by default None
+
+    Returns
+    -------
+    r : ndarray
+        Updated ray position & slope matrix which create a circular beam
+    num_points_kth_ring: ndarray or None
+        Array of the number of points on each ring of our circular beam, or None if the
+        rays are not laid out on rings
+    """
+    radius, cos_t, sin_t, num_points_kth_ring = unit_disk_samples(
+        r.shape[2], sampler, seed
+    )
 
     # fill in the x and y coordinates to our ray array
-    idx = 0
-    for i in range(len(radii)):
-        for j in range(num_points_kth_ring[i]):
-            radius = radii[i]
-            t = j * (2 * np.pi / num_points_kth_ring[i])
-            r[0, 1, idx] = np.tan(gun_beam_semi_angle * radius) * np.cos(t)
-            r[0, 3, idx] = np.tan(gun_beam_semi_angle * radius) * np.sin(t)
-            idx += 1
+    radius = outer_radius * radius
+    r[0, 0, :] = radius * cos_t
+    r[0, 2, :] = radius * sin_t
+
+    if num_points_kth_ring is not None:
+        num_points_kth_ring = num_points_kth_ring.copy()
+
+    return r, num_points_kth_ring
+
+
+def point_beam(r, gun_beam_semi_angle, sampler="rings", seed=None):
+    """Generates a point initial beam that spreads out with semi angle 'gun_beam_semi_angle'
+
+    Parameters
+    ----------
+    r : ndarray
+        Ray position and slope matrix
+    gun_beam_semi_angle : float
+        Beam semi angle in radians
+    sampler : str, optional
+        How the rays are spread over the cone, see unit_disk_samples, by default 'rings'
+    seed : int, optional
+        Seed used to scramble the 'sobol' and 'halton' samplers, by default None
+
+    Returns
+    -------
+    r : ndarray
+        Updated ray position & slope matrix which create a circular beam
+    num_points_kth_ring: ndarray or None
+        Array of the number of points on each ring of our circular beam, or None if the
+        rays are not laid out on rings
+    """
+    radius, cos_t, sin_t, num_points_kth_ring = unit_disk_samples(
+        r.shape[2], sampler, seed
+    )
+
+    # fill in the x and y slopes to our ray array
+    slope = np.tan(gun_beam_semi_angle * radius)
+    r[0, 1, :] = slope * cos_t
+    r[0, 3, :] = slope * sin_t
+
+    if num_points_kth_ring is not None:
+        num_points_kth_ring = num_points_kth_ring.copy()
 
     return r, num_points_kth_ring
 
@@ -245,12 +557,9 @@ def axial_point_beam(r, gun_beam_semi_angle):
         -gun_beam_semi_angle, gun_beam_semi_angle, y_rays, endpoint=True
     )
 
-    for idx, angle in enumerate(x_angles):
-        r[0, 1, idx] = np.tan(angle)
-
-    for idx, angle in enumerate(y_angles):
-        i = idx + y_rays
-        r[0, 3, i] = np.tan(angle)
+    # The first half of the rays spread out along x, and the rest along y
+    r[0, 1, :x_rays] = np.tan(x_angles)
+    r[0, 3, x_rays:] = np.tan(y_angles)
 
     return r
 
@@ -273,17 +582,74 @@ def x_axial_point_beam(r, gun_beam_semi_angle):
     """
     num_rays = r.shape[2]
 
-    x_rays = int(round(num_rays))
     x_angles = np.linspace(
-        -gun_beam_semi_angle, gun_beam_semi_angle, x_rays, endpoint=True
+        -gun_beam_semi_angle, gun_beam_semi_angle, num_rays, endpoint=True
     )
 
-    for idx, angle in enumerate(x_angles):
-        r[0, 1, idx] = np.tan(angle)
+    r[0, 1, :] = np.tan(x_angles)
 
     return r
 
 
+def transfer_rays(matrix, rays, out=None):
+    """Apply a transfer matrix, or a stack of them, to rays. Compact rays of shape
+    (..., 4, num_rays) are multiplied by the 4x4 linear part of the matrix and then
+    shifted by its offset column, in the precision of the rays.
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Transfer matrix of shape (..., 5, 5)
+    rays : ndarray
+        Ray positions and slopes of shape (..., 5, num_rays) or (..., 4, num_rays)
+    out : ndarray, optional
+        Array to write the transferred rays to, which may be rays itself
+
+    Returns
+    -------
+    rays : ndarray
+        Transferred ray positions and slopes
+    """
+    xp = array_namespace(rays)
+    if xp is not np:
+        return _transfer_rays_array_api(xp, matrix, rays, out)
+
+    if rays.shape[-2] == 5:
+        return np.matmul(matrix, rays, out=out)
+
+    matrix = np.asarray(matrix)
+    offset = matrix[..., :4, 4:]
+
+    rays = np.matmul(matrix[..., :4, :4].astype(rays.dtype), rays, out=out)
+
+    # Propagation matrices and lenses have no offset, so skip adding it
+    if np.any(offset):
+        rays += offset.astype(rays.dtype)
+
+    return rays
+
+
+def _transfer_rays_array_api(xp, matrix, rays, out=None):
+    """transfer_rays for rays of another array API namespace, which returns a new array
+    unless out is given, as there is no out argument to matmul in the standard"""
+    matrix = np.asarray(matrix)
+
+    if rays.shape[-2] == 5:
+        transferred = xp.matmul(xp.asarray(matrix, dtype=rays.dtype), rays)
+    else:
+        transferred = xp.matmul(xp.asarray(matrix[..., :4, :4], dtype=rays.dtype), rays)
+
+        offset = matrix[..., :4, 4:]
+        if np.any(offset):
+            transferred = transferred + xp.asarray(offset, dtype=rays.dtype)
+
+    if out is None:
+        return transferred
+
+    out[...] = transferred
+    return out
+
+
 def _flip_y():
     # From libertem.corrections.coordinates v0.11.1
     return np.array([(-1, 0), (0, 1)])
@@ -317,7 +683,13 @@ def get_pixel_coords(rays_x, rays_y, size, pixels, flip_y=False, scan_rotation=0
     # Transformations are applied right to left
     transform = _rotate_deg(scan_rotation) @ transform
 
-    y_transformed, x_transformed = (np.array((rays_y, rays_x)).T @ transform).T
+    # Apply the transform to the (y, x) row vector of every ray, with operators only, so that
+    # rays of any array namespace can be transformed
+    if array_namespace(rays_x, rays_y) is np:
+        rays_x, rays_y = np.asarray(rays_x), np.asarray(rays_y)
+    (t00, t01), (t10, t11) = transform.tolist()
+    y_transformed = rays_y * t00 + rays_x * t10
+    x_transformed = rays_y * t01 + rays_x * t11
 
     pixel_coords_x = x_transformed / size * pixels + pixels / 2 - 1
     pixel_coords_y = y_transformed / size * pixels + pixels / 2 - 1
@@ -325,6 +697,339 @@ def get_pixel_coords(rays_x, rays_y, size, pixels, flip_y=False, scan_rotation=0
     return (pixel_coords_x, pixel_coords_y)
 
 
+BINNING_METHODS = ("nearest", "bilinear")
+
+
+def bin_pixel_coords(
+    pixel_coords_x, pixel_coords_y, pixels, weights=None, method="nearest", out=None, dtype=None
+):
+    """Bin rays into square images by counting, or summing the weights of, the rays that land
+    on each pixel. Rays that land on the same pixel all add to it, and the images are summed
+    into out when it is given, so one image can be built up over many calls.
+
+    Parameters
+    ----------
+    pixel_coords_x : ndarray
+        X pixel coordinate of the rays, of shape (..., num_rays), see get_pixel_coords. Any
+        leading axes give a stack of images, binned together in one pass
+    pixel_coords_y : ndarray
+        Y pixel coordinate of the rays, of the same shape as pixel_coords_x
+    pixels : int
+        Pixel resolution of the images
+    weights : ndarray, optional
+        Weight of each ray, broadcastable to the shape of pixel_coords_x, which may be
+        complex. By default every ray counts once
+    method : str, optional
+        "nearest" to add each ray to the pixel nearest to it, or "bilinear" to share it
+        between the four pixels around it in proportion to its distance from each, by
+        default "nearest"
+    out : ndarray, optional
+        Images of shape (..., pixels, pixels) to add the rays to in place. The rays are added
+        in the dtype of out, e.g. counts to uint8 images, which wrap around if a pixel
+        overflows, or weights to integer images, which are rounded towards zero. Complex
+        weights need complex images
+    dtype : data-type, optional
+        Data type of the images when out is not given, by default int64 for counts of rays
+        binned to the nearest pixel, and float64 (or complex128) otherwise
+
+    Returns
+    -------
+    out : ndarray
+        Binned images of shape (..., pixels, pixels)
+    """
+    if method not in BINNING_METHODS:
+        raise ValueError(f"Unknown binning method {method!r}, use one of {BINNING_METHODS}")
+
+    xp = array_namespace(pixel_coords_x, pixel_coords_y)
+    if xp is not np:
+        return _bin_pixel_coords_array_api(
+            xp, pixel_coords_x, pixel_coords_y, pixels, weights, method, out, dtype
+        )
+
+    pixel_coords_x = np.asarray(pixel_coords_x)
+    batch_shape = pixel_coords_x.shape[:-1]
+    num_images = int(np.prod(batch_shape))
+
+    pixel_coords_x = pixel_coords_x.reshape(num_images, -1)
+    pixel_coords_y = np.asarray(pixel_coords_y).reshape(num_images, -1)
+    if weights is not None:
+        weights = np.broadcast_to(
+            weights, batch_shape + pixel_coords_x.shape[-1:]
+        ).reshape(num_images, -1)
+
+    if out is None:
+        if dtype is None:
+            if weights is not None and np.iscomplexobj(weights):
+                dtype = np.complex128
+            elif weights is None and method == "nearest":
+                dtype = np.int64
+            else:
+                dtype = np.float64
+        out = np.zeros(batch_shape + (pixels, pixels), dtype=dtype)
+
+    # Make a list of the pixel that every ray adds to, and with what weight
+    if method == "nearest":
+        corners = [(np.round(pixel_coords_x), np.round(pixel_coords_y), weights)]
+    else:
+        x0 = np.floor(pixel_coords_x)
+        y0 = np.floor(pixel_coords_y)
+        fx = pixel_coords_x - x0
+        fy = pixel_coords_y - y0
+
+        corners = [
+            (x0, y0, (1 - fx) * (1 - fy)),
+            (x0 + 1, y0, fx * (1 - fy)),
+            (x0, y0 + 1, (1 - fx) * fy),
+            (x0 + 1, y0 + 1, fx * fy),
+        ]
+        if weights is not None:
+            corners = [(x, y, corner_weights * weights) for x, y, corner_weights in corners]
+
+    # Give every pixel of every image a unique index into the flattened stack of images, so
+    # that a single bincount sums all of the rays that land on it
+    image_offsets = np.arange(num_images, dtype=np.int64)[:, None] * pixels * pixels
+    image_offsets = np.broadcast_to(image_offsets, pixel_coords_x.shape)
+    size = num_images * pixels * pixels
+
+    binned = 0
+    for x, y, corner_weights in corners:
+        # Rays that are not finite, e.g. the blocked rays of a compacted trace, compare False
+        rays_inside = (x > 0) & (x < pixels) & (y > 0) & (y < pixels)
+
+        flat_idcs = (
+            image_offsets[rays_inside]
+            + y[rays_inside].astype(np.int64) * pixels
+            + x[rays_inside].astype(np.int64)
+        )
+
+        if corner_weights is None:
+            binned = binned + np.bincount(flat_idcs, minlength=size)
+        elif np.iscomplexobj(corner_weights):
+            corner_weights = corner_weights[rays_inside]
+            binned = binned + (
+                np.bincount(flat_idcs, weights=corner_weights.real, minlength=size)
+                + 1j * np.bincount(flat_idcs, weights=corner_weights.imag, minlength=size)
+            )
+        else:
+            binned = binned + np.bincount(
+                flat_idcs, weights=corner_weights[rays_inside], minlength=size
+            )
+
+    binned = binned.reshape(out.shape)
+    if np.iscomplexobj(binned) and not np.iscomplexobj(out):
+        raise TypeError(f"Complex weights cannot be added to images of dtype {out.dtype}")
+
+    np.add(out, binned, out=out, casting="unsafe")
+
+    return out
+
+
+def _bin_pixel_coords_array_api(
+    xp, pixel_coords_x, pixel_coords_y, pixels, weights, method, out, dtype
+):
+    """bin_pixel_coords for pixel coordinates of another array API namespace. The standard
+    has no bincount, so the flat pixel index of every ray is sorted, the rays of each pixel
+    are counted between the edges found with searchsorted, and their weights are summed as
+    differences of a cumulative sum. Rays outside of the images are sent to one extra pixel
+    which is dropped, so that no shape depends on where the rays land."""
+    batch_shape = tuple(pixel_coords_x.shape[:-1])
+    num_images = math.prod(batch_shape)
+    num_rays = pixel_coords_x.shape[-1]
+
+    pixel_coords_x = xp.reshape(pixel_coords_x, (num_images, num_rays))
+    pixel_coords_y = xp.reshape(pixel_coords_y, (num_images, num_rays))
+    if weights is not None:
+        weights = xp.reshape(
+            xp.broadcast_to(xp.asarray(weights), batch_shape + (num_rays,)),
+            (num_images, num_rays),
+        )
+
+    if dtype is None:
+        if weights is not None and xp.isdtype(weights.dtype, "complex floating"):
+            dtype = xp.complex128
+        elif weights is None and method == "nearest":
+            dtype = xp.int64
+        else:
+            dtype = xp.float64
+
+    if method == "nearest":
+        corners = [(xp.round(pixel_coords_x), xp.round(pixel_coords_y), weights)]
+    else:
+        x0 = xp.floor(pixel_coords_x)
+        y0 = xp.floor(pixel_coords_y)
+        fx = pixel_coords_x - x0
+        fy = pixel_coords_y - y0
+
+        corners = [
+            (x0, y0, (1 - fx) * (1 - fy)),
+            (x0 + 1, y0, fx * (1 - fy)),
+            (x0, y0 + 1, (1 - fx) * fy),
+            (x0 + 1, y0 + 1, fx * fy),
+        ]
+        if weights is not None:
+            corners = [(x, y, corner_weights * weights) for x, y, corner_weights in corners]
+
+    image_offsets = xp.reshape(
+        xp.arange(num_images, dtype=xp.int64) * (pixels * pixels), (num_images, 1)
+    )
+    size = num_images * pixels * pixels
+
+    flat_idcs = []
+    flat_weights = []
+    for x, y, corner_weights in corners:
+        rays_inside = (x > 0) & (x < pixels) & (y > 0) & (y < pixels)
+
+        idcs = (
+            image_offsets
+            + xp.astype(xp.where(rays_inside, y, xp.zeros_like(y)), xp.int64) * pixels
+            + xp.astype(xp.where(rays_inside, x, xp.zeros_like(x)), xp.int64)
+        )
+        flat_idcs.append(xp.reshape(xp.where(rays_inside, idcs, xp.full_like(idcs, size)), (-1,)))
+
+        if corner_weights is not None:
+            corner_weights = xp.where(rays_inside, corner_weights, xp.zeros_like(corner_weights))
+            flat_weights.append(xp.reshape(corner_weights, (-1,)))
+
+    flat_idcs = xp.concat(flat_idcs)
+    order = xp.argsort(flat_idcs)
+    sorted_idcs = xp.take(flat_idcs, order)
+
+    # The rays of pixel k lie between edges k and k + 1 of the sorted indices
+    edges = xp.searchsorted(sorted_idcs, xp.arange(size + 1, dtype=sorted_idcs.dtype))
+    if not flat_weights:
+        binned = edges[1:] - edges[:-1]
+    else:
+        # Sum in double precision, as bincount does, however precise the rays are
+        flat_weights = xp.concat(flat_weights)
+        if xp.isdtype(flat_weights.dtype, "complex floating"):
+            flat_weights = xp.astype(flat_weights, xp.complex128)
+        else:
+            flat_weights = xp.astype(flat_weights, xp.float64)
+        sorted_weights = xp.take(flat_weights, order)
+        cumulative = xp.cumulative_sum(sorted_weights, include_initial=True)
+        binned = xp.take(cumulative, edges[1:]) - xp.take(cumulative, edges[:-1])
+
+    binned = xp.reshape(xp.astype(binned, dtype), batch_shape + (pixels, pixels))
+
+    if out is None:
+        return binned
+
+    if xp.isdtype(binned.dtype, "complex floating") and not xp.isdtype(
+        out.dtype, "complex floating"
+    ):
+        raise TypeError(f"Complex weights cannot be added to images of dtype {out.dtype}")
+
+    out[...] = out + xp.astype(binned, out.dtype)
+    return out
+
+
+def get_mean_image(pixel_coords_x, pixel_coords_y, pixels, values, method="nearest", out=None):
+    """Bin rays into square images of the mean of a value carried by each ray, such as the
+    intensity of the sample where the ray passed through it. Pixels that no ray lands on
+    are 0.
+
+    Parameters
+    ----------
+    pixel_coords_x : ndarray
+        X pixel coordinate of the rays, of shape (..., num_rays)
+    pixel_coords_y : ndarray
+        Y pixel coordinate of the rays, of the same shape as pixel_coords_x
+    pixels : int
+        Pixel resolution of the images
+    values : ndarray
+        Value carried by each ray, of the same shape as pixel_coords_x
+    method : str, optional
+        "nearest" or "bilinear", see bin_pixel_coords, by default "nearest"
+    out : ndarray, optional
+        Images of shape (..., pixels, pixels) to write the mean images into
+
+    Returns
+    -------
+    out : ndarray
+        Mean images of shape (..., pixels, pixels)
+    """
+    sums = bin_pixel_coords(pixel_coords_x, pixel_coords_y, pixels, values, method)
+    counts = bin_pixel_coords(
+        pixel_coords_x, pixel_coords_y, pixels, method=method, dtype=np.float64
+    )
+
+    if out is None:
+        out = np.zeros_like(sums)
+    else:
+        out[...] = 0
+
+    np.divide(sums, counts, out=sums, where=counts > 0)
+    np.copyto(out, sums, where=counts > 0, casting="unsafe")
+
+    return out
+
+
+def bin_rays(
+    rays_x,
+    rays_y,
+    size,
+    pixels,
+    weights=None,
+    method="nearest",
+    out=None,
+    dtype=None,
+    flip_y=False,
+    scan_rotation=0.0,
+):
+    """Bin the positions of rays on a square detector or sample into images, see
+    bin_pixel_coords.
+
+    Parameters
+    ----------
+    rays_x : ndarray
+        X position of the rays, of shape (..., num_rays)
+    rays_y : ndarray
+        Y position of the rays, of the same shape as rays_x
+    size : float
+        Real edge length of the square detector or sample
+    pixels : int
+        Pixel resolution of the images
+    weights : ndarray, optional
+        Weight of each ray, by default every ray counts once
+    method : str, optional
+        "nearest" or "bilinear", by default "nearest"
+    out : ndarray, optional
+        Images of shape (..., pixels, pixels) to add the rays to in place. The rays are added
+        in the dtype of out, e.g. counts to uint8 images, which wrap around if a pixel
+        overflows, or weights to integer images, which are rounded towards zero. Complex
+        weights need complex images
+    dtype : data-type, optional
+        Data type of the images when out is not given
+    flip_y : bool, optional
+        Flip the y axis, by default False
+    scan_rotation : float, optional
+        Rotation of the images in degrees, by default 0.0
+
+    Returns
+    -------
+    out : ndarray
+        Binned images of shape (..., pixels, pixels)
+    """
+    pixel_coords_x, pixel_coords_y = get_pixel_coords(
+        rays_x=rays_x,
+        rays_y=rays_y,
+        size=size,
+        pixels=pixels,
+        flip_y=flip_y,
+        scan_rotation=scan_rotation,
+    )
+
+    return bin_pixel_coords(
+        pixel_coords_x,
+        pixel_coords_y,
+        pixels,
+        weights=weights,
+        method=method,
+        out=out,
+        dtype=dtype,
+    )
+
+
 def get_image_from_rays(
     rays_x,
     rays_y,
@@ -364,17 +1069,17 @@ def get_image_from_rays(
     Returns
     -------
     detector_ray_image : ndarray
-        Ray image of where rays have hit the detector
+        Number of rays which missed the sample that hit each pixel of the detector, as int64
+        counts, so that every ray is counted however many land on a pixel
     detector_sample_image : ndarray
-        Sample image obtained by transferring ray which have hit the detector
+        Sample image obtained by transferring ray which have hit the detector, in float64.
+        Each pixel has the mean intensity of all of the rays that hit it, rather than the
+        intensity of any one of them
     sample_pixel_coords : ndarray
         Coordinates of where each ray has hit the sample
     detector_pixel_coords : ndarray
         Coordinates of where each ray has hit the detector
     """
-    detector_ray_image = np.zeros((detector_pixels, detector_pixels), dtype=np.uint8)
-    detector_sample_image = np.zeros((detector_pixels, detector_pixels))
-
     # Convert rays from sample positions to pixel positions
     sample_pixel_coords_x, sample_pixel_coords_y = np.round(
         get_pixel_coords(
@@ -389,48 +1094,48 @@ def get_image_from_rays(
     sample_pixel_coords = np.vstack([sample_pixel_coords_x, sample_pixel_coords_y]).T
 
     # Convert rays from detector positions to pixel positions
-    detector_pixel_coords_x, detector_pixel_coords_y = np.round(
-        get_pixel_coords(
-            rays_x=rays_x,
-            rays_y=rays_y,
-            size=detector_size,
-            pixels=detector_pixels,
-            flip_y=flip_y,
-        )
-    ).astype(np.int32)
+    detector_pixel_coords_x, detector_pixel_coords_y = get_pixel_coords(
+        rays_x=rays_x,
+        rays_y=rays_y,
+        size=detector_size,
+        pixels=detector_pixels,
+        flip_y=flip_y,
+    )
 
     detector_pixel_coords = np.vstack(
-        [detector_pixel_coords_x, detector_pixel_coords_y]
+        [
+            np.round(detector_pixel_coords_x).astype(np.int32),
+            np.round(detector_pixel_coords_y).astype(np.int32),
+        ]
     ).T
     sample_rays_inside = np.all(
         (sample_pixel_coords > 0) & (sample_pixel_coords < sample_pixels), axis=1
     ).T
-    detector_rays_inside = np.all(
-        (detector_pixel_coords > 0) & (detector_pixel_coords < detector_pixels), axis=1
-    ).T
-    rays_that_hit_sample_and_detector = sample_rays_inside & detector_rays_inside
-    rays_that_hit_detector_but_not_sample = ~sample_rays_inside & detector_rays_inside
-
-    sample_pixel_intensities = sample_image[
-        sample_pixel_coords[rays_that_hit_sample_and_detector, 1],
-        sample_pixel_coords[rays_that_hit_sample_and_detector, 0],
-    ]
 
     # Return this image for the case when we want to just plot the beam on the detector
-    detector_ray_image[
-        detector_pixel_coords[rays_that_hit_detector_but_not_sample, 1],
-        detector_pixel_coords[rays_that_hit_detector_but_not_sample, 0],
-    ] += 1
-
-    # Obtain sample image intensitions
-    detector_sample_image[
-        detector_pixel_coords[rays_that_hit_sample_and_detector, 1],
-        detector_pixel_coords[rays_that_hit_sample_and_detector, 0],
-    ] = sample_pixel_intensities
-    detector_sample_image[
-        detector_pixel_coords[rays_that_hit_detector_but_not_sample, 1],
-        detector_pixel_coords[rays_that_hit_detector_but_not_sample, 0],
-    ] = 0
+    detector_ray_image = bin_pixel_coords(
+        detector_pixel_coords_x[~sample_rays_inside],
+        detector_pixel_coords_y[~sample_rays_inside],
+        detector_pixels,
+    )
+
+    # Obtain sample image intensities. Every pixel of the detector shows the mean intensity
+    # of the rays that land on it, where rays that miss the sample carry no intensity
+    sample_pixel_intensities = np.where(
+        sample_rays_inside,
+        sample_image[
+            np.where(sample_rays_inside, sample_pixel_coords_y, 0),
+            np.where(sample_rays_inside, sample_pixel_coords_x, 0),
+        ],
+        0,
+    )
+    detector_sample_image = get_mean_image(
+        detector_pixel_coords_x,
+        detector_pixel_coords_y,
+        detector_pixels,
+        sample_pixel_intensities,
+        out=np.zeros((detector_pixels, detector_pixels)),
+    )
 
     return (
         detector_ray_image,
@@ -440,65 +1145,256 @@ def get_image_from_rays(
     )
 
 
-def convert_rays_to_line_vertices(model):
+def get_sample_images_from_rays(
+    rays_x,
+    rays_y,
+    sample_rays_x,
+    sample_rays_y,
+    detector_size,
+    detector_pixels,
+    sample_size,
+    sample_pixels,
+    sample_image,
+    flip_y=True,
+    out=None,
+):
+    """Form the detector image of the sample for a whole stack of ray sets at once, e.g. one
+    per scan position of a 4DSTEM scan. Each image is the same as the detector_sample_image
+    returned by get_image_from_rays for that set of rays, binned in a single pass.
+
+    Parameters
+    ----------
+    rays_x : ndarray
+        X position of rays that hit the detector, of shape (P, num_rays)
+    rays_y : ndarray
+        Y position of rays that hit the detector, of shape (P, num_rays)
+    sample_rays_x : ndarray
+        X position of rays that hit the sample, of shape (P, num_rays)
+    sample_rays_y : ndarray
+        Y position of rays that hit the sample, of shape (P, num_rays)
+    detector_size : float
+        Real size of the detector in the model
+    detector_pixels : int
+        Pixel resolution of the detector
+    sample_size : float
+        Real size of the sample in the model
+    sample_pixels : int
+        Pixel resolution of the the sample
+    sample_image : ndarray
+        image intensities of the sample. Used to form an image on the detector
+    flip_y : bool, optional
+        Flip the y axis of the sample and detector, by default True
+    out : ndarray, optional
+        Array of shape (P, detector_pixels, detector_pixels) to write the images into
+
+    Returns
+    -------
+    detector_sample_images : ndarray
+        Sample images obtained by transferring rays which have hit the detector, of shape
+        (P, detector_pixels, detector_pixels)
+    """
+    num_images = rays_x.shape[0]
+
+    if out is None:
+        out = np.zeros((num_images, detector_pixels, detector_pixels))
+
+    # Convert rays from sample and detector positions to pixel positions
+    sample_pixel_coords_x, sample_pixel_coords_y = np.round(
+        get_pixel_coords(
+            rays_x=sample_rays_x,
+            rays_y=sample_rays_y,
+            size=sample_size,
+            pixels=sample_pixels,
+            flip_y=flip_y,
+        )
+    ).astype(np.int32)
+
+    detector_pixel_coords_x, detector_pixel_coords_y = get_pixel_coords(
+        rays_x=rays_x,
+        rays_y=rays_y,
+        size=detector_size,
+        pixels=detector_pixels,
+        flip_y=flip_y,
+    )
+
+    sample_rays_inside = (
+        (sample_pixel_coords_x > 0)
+        & (sample_pixel_coords_x < sample_pixels)
+        & (sample_pixel_coords_y > 0)
+        & (sample_pixel_coords_y < sample_pixels)
+    )
+
+    # Every pixel shows the mean intensity of the rays that land on it, where rays that miss
+    # the sample carry no intensity
+    sample_pixel_intensities = np.where(
+        sample_rays_inside,
+        sample_image[
+            np.where(sample_rays_inside, sample_pixel_coords_y, 0),
+            np.where(sample_rays_inside, sample_pixel_coords_x, 0),
+        ],
+        0,
+    )
+
+    return get_mean_image(
+        detector_pixel_coords_x,
+        detector_pixel_coords_y,
+        detector_pixels,
+        sample_pixel_intensities,
+        out=out,
+    )
+
+
+def get_datacube_metadata_path(path):
+    """Path of the JSON sidecar file which stores the geometry of a datacube file
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npy datacube file
+
+    Returns
+    -------
+    str
+        Path of the sidecar file
+    """
+    return os.path.splitext(path)[0] + ".json"
+
+
+def save_datacube_metadata(path, metadata):
+    """Write the geometry of a datacube file to its JSON sidecar file
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npy datacube file
+    metadata : dict
+        Scan and detector geometry of the datacube
+    """
+    with open(get_datacube_metadata_path(path), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def open_datacube(path, mode="r"):
+    """Open a datacube file written by Model.write_4dstem_scan without loading it. The
+    datacube is memory mapped, so slicing it only reads the frames that are used.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npy datacube file
+    mode : str, optional
+        Memory map mode, "r" for read only or "r+" to modify the file in place, by
+        default "r"
+
+    Returns
+    -------
+    datacube : np.memmap
+        Memory map of the datacube
+    metadata : dict
+        Scan and detector geometry of the datacube, or an empty dict if the file has no
+        sidecar file
+    """
+    datacube = np.load(path, mmap_mode=mode)
+
+    metadata_path = get_datacube_metadata_path(path)
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    else:
+        metadata = {}
+
+    return datacube, metadata
+
+
+def empty_line_vertices(model, dtype=np.float32):
+    """Allocate a buffer for the line vertices of a model, which can be passed to
+    convert_rays_to_line_vertices as out for every frame of an interactive view
+
+    Parameters
+    ----------
+    model : class
+        Microscope model
+    dtype : data-type, optional
+        Data type of the vertices, by default float32
+
+    Returns
+    -------
+    out : ndarray
+        Uninitialised array of shape [(steps*2-2)*num rays, 3]
+    """
+    num_vertices = len(model.z_positions) * 2 - 2
+
+    return np.empty((num_vertices * model.num_rays, 3), dtype=dtype)
+
+
+def convert_rays_to_line_vertices(model, out=None):
     """Converts a ray position matrix of size [(steps, 5, num rays)] -
     (where steps is defined by the number of components + 2 - the two being
     included to add the gun and detector, which are not components chosen by the user)'
     to a line matrix of shape [(steps)*2-2)*num rays, 3], which is of the correct shape
     to be readily plot ray positions in the column as lines.
 
+    Rays stopped by a component are drawn up to the plane of that component, and every
+    vertex below it is placed on that plane, so the rest of the ray is not visible.
+
     Parameters
     ----------
     model : class
         Microscope model that stores all associated ray position data
-    gun_beam_semi_angle : float
-        Beam semi angle in radians
+    out : ndarray, optional
+        Array of shape [(steps*2-2)*num rays, 3] to write the vertices into, e.g. a float32
+        buffer from empty_line_vertices, so that no vertex array is allocated per frame
 
     Returns
     -------
-    r : ndarray
-        Updated ray position & slope matrix which create a circular beam
+    lines_paired : ndarray
+        Start and end vertex of the line of every ray between every pair of planes
+    allowed_rays : list
+        Indices of the rays which have not been stopped by any component
     """
-    ray_z = np.tile(model.z_positions, [model.num_rays, 1, 1]).T
-
-    # Stack with the z coordinates
-    ray_xyz = np.hstack((model.r[:, [0, 2], :], ray_z))
-
-    # Repeat vertices so we can create lines. The shape of this array is [Num Steps*2, 3, Num Rays]
-    lines_repeated = np.repeat(ray_xyz[:, :, :], repeats=2, axis=0)[1:-1]
-
-    # Index the total number of rays in the model initially which are by default
-    # allowed through all components
-    allowed_rays = range(model.num_rays)
-
-    for component in model.components:
-        if len(component.blocked_ray_idcs) != 0:
-            # Find the difference between blocked rays and original amount of allowed rays
-            allowed_rays = list(
-                set(allowed_rays).difference(set(component.blocked_ray_idcs))
-            )
-            # Convert from ray position indexing, to line indexing
-            idx = component.index * 2 + 2
-            # Get the coordinates of all rays which hit the aperture.
-            pts_blocked = lines_repeated[idx, :, component.blocked_ray_idcs]
-            # Do really funky array manipulation to create a copy of all of
-            # these points that is the same shape as the vertices of remaining
-            # lines after the aperture (I'm sorry to myself and anyone in the
-            # future who has to read this)
-            lines_aperture = np.broadcast_to(
-                pts_blocked[..., None],
-                pts_blocked.shape + (lines_repeated.shape[0] - (idx),),
-            ).transpose(2, 1, 0)
-
-            # Copy the coordinate of all rays that hit the aperture, to all line
-            # vertices after this, so we don't visualise them.
-            lines_repeated[idx:, :, component.blocked_ray_idcs] = lines_aperture
-
-    # Then restack each line so that we end up with a long list of lines, from
-    # [Num Steps*2, 3, Num Rays] > [(Num Steps*2-2)*Num rays, 3]
-    # see > https://stackoverflow.com/questions/38509196/efficiently-re-stacking-a-numpy-ndarray
-    lines_paired = lines_repeated.transpose(2, 0, 1).reshape(
-        lines_repeated.shape[0] * model.num_rays, 3
-    )
-
-    return lines_paired, allowed_rays
+    # Lines are drawn through every plane, so step the model with all planes recorded if it
+    # only records some of them
+    if isinstance(model.record_planes, str) and model.record_planes == "all":
+        r = model.r
+    else:
+        r = model.step_all_planes()
+    r = to_numpy(r)
+
+    num_planes = len(model.z_positions)
+    num_vertices = num_planes * 2 - 2
+
+    if out is None:
+        out = np.empty((num_vertices * model.num_rays, 3))
+
+    # View the vertices as [Num Rays, Num Steps*2-2, 3], where the line between each pair of
+    # planes starts at the even vertex and ends at the odd vertex
+    vertices = out.reshape(model.num_rays, num_vertices, 3)
+    for coord, row in enumerate((0, 2)):
+        vertices[:, 0::2, coord] = r[:-1, row, :].T
+        vertices[:, 1::2, coord] = r[1:, row, :].T
+    vertices[:, 0::2, 2] = model.z_positions[:-1]
+    vertices[:, 1::2, 2] = model.z_positions[1:]
+
+    # The rays allowed through all components are those which no component has stopped
+    if model.ray_fates is None:
+        return out, list(range(model.num_rays))
+
+    ray_fates = to_numpy(model.ray_fates)
+    blocked_rays = np.flatnonzero(ray_fates >= 0)
+    allowed_rays = np.flatnonzero(ray_fates < 0).tolist()
+
+    if len(blocked_rays):
+        # Clamp the vertices of every blocked ray to the last plane of the component which
+        # stopped it, in one pass over all of them
+        component_planes = np.array([component.index + 1 for component in model.components])
+        blocking_planes = component_planes[ray_fates[blocked_rays]]
+
+        vertex_planes = (np.arange(num_vertices) + 1) // 2
+        clamped_planes = np.minimum(vertex_planes, blocking_planes[:, None])
+
+        rays = blocked_rays[:, None]
+        vertices[blocked_rays, :, 0] = r[clamped_planes, 0, rays]
+        vertices[blocked_rays, :, 1] = r[clamped_planes, 2, rays]
+        vertices[blocked_rays, :, 2] = np.asarray(model.z_positions)[clamped_planes]
+
+    return out, allowed_rays
@@ -1,11 +1,27 @@
+from contextlib import contextmanager
+
 import numpy as np
 
+from temgymlite.backend import get_namespace, to_numpy
 from temgymlite.functions import (
+    DISK_SAMPLERS,
     axial_point_beam,
+    bin_rays,
     circular_beam,
+    get_sample_images_from_rays,
+    make_test_sample,
+    open_datacube,
     point_beam,
+    save_datacube_metadata,
+    transfer_rays,
+    unit_disk_chunk,
     x_axial_point_beam,
 )
+from temgymlite.optimize import get_ray_jacobian, least_squares
+from temgymlite.parallel import run_4dstem_scan_parallel
+from temgymlite.paraxial import get_system_matrix, solve_paraxial
+from temgymlite.profiling import Profiler
+from temgymlite.streaming import StreamedTrace
 
 """This class create the model composed of the specified components, and handles all of the computation
 that transmits the rays through each component."""
@@ -30,6 +46,12 @@ class Model:
         detector_size=0.5,
         detector_pixels=128,
         experiment=None,
+        beam_sampler="rings",
+        beam_seed=0,
+        record_planes="all",
+        compact_rays=False,
+        compaction_threshold=None,
+        array_namespace=None,
     ):
         """
         Parameters
@@ -50,6 +72,8 @@ class Model:
                     - 'axial' creates a beam which is only visible on the x and y axis.
                     - 'x_axial' creates a beam which is only visible on the x-axis. This is only used
                     for matplotlib diagrams, by default 'point'
+                    - 'point' and 'paralell' can be followed by the name of a sampler, such as
+                    'point_fibonacci' or 'paralell_sobol', which then overrides beam_sampler.
         gun_beam_semi_angle : float, optional
             Set the semi angle of the beam in radians., by default np.pi/4
         beam_tilt_x : int, optional
@@ -69,6 +93,50 @@ class Model:
                 in the model.
                 - '4DSTEM' sets up the conditions for a basic 4DSTEM experiment with an overfocused beam
                 projecting an image of the sample at each scan position.
+        beam_sampler : str, optional
+            Choose how the rays of a 'point' or 'paralell' beam are spread over the cone of
+            angles or the disk of the beam:
+                    - 'rings' places the rays on concentric rings.
+                    - 'fibonacci' places the rays along a sunflower spiral.
+                    - 'sobol' and 'halton' place the rays with scrambled low discrepancy
+                    sequences. Integrated quantities such as the transmitted current or the
+                    detector image converge with far fewer rays than with 'rings'.
+            by default 'rings'
+        beam_seed : int or None, optional
+            Seed used to scramble the 'sobol' and 'halton' samplers, or None to use the
+            unscrambled sequences, by default 0
+        record_planes : str or list, optional
+            Choose the planes whose rays are kept in self.r by step():
+                    - 'all' keeps the rays at every plane, from the gun to the detector.
+                    - A list of planes keeps only those, in the order of the column. A plane
+                    can be 'gun', 'detector', the name of a component (both planes of a
+                    double deflector), or a z position. A single plane can also be given
+                    without a list.
+            Every other plane is only held in a small working buffer while the rays pass
+            through it, which saves memory for large numbers of rays, by default 'all'
+        compact_rays : bool, optional
+            Store the rays as float32 arrays of shape (planes, 4, num_rays), without the
+            constant fifth row of ones. Every transfer matrix is then applied as its 4x4
+            linear part plus its offset column, in float32. This uses 16 bytes per ray
+            and plane instead of 40. See compare_compact_rays() for the accuracy of the
+            compact rays against the float64 rays, by default False
+        compaction_threshold : float or None, optional
+            Rays stopped by an aperture or biprism are propagated with the others until
+            the fraction of rays still alive falls below this threshold, e.g. 0.5. They
+            are then dropped from the working arrays, and their positions at the recorded
+            planes below are set to NaN. None never drops them, by default None
+        array_namespace : module, str or None, optional
+            Array library to trace the rays with in step(), through its namespace of the
+            Python array API standard: a namespace module such as array_api_strict, or the
+            name of a library such as 'jax'. The rays are generated with NumPy and moved to
+            the namespace once, and then stay there, as do the images of
+            get_detector_image(). Rays stopped by apertures are not compacted. The rays are
+            plotted from a NumPy copy. These methods only work with NumPy, and raise a
+            TypeError otherwise: step_compiled(), propagate_compiled(), propagate_sweep(),
+            sweep(), sweep_images(), trace_stream(), compare_compact_rays(),
+            trace_4dstem_positions(), scan_4dstem_rows(), run_4dstem_scan(),
+            write_4dstem_scan(), run_4dstem_scan_parallel(), get_ray_jacobian() and
+            optimize(). None uses NumPy, by default None
 
         """
         self.components = components
@@ -81,11 +149,21 @@ class Model:
 
         self.beam_z = beam_z
         self.beam_type = beam_type
+        self.beam_sampler = beam_sampler
+        self.beam_seed = beam_seed
         self.gun_beam_semi_angle = gun_beam_semi_angle
 
         self.beam_tilt_x = beam_tilt_x
         self.beam_tilt_y = beam_tilt_y
         self.experiment = experiment
+        self.record_planes = record_planes
+        self.compact_rays = compact_rays
+        self.compaction_threshold = compaction_threshold
+        self.ray_fates = None
+        self.xp = get_namespace(array_namespace)
+
+        # Profiler which records the time spent in each component, see profile()
+        self.profiler = None
 
         if self.experiment == "4DSTEM":
 
@@ -117,42 +195,76 @@ class Model:
         self.set_z_positions()
 
         self.z_distances = np.diff(self.z_positions)
+        self.propagation_matrices = self.get_propagation_matrices(self.z_distances)
+        self.set_plane_slots()
 
         # Make the matrix of rays that depends on the beam conditions input into the model.
         self.generate_rays()
+        self.components_matrix = None
         self.update_component_matrix()
         self.allowed_ray_idcs = np.arange(self.num_rays)
+        self.compiled_column = None
 
         self.detector_size = detector_size
         self.detector_pixels = detector_pixels
 
+    def __getstate__(self):
+        # Modules cannot be pickled, so the array namespace is kept by name, e.g. when a copy
+        # of the model is sent to a worker process
+        state = self.__dict__.copy()
+        state["xp"] = None if self.xp is np else self.xp.__name__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.xp = get_namespace(self.xp)
+
+    def require_numpy(self, method):
+        """Raise a TypeError unless the rays are traced with NumPy, for methods which only
+        work with NumPy
+
+        Parameters
+        ----------
+        method : str
+            Name of the method, for the error message
+        """
+        if self.xp is not np:
+            raise TypeError(
+                f"{method}() only works with NumPy, but the model traces its rays with "
+                f"{self.xp.__name__}, see array_namespace"
+            )
+
     def set_z_positions(self):
         """Create the z position list of all components in the model"""
         self.z_positions = []
 
+        # Also keep the index of the ray plane at which each component starts, with the
+        # detector plane at the end
+        self.component_plane_idcs = []
+
         # Input the initial beam_z as the first z_position
         self.z_positions.append(self.beam_z)
 
-        # We need to loop through all components and where there is a double deflector,
-        # we need to add an extra z_position to the matrix
-        double_deflectors = 0
+        # We need to loop through all components and add a z_position for every plane of
+        # each, where components such as a double deflector have more than one plane
+        extra_planes = 0
         for idx, component in enumerate(self.components):
-            if component.type == "Double Deflector":
-                self.z_positions.append(component.z_up)
-                component.index = idx
-                self.z_positions.append(component.z_low)
-                component.index = idx + 1
-                double_deflectors += 1
-            else:
-                self.z_positions.append(component.z)
-                component.index = idx + double_deflectors
+            plane = idx + extra_planes + 1
+            self.component_plane_idcs.append(plane)
+
+            self.z_positions.extend(component.get_z_positions())
+            extra_planes += component.num_planes - 1
+
+            # Index of the last plane of the component, not counting the gun
+            component.index = plane + component.num_planes - 2
 
             if component.type == "Sample":
-                self.sample_r_idx = idx + double_deflectors + 1
+                self.sample_r_idx = plane
                 self.sample_idx = idx
 
         # Add the position of the detector
         self.z_positions.append(0)
+        self.component_plane_idcs.append(len(self.z_positions) - 1)
 
     def set_obj_lens_f_from_overfocus(self, overfocus):
         if overfocus <= 0:
@@ -172,136 +284,992 @@ class Model:
         # This is used for the GUI Slider
         self.beam_radius_init = abs(self.obj_lens.f) * np.tan(self.semiconv)
 
+    def get_plane_idcs(self, planes):
+        """Find the indices of ray planes, see record_planes in __init__()
+
+        Parameters
+        ----------
+        planes : str, float or list
+            'all', or a plane or list of planes, each of which is 'gun', 'detector', the name
+            of a component or a z position
+
+        Returns
+        -------
+        plane_idcs : list
+            Sorted indices of the ray planes
+        """
+        num_planes = len(self.z_positions)
+        if isinstance(planes, str) and planes == "all":
+            return list(range(num_planes))
+
+        if isinstance(planes, str) or np.ndim(planes) == 0:
+            planes = [planes]
+
+        plane_idcs = set()
+        for plane in planes:
+            if isinstance(plane, str):
+                if plane == "gun":
+                    plane_idcs.add(0)
+                elif plane == "detector":
+                    plane_idcs.add(num_planes - 1)
+                else:
+                    idx = self.components.index(self.find_component(plane))
+                    plane_idcs.update(
+                        range(self.component_plane_idcs[idx], self.component_plane_idcs[idx + 1])
+                    )
+            else:
+                matches = np.flatnonzero(np.isclose(self.z_positions, plane))
+                if len(matches) == 0:
+                    raise ValueError(f"No plane of the model at z = {plane}")
+                plane_idcs.update(matches.tolist())
+
+        return sorted(plane_idcs)
+
+    def set_plane_slots(self):
+        """Find the planes to record from self.record_planes, and the slot of self.r each
+        plane is written to, which is -1 for planes that are not recorded."""
+        self.recorded_plane_idcs = self.get_plane_idcs(self.record_planes)
+
+        self.plane_slots = np.full(len(self.z_positions), -1)
+        self.plane_slots[self.recorded_plane_idcs] = np.arange(len(self.recorded_plane_idcs))
+
+    def set_record_planes(self, record_planes):
+        """Choose the planes whose rays are kept in self.r, see record_planes in __init__().
+        The rays are generated again, so they are traced from the gun at the next step().
+
+        Parameters
+        ----------
+        record_planes : str, float or list
+            'all', or a plane or list of planes to record
+        """
+        self.record_planes = record_planes
+        self.set_plane_slots()
+        self.generate_rays()
+
+    def get_plane_rays(self, plane):
+        """Get the rays stored by the last step() at a recorded plane
+
+        Parameters
+        ----------
+        plane : str or float
+            'gun', 'detector', the name of a component or a z position. For a double
+            deflector, the rays at its upper plane are returned.
+
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the plane of shape (5, num_rays)
+        """
+        idx = self.get_plane_idcs(plane)[0]
+        if self.plane_slots[idx] < 0:
+            raise KeyError(f"Plane {plane!r} is not recorded, see record_planes")
+
+        return self.r[int(self.plane_slots[idx]), :, :]
+
+    def get_detector_image(self, method="nearest", flip_y=True):
+        """Bin the rays which reached the detector at the last step() into an image, in the
+        array namespace of the model. The detector plane must be recorded.
+
+        Parameters
+        ----------
+        method : str, optional
+            "nearest" or "bilinear", see temgymlite.functions.bin_pixel_coords, by default
+            "nearest"
+        flip_y : bool, optional
+            Flip the y axis of the detector, as in get_image_from_rays, by default True
+
+        Returns
+        -------
+        image : array
+            Image of shape (detector_pixels, detector_pixels)
+        """
+        xp = self.xp
+        rays = self.get_plane_rays("detector")
+
+        # Rays stopped by a component do not reach the detector
+        reached = self.ray_fates < 0
+        missing = xp.full_like(rays[0, :], float("nan"))
+
+        return bin_rays(
+            xp.where(reached, rays[0, :], missing),
+            xp.where(reached, rays[2, :], missing),
+            self.detector_size,
+            self.detector_pixels,
+            method=method,
+            flip_y=flip_y,
+        )
+
+    def step_all_planes(self):
+        """Step the model and get the rays at every plane, whichever planes are recorded.
+        If only some planes are recorded, they are recorded again afterwards, and keep the
+        rays of this trace, as after step().
+
+        Returns
+        -------
+        r : ndarray
+            Ray positions at every plane of shape (steps, 5, num_rays)
+        """
+        if isinstance(self.record_planes, str) and self.record_planes == "all":
+            return self.step()
+
+        record_planes = self.record_planes
+        self.set_record_planes("all")
+        try:
+            r = self.step()
+            traced_modified_counts = self.traced_modified_counts
+        finally:
+            self.set_record_planes(record_planes)
+
+        # Setting the recorded planes gives new, untraced rays, so copy the rays of the
+        # recorded planes over from this trace
+        xp = self.xp
+        self.r = xp.take(r, xp.asarray(self.recorded_plane_idcs), axis=0)
+        if self.plane_slots[0] == 0:
+            self.gun_rays = self.r[0, :, :]
+        else:
+            self.gun_rays = r[0, :, :]
+        self.traced_modified_counts = traced_modified_counts
+
+        return r
+
+    def compare_compact_rays(self):
+        """Compare compact float32 rays with float64 rays, see compact_rays in __init__().
+        The rays of the model are traced through every plane both ways, and the model is
+        left as it was afterwards.
+
+        Positions and slopes are rounded to float32 once at the gun, and every plane then
+        adds a rounding error of about one float32 unit (6e-8) of the values involved. For
+        the columns of the examples (up to 20 components and 26 planes, with point,
+        paralell and axial beams), the largest error at any plane was between 5e-8 and
+        9e-7 of the largest position or slope in the column, i.e. far below the size of a
+        detector pixel, and no ray was blocked differently. Rays which land within that
+        distance of an aperture edge or biprism wire can be blocked differently, which
+        shows up in blocked_mismatch.
+
+        Returns
+        -------
+        comparison : dict
+            'max_abs_error': largest absolute difference of x, x slope, y and y slope at
+            each plane, of shape (steps, 4)
+            'max_rel_error': max_abs_error relative to the largest position (for x and y)
+            or slope (for the slopes) of any ray anywhere in the column, of shape (steps, 4)
+            'blocked_mismatch': number of rays blocked in one precision but not the other
+        """
+        self.require_numpy("compare_compact_rays")
+
+        compact_rays = self.compact_rays
+        record_planes = self.record_planes
+
+        traced = []
+        try:
+            for compact in (False, True):
+                self.compact_rays = compact
+                self.set_record_planes("all")
+                r = self.step()[:, :4, :].astype(np.float64)
+
+                blocked = np.zeros(self.num_rays, dtype=bool)
+                for component in self.components:
+                    blocked[component.blocked_ray_idcs] = True
+
+                traced.append((r, blocked))
+        finally:
+            self.compact_rays = compact_rays
+            self.set_record_planes(record_planes)
+
+        # Trace the rays again, in the precision and planes of the model
+        self.step()
+
+        (r64, blocked64), (r32, blocked32) = traced
+
+        max_abs_error = np.max(np.abs(r32 - r64), axis=-1, initial=0)
+
+        # The beam can shrink to a point at a crossover, so compare positions and slopes
+        # with the largest position and slope anywhere in the column
+        scale = np.max(np.abs(r64), axis=(0, 2), initial=0)
+        position_scale, slope_scale = max(scale[0], scale[2]), max(scale[1], scale[3])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            max_rel_error = max_abs_error / np.array(
+                [position_scale, slope_scale, position_scale, slope_scale]
+            )
+
+        return {
+            "max_abs_error": max_abs_error,
+            "max_rel_error": max_rel_error,
+            "blocked_mismatch": int(np.count_nonzero(blocked64 != blocked32)),
+        }
+
+    def get_beam_geometry_and_sampler(self):
+        """Split the beam type into the geometry of the beam and the sampler of its rays, so
+        that a beam type such as 'point_sobol' can choose its sampler directly.
+
+        Returns
+        -------
+        beam_type : str
+            Geometry of the beam, such as 'point' or 'paralell'
+        sampler : str
+            Name of the sampler that spreads the rays over the beam
+        """
+        beam_type, _, sampler = self.beam_type.rpartition("_")
+        if beam_type and sampler in DISK_SAMPLERS:
+            return beam_type, sampler
+
+        return self.beam_type, self.beam_sampler
+
     def generate_rays(self):
         """Generate electron rays"""
         # Make our 3D matrix of rays. This matrix is of shape (steps, 5, num rays), where
-        # steps is defined by the number of components.
+        # steps is defined by the number of components, or by the number of recorded planes
+        # if not all planes are recorded.
 
         self.steps = len(self.z_positions)
 
-        self.r = np.zeros(
-            (self.steps, 5, self.num_rays), dtype=np.float64
-        )  # x, theta_x, y, theta_y, 1
-
-        self.r[:, 4, :] = np.ones(self.num_rays)
-
-        if self.beam_type == "paralell":
-            self.r, self.spot_indices = circular_beam(self.r, self.beam_radius)
-        elif self.beam_type == "point":
-            self.r, self.spot_indices = point_beam(self.r, self.gun_beam_semi_angle)
-        elif self.beam_type == "axial":
-            self.r = axial_point_beam(self.r, self.gun_beam_semi_angle)
-        elif self.beam_type == "x_axial":
-            self.r = x_axial_point_beam(self.r, self.gun_beam_semi_angle)
+        if self.compact_rays:
+            self.r = np.zeros(
+                (len(self.recorded_plane_idcs), 4, self.num_rays), dtype=np.float32
+            )  # x, theta_x, y, theta_y
+        else:
+            self.r = np.zeros(
+                (len(self.recorded_plane_idcs), 5, self.num_rays), dtype=np.float64
+            )  # x, theta_x, y, theta_y, 1
+
+            self.r[:, 4, :] = np.ones(self.num_rays)
+
+        # The rays leaving the gun are kept at the first plane of self.r if the gun plane is
+        # recorded, and in an array of their own if not. Compact rays are always generated
+        # in full precision first.
+        if self.plane_slots[0] == 0 and not self.compact_rays:
+            rays = self.r
+        else:
+            rays = np.zeros((1, 5, self.num_rays), dtype=np.float64)
+            rays[:, 4, :] = np.ones(self.num_rays)
+
+        beam_type, sampler = self.get_beam_geometry_and_sampler()
+
+        if beam_type == "paralell":
+            rays, self.spot_indices = circular_beam(
+                rays, self.beam_radius, sampler, self.beam_seed
+            )
+        elif beam_type == "point":
+            rays, self.spot_indices = point_beam(
+                rays, self.gun_beam_semi_angle, sampler, self.beam_seed
+            )
+        elif beam_type == "axial":
+            rays = axial_point_beam(rays, self.gun_beam_semi_angle)
+        elif beam_type == "x_axial":
+            rays = x_axial_point_beam(rays, self.gun_beam_semi_angle)
+
+        rays[:, 1, :] += self.beam_tilt_x
+        rays[:, 3, :] += self.beam_tilt_y
+
+        if not self.compact_rays:
+            self.gun_rays = rays[0, :, :]
+        elif self.plane_slots[0] == 0:
+            self.r[0, :, :] = rays[0, :4, :]
+            self.gun_rays = self.r[0, :, :]
+        else:
+            self.gun_rays = rays[0, :4, :].astype(np.float32)
+
+        if self.xp is not np:
+            # The samplers are memoized with NumPy, so the rays are moved over once here
+            self.r = self.xp.asarray(self.r)
+            self.gun_rays = self.xp.asarray(self.gun_rays)
+
+        # New rays have not been traced through any component yet
+        self.traced_modified_counts = None
+
+    def update_z_positions(self):
+        """Update the z positions of all components in the model, and rebuild the
+        propagation matrices between them if any component has moved.
+        """
+        z_positions = self.z_positions
+        self.set_z_positions()
 
-        self.r[:, 1, :] += self.beam_tilt_x
-        self.r[:, 3, :] += self.beam_tilt_y
+        if self.z_positions != z_positions:
+            self.z_distances = np.diff(self.z_positions)
+            self.propagation_matrices = self.get_propagation_matrices(self.z_distances)
 
-    # Add the matrices of each component to a list
+    # Add the matrices of each component to an array
     def update_component_matrix(self):
-        """Update the list of all component matrices, each matrix of which has
-        been set by the component upon it's creation.
+        """Update the array of all component matrices, which has one matrix for every plane
+        of the components. A component whose parameters have changed since its matrix was
+        last set has its matrix set again first. Only the matrices of components which have
+        changed since the last update are copied into the array.
         """
-        self.components_matrix = []
+        num_planes = self.component_plane_idcs[-1] - 1
+        if self.components_matrix is None or len(self.components_matrix) != num_planes:
+            self.components_matrix = np.empty((num_planes, 5, 5))
+            self.matrix_modified_counts = [None] * len(self.components)
+
+        profiler = self.profiler
+
         for idx, component in enumerate(self.components):
-            if component.type == "Double Deflector":
-                self.components_matrix.append(component.up_matrix)
-                self.components_matrix.append(component.low_matrix)
-            else:
-                self.components_matrix.append(component.matrix)
+            if component.matrix_dirty:
+                if profiler is not None:
+                    event = profiler.begin(component.name, "matrix")
+                component.set_matrices()
+                if profiler is not None:
+                    profiler.end(event)
+
+            if component.modified_count == self.matrix_modified_counts[idx]:
+                continue
+
+            plane = self.component_plane_idcs[idx] - 1
+            for matrix in component.get_matrices():
+                self.components_matrix[plane] = matrix
+                plane += 1
+
+            self.matrix_modified_counts[idx] = component.modified_count
 
     # Perform the matrix multiplication of the rays with each component in the model
-    def update_rays_stepwise(self):
+    def update_rays_stepwise(self, start=0):
         """Perform the neccessary matrix multiplications and function multiplications
         to propagate the beam through the column
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first component to propagate the beam through. The rays at every
+            plane above this component are reused as they are, by default 0
         """
-        # Do the matrix multiplication of the first rays with the distance between the initial beam z
-        # and the first component
-        self.r[1, :, :] = np.matmul(
-            self.propagate(self.z_distances[0]), self.r[0, :, :]
+        xp = self.xp
+
+        fates = None
+        if start != 0 and self.ray_fates is not None:
+            # Rays stopped above the start component stay stopped
+            fates = xp.where(
+                self.ray_fates >= start, xp.full_like(self.ray_fates, -1), self.ray_fates
+            )
+
+        self.r, self.ray_fates = self.trace_planes(
+            self.r, start, self.plane_slots, self.gun_rays, fates
         )
 
+        ray_fates = to_numpy(self.ray_fates)
+        for idx, component in enumerate(self.components[start:], start):
+            if not component.linear:
+                component.blocked_ray_idcs = np.flatnonzero(ray_fates == idx)
+
+    def trace_planes(self, r, start=0, plane_slots=None, gun_rays=None, fates=None):
+        """Propagate rays through the column plane by plane, with the component and
+        propagation matrices last set by update_component_matrix().
+
+        A ray is alive until an aperture or biprism stops it. Stopped rays are still
+        propagated with the others, until the fraction of alive rays falls below
+        self.compaction_threshold. The stopped rays are then dropped from the working
+        arrays, and their positions at the recorded planes below are set to NaN.
+
+        With NumPy, the rays are written in place into r and a small working buffer. With
+        any other array namespace of the model, only functions of the array API standard
+        are used and no array is changed in place, so namespaces of immutable arrays such
+        as jax.numpy work too. The recorded planes are then stacked into a new array, and
+        stopped rays are never dropped.
+
+        Parameters
+        ----------
+        r : ndarray
+            Ray positions and slopes at the recorded planes of shape (planes, 5, num_rays),
+            which are filled from the plane of the start component downwards
+        start : int, optional
+            Index of the first component to propagate the beam through. The rays at the
+            plane above this component are used as they are, so that plane must be
+            recorded unless it is the gun, by default 0
+        plane_slots : ndarray, optional
+            Slot of r that each ray plane is written to, or -1 for planes which are only
+            held in a working buffer. By default every plane is recorded.
+        gun_rays : ndarray, optional
+            Ray positions and slopes leaving the gun of shape (5, num_rays), by default
+            the first plane of r
+        fates : ndarray, optional
+            Fate of every ray above the start component, see below. By default no ray
+            has been stopped.
+
+        Returns
+        -------
+        r : ndarray
+            Ray positions and slopes at the recorded planes, which is r itself with NumPy
+        fates : ndarray
+            Integer array of shape (num_rays,) with the index of the component which
+            stopped each ray, or -1 for rays that reach the detector
+        """
+        xp = self.xp
+        in_place = xp is np
+
+        num_rays = r.shape[-1]
+        if plane_slots is None:
+            plane_slots = np.arange(len(self.z_positions))
+        if fates is None:
+            fates = xp.full(num_rays, -1, dtype=xp.int64)
+
+        idx = self.component_plane_idcs[start]
+        if idx - 1 == 0 and gun_rays is not None:
+            rays = gun_rays
+        else:
+            rays = r[int(plane_slots[idx - 1]), :, :]
+
+        if not in_place:
+            # The recorded planes above the start component, to which the planes below
+            # are appended
+            num_recorded = int(np.count_nonzero(plane_slots[:idx] >= 0))
+            recorded_planes = [r[slot, :, :] for slot in range(num_recorded)]
+
+        # Indices of the rays held in the working arrays, which is None while every ray is
+        # held, and which of them are still alive
+        live = None
+        alive = fates < 0
+
+        # Planes which are not recorded take turns in a working buffer of two planes, so
+        # that the rays are never multiplied into the array they are read from
+        work = None
+        turn = 0
+
+        # Transfer matrix of the planes the rays have passed since they were last computed.
+        # Linear components below a plane which is not recorded are folded into a single
+        # matrix, so the rays are only computed where they are needed
+        matrix = None
+
+        profiler = self.profiler
+
+        # Loop through the components, and finally the detector, which has no component
+        for component_idx in range(start, len(self.components) + 1):
+            if component_idx < len(self.components):
+                component = self.components[component_idx]
+                planes = range(idx, self.component_plane_idcs[component_idx + 1])
+            else:
+                component = None
+                planes = range(idx, idx + 1)
+
+            if profiler is not None:
+                event = profiler.begin(
+                    "Detector" if component is None else component.name,
+                    "component",
+                    rays_in=int(xp.count_nonzero(alive)),
+                )
+
+            if (
+                in_place
+                and self.compaction_threshold is not None
+                and np.count_nonzero(alive) < self.compaction_threshold * len(alive)
+            ):
+                # Drop the stopped rays from the working arrays
+                rays = rays[:, alive]
+                live = np.flatnonzero(alive) if live is None else live[alive]
+                alive = np.ones(len(live), dtype=bool)
+
+            # A component such as a double deflector can have more than one plane
+            for plane, idx in enumerate(planes):
+                if matrix is None:
+                    matrix = self.propagation_matrices[idx - 1]
+                else:
+                    matrix = np.matmul(self.propagation_matrices[idx - 1], matrix)
+
+                slot = plane_slots[idx]
+                if component is not None and component.linear:
+                    matrix = np.matmul(self.components_matrix[idx - 1], matrix)
+                    if slot < 0:
+                        continue
+
+                out = None
+                if in_place and live is None and slot >= 0:
+                    out = r[slot, :, :]
+                elif in_place:
+                    if work is None or work.shape[-1] != rays.shape[-1]:
+                        work = np.empty((2,) + rays.shape, dtype=r.dtype)
+                    out = work[turn]
+                    turn = 1 - turn
+
+                # Propagate the rays from the last computed plane, then apply the component
+                # if it cannot be folded into the matrix
+                rays = transfer_rays(matrix, rays, out=out)
+                matrix = None
+
+                blocked_ray_bools = None
+                if component is not None and not component.linear:
+                    if in_place:
+                        blocked_ray_bools = component.apply(rays, plane=plane)
+                    else:
+                        rays, blocked_ray_bools = component.transfer(rays, plane=plane)
+
+                if not in_place:
+                    if slot >= 0:
+                        recorded_planes.append(rays)
+                elif live is not None and slot >= 0:
+                    recorded = r[slot, :, :]
+                    recorded[...] = np.nan
+                    recorded[:, live] = rays
+
+                if blocked_ray_bools is not None:
+                    stopped = alive & blocked_ray_bools
+                    if live is None:
+                        fates = xp.where(stopped, xp.full_like(fates, component_idx), fates)
+                    else:
+                        fates[live[stopped]] = component_idx
+                    alive = alive & ~blocked_ray_bools
+
+            if profiler is not None:
+                profiler.end(event, rays_out=int(xp.count_nonzero(alive)))
+
+            idx = planes.stop
+
+        if not in_place:
+            r = xp.stack(recorded_planes)
+
+        return r, fates
+
+    def build_compiled_column(self):
+        """Fold every run of linear components, and the propagation between them, into a
+        single transfer matrix. Components which are not linear, such as apertures and
+        biprisms, cannot be expressed as a matrix, so they split the column into stages.
+        The column is also split at any component with compiled_stop set, such as the
+        sample, so that the rays which hit it are available to form an image.
+
+        If component matrices are stacks of shape (P, 5, 5), the compiled matrices are
+        stacked in the same way.
+
+        Returns
+        -------
+        compiled_column : list
+            List of (matrix, component, plane) triples: the matrix carries the rays from
+            the previous stage to the given plane of the component, after which the
+            component is applied. The final triple has no component and carries the rays
+            to the detector.
+        """
+        compiled_column = []
+
+        # Start with the propagation from the gun to the first component
+        matrix = self.propagation_matrices[0]
         idx = 1
 
-        # For every component, loop through it and perform the matrix multiplication
         for component in self.components:
-            if component.type == "Biprism":
-                x = abs(self.r[idx, 0, :])
-                y = abs(self.r[idx, 2, :])
+            for plane, component_matrix in enumerate(component.get_matrices()):
+                if component.linear:
+                    matrix = np.matmul(component_matrix, matrix)
+
+                if component.compiled_stop or not component.linear:
+                    compiled_column.append((matrix, component, plane))
+                    matrix = self.propagation_matrices[idx]
+                else:
+                    matrix = np.matmul(self.propagation_matrices[idx], matrix)
+                idx += 1
 
-                if component.theta != 0:
-                    x_hit_biprism = np.where(x < component.width)[0]
-                    y_hit_biprism = np.where(y < component.radius)[0]
+        compiled_column.append((matrix, None, 0))
 
-                elif component.theta == 0:
-                    x_hit_biprism = np.where(x < component.radius)[0]
-                    y_hit_biprism = np.where(y < component.width)[0]
+        return compiled_column
 
-                blocked_idcs = list(set(x_hit_biprism).intersection(y_hit_biprism))
+    def propagate_compiled(self, compiled_column, rays):
+        """Propagate rays through a compiled column, see build_compiled_column().
 
-                component.blocked_ray_idcs = blocked_idcs
+        Parameters
+        ----------
+        compiled_column : list
+            List of (matrix, component, plane) triples
+        rays : ndarray
+            Ray positions and slopes at the gun of shape (..., 5, num_rays)
 
-                self.r[idx, 1, :] = (
-                    self.r[idx, 1, :]
-                    + np.sign(self.r[idx, 0, :]) * component.matrix[1, 4]
-                )
-                self.r[idx, 3, :] = (
-                    self.r[idx, 3, :]
-                    + np.sign(self.r[idx, 2, :]) * component.matrix[3, 4]
-                )
-                self.r[idx + 1, :, :] = np.matmul(
-                    self.propagate(self.z_distances[idx]), self.r[idx, :, :]
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the detector
+        stops : list
+            List of (component, rays, blocked_ray_bools) for every stage of the compiled
+            column, with the rays at the plane of that component, and which of them were
+            blocked by it (None for linear components such as the sample)
+        """
+        self.require_numpy("propagate_compiled")
+
+        profiler = self.profiler
+
+        stops = []
+        for matrix, component, plane in compiled_column:
+            if profiler is not None:
+                event = profiler.begin(
+                    "Detector" if component is None else component.name, "stage"
                 )
-                idx += 1
 
-            elif component.type == "Aperture":
+            rays = transfer_rays(matrix, rays)
 
-                # Special vectorised function for the aperture
-                xp, yp = self.r[idx, 0, :], self.r[idx, 2, :]
-                xc, yc = component.x, component.y
-                distance = np.sqrt((xp - xc) ** 2 + (yp - yc) ** 2)
+            if component is None or component.linear:
+                if component is not None:
+                    stops.append((component, rays, None))
+                if profiler is not None:
+                    profiler.end(event)
+                continue
 
-                blocked_ray_bools = np.logical_and(
-                    distance >= component.aperture_radius_inner,
-                    distance < component.aperture_radius_outer,
-                )
-                component.blocked_ray_idcs = np.where(blocked_ray_bools)[0]
+            # A swept component may act differently at every sweep point, so the rays need
+            # a sweep axis before they can be updated in place
+            shape = np.broadcast_shapes(
+                rays.shape,
+                np.shape(component.get_matrices()[plane])[:-2] + rays.shape[-2:],
+            )
+            if rays.shape != shape:
+                rays = np.broadcast_to(rays, shape).copy()
 
-                self.r[idx + 1, :, :] = np.matmul(
-                    self.propagate(self.z_distances[idx]), self.r[idx, :, :]
-                )
-                idx += 1
-            elif component.type == "Double Deflector":
-                self.r[idx, :, :] = np.matmul(component.up_matrix, self.r[idx, :, :])
-                self.r[idx + 1, :, :] = np.matmul(
-                    self.propagate(self.z_distances[idx]), self.r[idx, :, :]
-                )
-                idx += 1
+            stops.append((component, rays, component.apply(rays, plane=plane)))
 
-                self.r[idx, :, :] = np.matmul(component.low_matrix, self.r[idx, :, :])
-                self.r[idx + 1, :, :] = np.matmul(
-                    self.propagate(self.z_distances[idx]), self.r[idx, :, :]
-                )
-                idx += 1
+            if profiler is not None:
+                profiler.end(event)
+
+        return rays, stops
+
+    def compile(self):
+        """Compile the column into as few transfer matrices as possible and store them in
+        self.compiled_column, see build_compiled_column().
+
+        Returns
+        -------
+        compiled_column : list
+            List of (matrix, component, plane) triples
+        """
+        self.update_z_positions()
+        self.update_component_matrix()
+        self.compiled_column = self.build_compiled_column()
+
+        self.compiled_modified_counts = self.get_modified_counts()
+        self.compiled_z_distances = self.z_distances
+
+        return self.compiled_column
+
+    def step_compiled(self):
+        """Propagate the rays from the gun straight to the detector with the compiled column.
+        Rays are only computed at the detector and at the planes of apertures and
+        biprisms, so this is much faster than step() when intermediate ray positions are
+        not needed. The column is compiled again whenever a component has been modified
+        or moved since it was last compiled, see compile().
+
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the detector of shape (5, num_rays)
+        """
+        self.require_numpy("step_compiled")
+
+        profiler = self.profiler
+        if profiler is not None:
+            step_event = profiler.begin("step_compiled", "step", rays_in=self.num_rays)
+
+        if (
+            self.compiled_column is None
+            or self.get_modified_counts() != self.compiled_modified_counts
+            or self.beam_z != self.z_positions[0]
+            or self.z_distances is not self.compiled_z_distances
+        ):
+            if profiler is not None:
+                event = profiler.begin("compile", "compile")
+            self.compile()
+            if profiler is not None:
+                profiler.end(event)
+
+        rays, stops = self.propagate_compiled(self.compiled_column, self.gun_rays)
+
+        # Record the fate of every ray, as in trace_planes()
+        self.ray_fates = np.full(self.num_rays, -1)
+        for component, _, blocked_ray_bools in stops:
+            if blocked_ray_bools is not None:
+                stopped = blocked_ray_bools & (self.ray_fates < 0)
+                self.ray_fates[stopped] = self.components.index(component)
+                component.blocked_ray_idcs = np.flatnonzero(stopped)
+
+        if profiler is not None:
+            profiler.end(step_event, rays_out=int(np.count_nonzero(self.ray_fates < 0)))
+            profiler.num_steps += 1
+
+        return rays
+
+    def find_component(self, name):
+        """Find a component of the model by its name
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+
+        Returns
+        -------
+        component : class
+            First component in the model with this name
+        """
+        for component in self.components:
+            if component.name == name:
+                return component
+
+        raise KeyError(f"No component named '{name}' in the model")
+
+    def propagate_sweep(self, parameters):
+        """Propagate the rays through the compiled column for a whole series of component
+        parameters at once, see sweep().
+
+        Parameters
+        ----------
+        parameters : dict
+            Dictionary of "Component Name.attribute" or (component, "attribute") keys with
+            an array of P values each
+
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the detector of shape (P, 5, num_rays)
+        stops : list
+            List of (component, rays, blocked_ray_bools) for every stage of the compiled
+            column, see propagate_compiled()
+        """
+        self.require_numpy("propagate_sweep")
+
+        # Group the swept parameters by component
+        swept = {}
+        num_points = None
+        for key, values in parameters.items():
+            if isinstance(key, str):
+                name, attribute = key.rsplit(".", 1)
+                component = self.find_component(name)
             else:
-                # Every other function has a single matrix, so just need to do straightforward matrix multiplication
-                self.r[idx, :, :] = np.matmul(component.matrix, self.r[idx, :, :])
-                self.r[idx + 1, :, :] = np.matmul(
-                    self.propagate(self.z_distances[idx]), self.r[idx, :, :]
+                component, attribute = key
+
+            if not hasattr(component, attribute):
+                raise AttributeError(
+                    f"Component '{component.name}' has no parameter '{attribute}' to sweep"
                 )
-                idx += 1
 
-    def update_scan_coil_ratio(self):
+            values = np.asarray(values, dtype=np.float64)
+            if num_points is None:
+                num_points = len(values)
+            elif len(values) != num_points:
+                raise ValueError("All swept parameters must have the same number of values")
+
+            swept.setdefault(component, {})[attribute] = values
+
+        if num_points is None:
+            raise ValueError("No parameters to sweep")
+
+        # Set the matrices of components whose parameters changed since the last step, so
+        # that the components which are not swept enter the compiled column up to date
+        self.update_component_matrix()
+
+        # Store the original parameters of every swept component so we can restore them after
+        originals = {
+            component: {attribute: getattr(component, attribute) for attribute in values}
+            for component, values in swept.items()
+        }
+
+        try:
+            # Give every swept component an array of parameters, so that its matrix
+            # function builds a stack of matrices of shape (P, 5, 5)
+            for component, values in swept.items():
+                for attribute, value in values.items():
+                    setattr(component, attribute, value)
+
+                component.set_matrices()
+
+            compiled_column = self.build_compiled_column()
+            rays, stops = self.propagate_compiled(compiled_column, self.gun_rays)
+        finally:
+            # Set the matrices again from the restored parameters, rather than restoring the
+            # old matrices, which would mark the components as up to date
+            for component, attributes in originals.items():
+                for attribute, value in attributes.items():
+                    setattr(component, attribute, value)
+
+                component.set_matrices()
+
+        # Matrices of components which are not swept have no sweep axis
+        rays = np.broadcast_to(rays, (num_points,) + rays.shape[-2:])
+
+        return rays, stops
+
+    def sweep(self, parameters):
+        """Propagate the rays to the detector for a whole series of component parameters at
+        once, e.g. a focus series or a stigmator scan.
+
+        Every swept component gets a stack of P matrices, one per sweep point, and the
+        rays of all sweep points are carried through the compiled column together as an
+        array of shape (P, 5, num_rays). The components are left unchanged afterwards.
+
+        Parameters
+        ----------
+        parameters : dict
+            Dictionary of "Component Name.attribute" keys with an array of P values each,
+            e.g. {"Objective Lens.f": np.linspace(-0.25, -0.15, 1000)}. All swept
+            parameters change together, so every array must have the same length.
+            Any attribute used to set the component matrix can be swept, as well as the
+            position and radii of an aperture. A (component, "attribute") tuple can also
+            be used as a key.
+
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the detector of shape (P, 5, num_rays)
+        blocked : ndarray
+            Boolean array of shape (P, num_rays) which is True for rays blocked by an
+            aperture or biprism at that sweep point
+        """
+        self.require_numpy("sweep")
+
+        rays, stops = self.propagate_sweep(parameters)
+
+        blocked_ray_bools = np.zeros((rays.shape[0], self.num_rays), dtype=bool)
+        for _, _, component_blocked in stops:
+            if component_blocked is not None:
+                blocked_ray_bools |= component_blocked
+
+        return rays, blocked_ray_bools
+
+    def sweep_images(self, parameters, flip_y=True):
+        """Form an image of the rays that hit the detector for every point of a parameter
+        sweep, see sweep().
+
+        Parameters
+        ----------
+        parameters : dict
+            Dictionary of "Component Name.attribute" keys with an array of P values each
+        flip_y : bool, optional
+            Flip the y axis of the detector, as in get_image_from_rays, by default True
+
+        Returns
+        -------
+        detector_ray_images : ndarray
+            Number of unblocked rays that hit each detector pixel, of shape
+            (P, detector_pixels, detector_pixels)
+        """
+        self.require_numpy("sweep_images")
+
+        rays, blocked = self.sweep(parameters)
+
+        # Blocked rays are moved off the detector so that they are not counted
+        detector_ray_images = bin_rays(
+            rays_x=np.where(blocked, np.nan, rays[:, 0, :]),
+            rays_y=rays[:, 2, :],
+            size=self.detector_size,
+            pixels=self.detector_pixels,
+            flip_y=flip_y,
+        )
+
+        return detector_ray_images
+
+    def generate_ray_chunks(self, num_rays=None, chunk_size=65536):
+        """Generate the rays of the gun chunk by chunk, so that a beam of many more rays
+        than fit in memory can be traced with trace_stream(). The chunks together make up
+        the same beam as generate_rays() would for num_rays rays.
+
+        Parameters
+        ----------
+        num_rays : int, optional
+            Total number of rays, by default self.num_rays
+        chunk_size : int, optional
+            Number of rays in each chunk, by default 65536
+
+        Yields
+        ------
+        rays : ndarray
+            Ray positions and slopes at the gun of shape (5, chunk_size), the last chunk
+            may be smaller
+        """
+        if num_rays is None:
+            num_rays = self.num_rays
+
+        beam_type, sampler = self.get_beam_geometry_and_sampler()
+        if beam_type not in ("point", "paralell"):
+            raise ValueError(
+                f"Only point and paralell beams can be generated in chunks, not {beam_type!r}"
+            )
+
+        for start in range(0, num_rays, chunk_size):
+            stop = min(start + chunk_size, num_rays)
+            radius, cos_t, sin_t = unit_disk_chunk(
+                num_rays, start, stop, sampler, self.beam_seed
+            )
+
+            rays = np.zeros((5, stop - start), dtype=np.float64)
+            rays[4, :] = 1
+
+            if beam_type == "paralell":
+                radius = self.beam_radius * radius
+                rays[0, :] = radius * cos_t
+                rays[2, :] = radius * sin_t
+            else:
+                slope = np.tan(self.gun_beam_semi_angle * radius)
+                rays[1, :] = slope * cos_t
+                rays[3, :] = slope * sin_t
+
+            rays[1, :] += self.beam_tilt_x
+            rays[3, :] += self.beam_tilt_y
+
+            yield rays
+
+    def trace_stream(self, chunks=None, num_rays=None, chunk_size=65536, flip_y=True):
+        """Trace rays through the column one chunk at a time, folding every traced chunk
+        into running totals before discarding it. The memory used only depends on the
+        size of a chunk, so any number of rays can be traced.
 
+        Parameters
+        ----------
+        chunks : iterable, optional
+            Iterable of ray arrays at the gun of shape (5, n), or (4, n) for compact rays,
+            e.g. a generator that
+            produces them lazily. By default the rays of the gun are generated with
+            generate_ray_chunks(num_rays, chunk_size).
+        num_rays : int, optional
+            Total number of rays to generate when no chunks are given, by default
+            self.num_rays
+        chunk_size : int, optional
+            Number of rays in each generated chunk, by default 65536
+        flip_y : bool, optional
+            Flip the y axis of the detector image, as in get_image_from_rays, by default True
+
+        Returns
+        -------
+        trace : StreamedTrace
+            Detector image, transmitted ray counts of each component and statistics of the
+            rays at every plane, accumulated over all chunks
+        """
+        self.require_numpy("trace_stream")
+
+        if chunks is None:
+            chunks = self.generate_ray_chunks(num_rays, chunk_size)
+
+        self.update_z_positions()
+        self.update_component_matrix()
+
+        trace = StreamedTrace(self, flip_y=flip_y)
+
+        # Compact rays are traced without the row of ones, in float32
+        rows, dtype = (4, np.float32) if self.compact_rays else (5, np.float64)
+
+        # Reuse the buffer of ray planes for every chunk of the same size
+        r = None
+        for rays in chunks:
+            if r is None or r.shape[-1] != rays.shape[-1]:
+                r = np.empty((len(self.z_positions), rows, rays.shape[-1]), dtype=dtype)
+
+            r[0, :, :] = rays[:rows, :]
+            trace.add_chunk(*self.trace_planes(r))
+
+        return trace
+
+    def get_scan_coil_deflections(self, scan_pixel_x, scan_pixel_y):
+        """Calculate the deflections of the scan and descan coils which move the probe to a
+        scan position on the sample, and bring it back onto the optic axis after.
+
+        Parameters
+        ----------
+        scan_pixel_x : int or ndarray
+            Scan pixel in x, or an array of them
+        scan_pixel_y : int or ndarray
+            Scan pixel in y, or an array of them
+
+        Returns
+        -------
+        scan_deflections : dict
+            Parameters of the scan coils, as attribute name and value
+        descan_deflections : dict
+            Parameters of the descan coils, as attribute name and value
+        """
         sample_size = self.components[self.sample_idx].sample_size
         scan_position_x = (
             sample_size / (2 * self.scan_pixels)
-            + (self.scan_pixel_x / self.scan_pixels) * sample_size
+            + (scan_pixel_x / self.scan_pixels) * sample_size
             - sample_size / 2
         )
         scan_position_y = (
             sample_size / (2 * self.scan_pixels)
-            + (self.scan_pixel_y / self.scan_pixels) * sample_size
+            + (scan_pixel_y / self.scan_pixels) * sample_size
             - sample_size / 2
         )
 
@@ -311,54 +1279,338 @@ class Model:
         )
         dist_to_lens = abs(self.scan_coils.z_low - self.obj_lens.z)
 
-        self.scan_coils.defratiox = -1 - 1 * self.scan_coils.dist / dist_to_ffp
-        self.scan_coils.defratioy = -1 - 1 * self.scan_coils.dist / dist_to_ffp
+        defratiox = -1 - 1 * self.scan_coils.dist / dist_to_ffp
+        defratioy = -1 - 1 * self.scan_coils.dist / dist_to_ffp
 
         # upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
-        self.scan_coils.updefx = scan_position_x / (
-            self.scan_coils.dist
-            + dist_to_lens * self.scan_coils.defratiox
-            + dist_to_lens
+        scan_updefx = scan_position_x / (
+            self.scan_coils.dist + dist_to_lens * defratiox + dist_to_lens
         )
-        self.scan_coils.lowdefx = self.scan_coils.defratiox * self.scan_coils.updefx
-
-        self.scan_coils.updefy = scan_position_y / (
-            self.scan_coils.dist
-            + dist_to_lens * self.scan_coils.defratiox
-            + dist_to_lens
+        scan_updefy = scan_position_y / (
+            self.scan_coils.dist + dist_to_lens * defratiox + dist_to_lens
         )
-        self.scan_coils.lowdefy = self.scan_coils.defratioy * self.scan_coils.updefy
 
-        self.scan_coils.set_matrices()
-
-        self.descan_coils.defratiox = -1 - 1 * self.scan_coils.dist / dist_to_ffp
-        self.descan_coils.defratioy = -1 - 1 * self.scan_coils.dist / dist_to_ffp
+        scan_deflections = {
+            "defratiox": defratiox,
+            "defratioy": defratioy,
+            "updefx": scan_updefx,
+            "lowdefx": defratiox * scan_updefx,
+            "updefy": scan_updefy,
+            "lowdefy": defratioy * scan_updefy,
+        }
 
         # upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
-        self.descan_coils.updefx = (
-            -self.scan_coils.updefx
-            * (
-                self.scan_coils.dist
-                + self.scan_coils.defratiox * dist_to_lens
-                + dist_to_lens
-            )
+        descan_updefx = (
+            -scan_updefx
+            * (self.scan_coils.dist + defratiox * dist_to_lens + dist_to_lens)
             / self.descan_coils.dist
         )
-        self.descan_coils.lowdefx = -self.descan_coils.updefx
-
-        self.descan_coils.updefy = (
-            -self.scan_coils.updefy
-            * (
-                self.scan_coils.dist
-                + self.scan_coils.defratiox * dist_to_lens
-                + dist_to_lens
-            )
+        descan_updefy = (
+            -scan_updefy
+            * (self.scan_coils.dist + defratiox * dist_to_lens + dist_to_lens)
             / self.descan_coils.dist
         )
-        self.descan_coils.lowdefy = -self.descan_coils.updefy
 
+        descan_deflections = {
+            "defratiox": defratiox,
+            "defratioy": defratioy,
+            "updefx": descan_updefx,
+            "lowdefx": -descan_updefx,
+            "updefy": descan_updefy,
+            "lowdefy": -descan_updefy,
+        }
+
+        return scan_deflections, descan_deflections
+
+    def update_scan_coil_ratio(self):
+
+        scan_deflections, descan_deflections = self.get_scan_coil_deflections(
+            self.scan_pixel_x, self.scan_pixel_y
+        )
+
+        for attribute, value in scan_deflections.items():
+            setattr(self.scan_coils, attribute, value)
+        self.scan_coils.set_matrices()
+
+        for attribute, value in descan_deflections.items():
+            setattr(self.descan_coils, attribute, value)
         self.descan_coils.set_matrices()
 
+    def trace_4dstem_positions(self, scan_pixel_x, scan_pixel_y):
+        """Propagate the rays of many scan positions at once, by sweeping the scan and
+        descan coils through the deflections of every scan position.
+
+        Parameters
+        ----------
+        scan_pixel_x : ndarray
+            Array of P scan pixels in x
+        scan_pixel_y : ndarray
+            Array of P scan pixels in y
+
+        Returns
+        -------
+        detector_rays : ndarray
+            Ray positions and slopes at the detector of shape (P, 5, num_rays)
+        sample_rays : ndarray
+            Ray positions and slopes at the sample of shape (P, 5, num_rays)
+        """
+        self.require_numpy("trace_4dstem_positions")
+
+        scan_deflections, descan_deflections = self.get_scan_coil_deflections(
+            np.asarray(scan_pixel_x), np.asarray(scan_pixel_y)
+        )
+
+        parameters = {}
+        for coils, deflections in (
+            (self.scan_coils, scan_deflections),
+            (self.descan_coils, descan_deflections),
+        ):
+            for attribute in ("updefx", "updefy", "lowdefx", "lowdefy"):
+                parameters[(coils, attribute)] = deflections[attribute]
+
+        detector_rays, stops = self.propagate_sweep(parameters)
+
+        for component, rays, _ in stops:
+            if component is self.sample:
+                sample_rays = np.broadcast_to(rays, detector_rays.shape)
+
+        return detector_rays, sample_rays
+
+    def scan_4dstem_rows(self, row_start, row_stop, sample_image, out, flip_y=True):
+        """Form the detector images of a block of scan rows of a 4DSTEM scan.
+
+        Parameters
+        ----------
+        row_start : int
+            First scan row of the block
+        row_stop : int
+            Scan row after the last one of the block
+        sample_image : ndarray
+            Square image of the sample
+        out : ndarray
+            Array of shape (row_stop - row_start, scan_pixels, detector_pixels,
+            detector_pixels) to write the detector images into
+        flip_y : bool, optional
+            Flip the y axis of the sample and detector, by default True
+
+        Returns
+        -------
+        out : ndarray
+            Detector images of the block of scan rows
+        """
+        self.require_numpy("scan_4dstem_rows")
+
+        scan_pixel_y, scan_pixel_x = np.mgrid[row_start:row_stop, 0:self.scan_pixels]
+
+        detector_rays, sample_rays = self.trace_4dstem_positions(
+            scan_pixel_x.ravel(), scan_pixel_y.ravel()
+        )
+
+        get_sample_images_from_rays(
+            rays_x=detector_rays[:, 0, :],
+            rays_y=detector_rays[:, 2, :],
+            sample_rays_x=sample_rays[:, 0, :],
+            sample_rays_y=sample_rays[:, 2, :],
+            detector_size=self.detector_size,
+            detector_pixels=self.detector_pixels,
+            sample_size=self.sample.sample_size,
+            sample_pixels=sample_image.shape[0],
+            sample_image=sample_image,
+            flip_y=flip_y,
+            out=out.reshape((-1, self.detector_pixels, self.detector_pixels)),
+        )
+
+        return out
+
+    def get_4dstem_sample_image(self, sample_image=None):
+        """Get the image of the sample to use in a 4DSTEM scan
+
+        Parameters
+        ----------
+        sample_image : ndarray, optional
+            Square image of the sample. By default the image stored on the sample component
+            is used, or the test sample if there is none.
+
+        Returns
+        -------
+        sample_image : ndarray
+            Square image of the sample
+        """
+        if self.experiment != "4DSTEM":
+            raise ValueError("A 4DSTEM scan needs a model with experiment='4DSTEM'")
+
+        if sample_image is None:
+            sample_image = self.sample.sample
+        if sample_image is None:
+            sample_image = make_test_sample()
+
+        return sample_image
+
+    def run_4dstem_scan(
+        self, sample_image=None, batch_rows=16, dtype=np.float32, flip_y=True
+    ):
+        """Simulate a whole 4DSTEM scan, forming the detector image of the sample at every
+        scan position. Scan positions are traced together in batches of scan rows, so the
+        model is never stepped one position at a time. The scan and descan coils are left
+        unchanged. See write_4dstem_scan() for scans which do not fit in memory.
+
+        Parameters
+        ----------
+        sample_image : ndarray, optional
+            Square image of the sample. By default the image stored on the sample component
+            is used, or the test sample if there is none.
+        batch_rows : int, optional
+            Number of scan rows to trace at once, which sets the memory used for rays, by
+            default 16
+        dtype : data-type, optional
+            Data type of the datacube, by default np.float32
+        flip_y : bool, optional
+            Flip the y axis of the sample and detector, as in get_image_from_rays, by
+            default True
+
+        Returns
+        -------
+        datacube : ndarray
+            Detector images of shape (scan_pixels, scan_pixels, detector_pixels,
+            detector_pixels), indexed as [scan_y, scan_x, detector_y, detector_x]
+        """
+        self.require_numpy("run_4dstem_scan")
+
+        sample_image = self.get_4dstem_sample_image(sample_image)
+
+        datacube = np.zeros(
+            (
+                self.scan_pixels,
+                self.scan_pixels,
+                self.detector_pixels,
+                self.detector_pixels,
+            ),
+            dtype=dtype,
+        )
+
+        for row_start in range(0, self.scan_pixels, batch_rows):
+            row_stop = min(row_start + batch_rows, self.scan_pixels)
+            self.scan_4dstem_rows(
+                row_start,
+                row_stop,
+                sample_image,
+                out=datacube[row_start:row_stop],
+                flip_y=flip_y,
+            )
+
+        return datacube
+
+    def write_4dstem_scan(
+        self, path, sample_image=None, batch_rows=4, dtype=np.float32, flip_y=True
+    ):
+        """Simulate a whole 4DSTEM scan and stream it to disk as a .npy file, so that scans
+        much larger than memory can be simulated. Detector images are formed a few scan
+        rows at a time in a buffer, which is written into the memory mapped file and
+        flushed before the next rows are formed. The scan and detector geometry is written
+        next to it as a JSON sidecar file, see open_datacube() to read both back.
+
+        Parameters
+        ----------
+        path : str
+            Path of the .npy file to write the datacube to. The sidecar file is written to
+            the same path with a .json extension.
+        sample_image : ndarray, optional
+            Square image of the sample. By default the image stored on the sample component
+            is used, or the test sample if there is none.
+        batch_rows : int, optional
+            Number of scan rows held in memory at once, by default 4
+        dtype : data-type, optional
+            Data type of the datacube, by default np.float32
+        flip_y : bool, optional
+            Flip the y axis of the sample and detector, as in get_image_from_rays, by
+            default True
+
+        Returns
+        -------
+        datacube : np.memmap
+            Read only memory map of the datacube of shape (scan_pixels, scan_pixels,
+            detector_pixels, detector_pixels), indexed as
+            [scan_y, scan_x, detector_y, detector_x]
+        """
+        self.require_numpy("write_4dstem_scan")
+
+        sample_image = self.get_4dstem_sample_image(sample_image)
+
+        shape = (
+            self.scan_pixels,
+            self.scan_pixels,
+            self.detector_pixels,
+            self.detector_pixels,
+        )
+
+        datacube = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        buffer = np.zeros((batch_rows,) + shape[1:], dtype=dtype)
+
+        for row_start in range(0, self.scan_pixels, batch_rows):
+            row_stop = min(row_start + batch_rows, self.scan_pixels)
+            rows = row_stop - row_start
+
+            self.scan_4dstem_rows(
+                row_start, row_stop, sample_image, out=buffer[:rows], flip_y=flip_y
+            )
+            datacube[row_start:row_stop] = buffer[:rows]
+            datacube.flush()
+
+        del datacube
+
+        metadata = {
+            "axes": ["scan_y", "scan_x", "detector_y", "detector_x"],
+            "shape": [int(length) for length in shape],
+            "dtype": np.dtype(dtype).str,
+            "scan_pixels": int(self.scan_pixels),
+            "scan_size": float(self.sample.sample_size),
+            "scan_step": float(self.sample.sample_size / self.scan_pixels),
+            "scan_rotation": float(self.scan_coils.scan_rotation),
+            "detector_pixels": int(self.detector_pixels),
+            "detector_size": float(self.detector_size),
+            "detector_pixel_size": float(self.detector_size / self.detector_pixels),
+            "flip_y": bool(flip_y),
+            "overfocus": float(self.overfocus),
+            "semiconv": float(self.semiconv),
+            "num_rays": int(self.num_rays),
+        }
+        save_datacube_metadata(path, metadata)
+
+        datacube, _ = open_datacube(path)
+
+        return datacube
+
+    def run_4dstem_scan_parallel(
+        self,
+        sample_image=None,
+        max_workers=None,
+        tile_rows=4,
+        dtype=np.float32,
+        flip_y=True,
+        shm=None,
+    ):
+        """Simulate a whole 4DSTEM scan with a pool of worker processes, which write their
+        detector images directly into a datacube in shared memory.
+        See temgymlite.parallel.run_4dstem_scan_parallel for the parameters.
+
+        Returns
+        -------
+        datacube : ndarray
+            Detector images of shape (scan_pixels, scan_pixels, detector_pixels,
+            detector_pixels), indexed as [scan_y, scan_x, detector_y, detector_x]
+        """
+        self.require_numpy("run_4dstem_scan_parallel")
+
+        return run_4dstem_scan_parallel(
+            self,
+            sample_image=sample_image,
+            max_workers=max_workers,
+            tile_rows=tile_rows,
+            dtype=dtype,
+            flip_y=flip_y,
+            shm=shm,
+        )
+
     def update_scan_position(self):
 
         self.scan_pixel_x += 1
@@ -369,6 +1621,38 @@ class Model:
             if self.scan_pixel_y == self.scan_pixels:
                 self.scan_pixel_y = 0
 
+    @contextmanager
+    def profile(self, memory=True):
+        """Record the time spent in each part of every step while the context is open, e.g.
+
+            with model.profile() as profiler:
+                model.step()
+            profiler.get_stats()
+
+        Steps outside the context are not instrumented, and only check that there is no
+        profiler.
+
+        Parameters
+        ----------
+        memory : bool, optional
+            Also trace the memory allocated, which slows the tracer down, by default True
+
+        Yields
+        ------
+        profiler : Profiler
+            Events of every step, with the wall time, rays in and out and bytes allocated
+            of each component, see temgymlite.profiling.Profiler
+        """
+        profiler = Profiler(memory=memory)
+        previous_profiler, self.profiler = self.profiler, profiler
+
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            self.profiler = previous_profiler
+
     def step(self):
         """Master function that updates the matrices and perfroms ray propagation
 
@@ -378,12 +1662,99 @@ class Model:
             Returns the array of ray positions
         """
         # This method performs the computation of updating the matrices to their gui slider
-        # paramaters, and of moving the rays throgh the model.
+        # paramaters, and of moving the rays throgh the model. Only the rays below the first
+        # component which has changed since the last step need to be moved again.
+        profiler = self.profiler
+        if profiler is not None:
+            step_event = profiler.begin("step", "step", rays_in=self.num_rays)
+
+        if (
+            self.get_modified_counts() != self.traced_modified_counts
+            or self.beam_z != self.z_positions[0]
+        ):
+            self.update_z_positions()
+        start = self.get_retrace_start()
+
+        # Retracing needs the rays at the plane above the start component, so go back to
+        # the last component below a recorded plane
+        while start and self.plane_slots[self.component_plane_idcs[start] - 1] < 0:
+            start -= 1
+
         self.update_component_matrix()
-        self.update_rays_stepwise()
+        if start is not None:
+            if profiler is not None:
+                event = profiler.begin("trace", "trace", start=start)
+            self.update_rays_stepwise(start)
+            if profiler is not None:
+                profiler.end(event)
+
+        self.traced_modified_counts = self.get_modified_counts()
+        if self.xp is np:
+            self.traced_gun_rays = self.gun_rays.copy()
+        else:
+            self.traced_gun_rays = self.xp.asarray(self.gun_rays, copy=True)
+        self.traced_z_distances = self.z_distances
+
+        if profiler is not None:
+            profiler.end(
+                step_event, rays_out=int(np.count_nonzero(to_numpy(self.ray_fates) < 0))
+            )
+            profiler.num_steps += 1
 
         return self.r
 
+    def get_modified_counts(self):
+        """Get the count of changes to the parameters of every component
+
+        Returns
+        -------
+        list
+            Modified count of each component
+        """
+        return [component.modified_count for component in self.components]
+
+    def get_retrace_start(self):
+        """Find the first component which has been modified or moved since the rays were
+        last traced by step(), from the count of changes each component keeps of its
+        parameters and from the distances between components.
+
+        Returns
+        -------
+        start : int or None
+            Index of the first modified component, which is the number of components if
+            only the distance to the detector has changed. This is 0 if the rays have not
+            been traced yet or the rays leaving the gun have changed, and None if nothing
+            has changed.
+        """
+        if (
+            self.traced_modified_counts is None
+            or len(self.traced_modified_counts) != len(self.components)
+            or self.traced_z_distances.shape != self.z_distances.shape
+            or not np.array_equal(to_numpy(self.gun_rays), to_numpy(self.traced_gun_rays))
+        ):
+            return 0
+
+        start = None
+        for idx, component in enumerate(self.components):
+            if component.modified_count != self.traced_modified_counts[idx]:
+                start = idx
+                break
+
+        # The gap above ray plane idx + 1 has changed, so retrace from the component
+        # that plane belongs to
+        changed_gaps = np.flatnonzero(self.z_distances != self.traced_z_distances)
+        if len(changed_gaps) != 0:
+            z_start = (
+                np.searchsorted(
+                    self.component_plane_idcs, changed_gaps[0] + 1, side="right"
+                )
+                - 1
+            )
+            if start is None or z_start < start:
+                start = int(z_start)
+
+        return start
+
     # Propagation matrix used by the model to propagate rays between components
     def propagate(self, z):
         """Propagation matrix
@@ -410,3 +1781,90 @@ class Model:
         )
 
         return matrix
+
+    def get_propagation_matrices(self, z_distances):
+        """Build the propagation matrices for every distance between planes at once
+
+        Parameters
+        ----------
+        z_distances : ndarray
+            Distances to propagate rays
+
+        Returns
+        -------
+        ndarray
+            Propagation matrices of shape (len(z_distances), 5, 5)
+        """
+        matrices = np.zeros((len(z_distances), 5, 5))
+        matrices[:, np.arange(5), np.arange(5)] = 1
+        matrices[:, 0, 1] = z_distances
+        matrices[:, 2, 3] = z_distances
+
+        return matrices
+
+    def get_system_matrix(self, start="gun", end="detector"):
+        """Compose the transfer matrix which carries rays between two planes of the column,
+        from the component matrices and propagate(), without tracing any rays.
+        See temgymlite.paraxial.get_system_matrix for the parameters.
+
+        Returns
+        -------
+        matrix : ndarray
+            Transfer matrix of shape (5, 5)
+        """
+        return get_system_matrix(self, start=start, end=end)
+
+    def solve_paraxial(self, start="gun", end="detector", parallel=None):
+        """Solve the focal and principal planes, magnification, rotation, camera length and
+        crossovers of the column between two planes, without tracing any rays.
+        See temgymlite.paraxial.solve_paraxial for the parameters.
+
+        Returns
+        -------
+        solution : dict
+            Paraxial properties of the column between the two planes
+        """
+        return solve_paraxial(self, start=start, end=end, parallel=parallel)
+
+    def get_ray_jacobian(self, parameters, plane="detector"):
+        """Step the model, and get the rays at a plane and their derivatives with respect to
+        the parameters of components. See temgymlite.optimize.get_ray_jacobian for the
+        parameters.
+
+        Returns
+        -------
+        rays : ndarray
+            Ray positions and slopes at the plane of shape (5, num_rays)
+        jacobian : ndarray
+            Derivatives of the rays of shape (parameters, 5, num_rays)
+        alive : ndarray
+            Boolean array which is True for rays which reach the plane
+        """
+        self.require_numpy("get_ray_jacobian")
+
+        return get_ray_jacobian(self, parameters, plane=plane)
+
+    def optimize(self, parameters, residuals, max_iterations=20, tolerance=1e-10, damping=1e-3):
+        """Adjust the parameters of components to minimise residuals by least squares, e.g.
+        to focus the probe on the sample:
+
+            from temgymlite.optimize import spot_residuals
+            model.optimize(["Objective Lens.f"], spot_residuals("Sample"))
+
+        See temgymlite.optimize.least_squares for the parameters.
+
+        Returns
+        -------
+        result : dict
+            Final values of the parameters, cost and number of iterations
+        """
+        self.require_numpy("optimize")
+
+        return least_squares(
+            self,
+            parameters,
+            residuals,
+            max_iterations=max_iterations,
+            tolerance=tolerance,
+            damping=damping,
+        )
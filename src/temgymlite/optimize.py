@@ -0,0 +1,490 @@
+"""Derivatives of the rays and the paraxial properties of a model with respect to the parameters
+of its components, and a least squares optimiser which uses them, e.g. to focus the probe on the
+sample, correct astigmatism or align the beam through an aperture.
+
+Every linear component is an affine map of the rays, so the derivative of the rays at a plane
+with respect to a parameter is the derivative of that component's matrix, applied to the rays
+arriving at it and carried on to the plane by the matrices below it. Biprisms and apertures act
+on each ray through its own side of them, which is kept as it is, so the derivatives hold for as
+long as no ray crosses a wire or the edge of an aperture. Their own parameters cannot be
+differentiated."""
+
+import numpy as np
+
+from temgymlite.paraxial import find_plane, get_crossovers, get_plane_matrices
+
+
+def get_parameter_keys(model, parameters):
+    """Find the components of the parameters to differentiate
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+
+    Returns
+    -------
+    keys : list
+        List of (component, attribute) of every parameter
+    """
+    keys = []
+    for key in parameters:
+        if isinstance(key, str):
+            name, attribute = key.rsplit(".", 1)
+            component = model.find_component(name)
+        else:
+            component, attribute = key
+
+        if not hasattr(component, attribute):
+            raise AttributeError(
+                f"Component '{component.name}' has no parameter '{attribute}' to differentiate"
+            )
+        if not component.linear:
+            raise ValueError(
+                f"Component '{component.name}' is not linear, so its parameters cannot be "
+                "differentiated"
+            )
+
+        keys.append((component, attribute))
+
+    if not keys:
+        raise ValueError("No parameters to differentiate")
+
+    return keys
+
+
+def _get_parameter_derivatives(model, keys):
+    """Get the plane and matrix derivative of every plane which depends on each parameter
+
+    Returns
+    -------
+    derivatives : list
+        List of (plane index, matrix derivative) pairs for each parameter
+    """
+    derivatives = []
+    for component, attribute in keys:
+        plane = model.component_plane_idcs[model.components.index(component)]
+        derivatives.append(
+            [
+                (plane + plane_offset, derivative)
+                for plane_offset, derivative in enumerate(
+                    component.get_matrix_derivatives(attribute)
+                )
+                if np.any(derivative)
+            ]
+        )
+
+    return derivatives
+
+
+def _get_matrices_to(model, matrices, end_idx, end_dz):
+    """Get the transfer matrix from just after every plane down to a plane
+
+    Returns
+    -------
+    to_end : ndarray
+        Transfer matrices of shape (planes, 5, 5), which are zero for planes below the end
+    """
+    to_end = np.zeros((len(matrices), 5, 5))
+    to_end[end_idx] = model.propagate(end_dz)
+    for idx in range(end_idx - 1, -1, -1):
+        to_end[idx] = to_end[idx + 1] @ matrices[idx + 1] @ model.propagate(
+            model.z_distances[idx]
+        )
+
+    return to_end
+
+
+def get_matrix_jacobian(model, parameters, start="gun", end="detector"):
+    """Get the system matrix between two planes and its derivatives with respect to the
+    parameters of components, without tracing any rays, see
+    temgymlite.paraxial.get_system_matrix()
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+    start : str or float, optional
+        Plane the system starts at, by default 'gun'
+    end : str or float, optional
+        Plane the system ends at, by default 'detector'
+
+    Returns
+    -------
+    matrix : ndarray
+        System matrix of shape (5, 5)
+    jacobian : ndarray
+        Derivative of the system matrix with respect to each parameter, of shape
+        (parameters, 5, 5)
+    """
+    keys = get_parameter_keys(model, parameters)
+    matrices = get_plane_matrices(model)
+    start_idx, start_dz = find_plane(model, start)
+    end_idx, end_dz = find_plane(model, end)
+
+    to_end = _get_matrices_to(model, matrices, end_idx, end_dz)
+
+    # Transfer matrices from the start to just before the component of every plane below it
+    from_start = np.zeros((len(matrices), 5, 5))
+    matrix = model.propagate(-start_dz)
+    for idx in range(start_idx + 1, end_idx + 1):
+        from_start[idx] = model.propagate(model.z_distances[idx - 1]) @ matrix
+        matrix = matrices[idx] @ from_start[idx]
+
+    jacobian = np.zeros((len(keys), 5, 5))
+    for param_idx, derivatives in enumerate(_get_parameter_derivatives(model, keys)):
+        for plane, derivative in derivatives:
+            if start_idx < plane <= end_idx:
+                jacobian[param_idx] += to_end[plane] @ derivative @ from_start[plane]
+
+    return model.propagate(end_dz) @ matrix, jacobian
+
+
+def get_ray_jacobian(model, parameters, plane="detector"):
+    """Trace the rays through the model, and get their derivatives at a plane with respect to
+    the parameters of components
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+    plane : str or float, optional
+        'gun', 'detector', the name of a component or a z position, by default 'detector'
+
+    Returns
+    -------
+    rays : ndarray
+        Ray positions and slopes at the plane of shape (5, num_rays)
+    jacobian : ndarray
+        Derivative of the rays with respect to each parameter, of shape
+        (parameters, 5, num_rays)
+    alive : ndarray
+        Boolean array of shape (num_rays,) which is True for rays which reach the plane
+    """
+    keys = get_parameter_keys(model, parameters)
+    r = np.asarray(model.step_all_planes(), dtype=np.float64)
+    if r.shape[1] == 4:
+        # Compact rays have no row of ones
+        r = np.concatenate([r, np.ones_like(r[:, :1])], axis=1)
+
+    matrices = get_plane_matrices(model)
+    idx, dz = find_plane(model, plane)
+    to_end = _get_matrices_to(model, matrices, idx, dz)
+
+    jacobian = np.zeros((len(keys),) + r.shape[1:])
+    for param_idx, derivatives in enumerate(_get_parameter_derivatives(model, keys)):
+        for component_plane, derivative in derivatives:
+            if component_plane > idx:
+                continue
+
+            # Rays arriving at the plane of the component, before it acts on them
+            arriving = model.propagate(model.z_distances[component_plane - 1]) @ r[
+                component_plane - 1
+            ]
+            jacobian[param_idx] += to_end[component_plane] @ derivative @ arriving
+
+    fates = model.ray_fates
+    component_planes = np.asarray(model.component_plane_idcs)[fates]
+    alive = ((fates < 0) | (component_planes > idx)) & ~np.isnan(r[idx, 0])
+
+    return model.propagate(dz) @ r[idx], jacobian, alive
+
+
+def get_spot_jacobian(model, parameters, plane="detector"):
+    """Get the root mean square radius of the spot of rays at a plane about their centre,
+    and its derivatives with respect to the parameters of components
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+    plane : str or float, optional
+        Plane of the spot, by default 'detector'
+
+    Returns
+    -------
+    rms : float
+        Root mean square distance of the rays which reach the plane from their centre
+    jacobian : ndarray
+        Derivative of rms with respect to each parameter, of shape (parameters,)
+    """
+    residuals, jacobian = spot_residuals(plane)(model, parameters)
+
+    rms = np.sqrt(residuals @ residuals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return rms, jacobian.T @ residuals / rms
+
+
+def get_crossover_jacobian(model, parameters, start="gun", end="detector", parallel=None):
+    """Get the z position of every crossover of a plane, and its derivatives with respect to
+    the parameters of components, without tracing any rays, see
+    temgymlite.paraxial.get_crossovers()
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+    start : str or float, optional
+        Plane to find the crossovers of, by default 'gun'
+    end : str or float, optional
+        Plane to search down to, by default 'detector'
+    parallel : bool, optional
+        Find where parallel rays meet instead of rays from a point, by default this
+        follows the beam type of the model for crossovers of the gun
+
+    Returns
+    -------
+    crossovers : ndarray
+        z positions of the crossovers, from the top of the column down
+    jacobian : ndarray
+        Derivative of the z position of each crossover with respect to each parameter, of
+        shape (parameters, crossovers)
+    """
+    if parallel is None:
+        parallel = start == "gun" and model.beam_type.startswith("paralell")
+
+    crossovers = get_crossovers(model, start, end, parallel)
+    columns = [0, 2] if parallel else [1, 3]
+
+    jacobian = np.zeros((len(parameters), len(crossovers)))
+    for crossover_idx, z in enumerate(crossovers):
+        matrix, matrix_jacobian = get_matrix_jacobian(model, parameters, start, z)
+        block = matrix[np.ix_([0, 2], columns)]
+        slope_block = matrix[np.ix_([1, 3], columns)]
+        block_jacobian = matrix_jacobian[:, [[0], [2]], columns]
+
+        # The crossover is where det(block + dz * slope_block) = 0. At a round crossover the
+        # whole block vanishes, and both axes move together.
+        if np.max(np.abs(block)) <= 1e-9 * np.max(np.abs(slope_block)):
+            weights = np.eye(2)
+        else:
+            weights = np.array([[block[1, 1], -block[0, 1]], [-block[1, 0], block[0, 0]]])
+
+        jacobian[:, crossover_idx] = -np.trace(
+            weights @ block_jacobian, axis1=1, axis2=2
+        ) / np.trace(weights @ slope_block)
+
+    return crossovers, jacobian
+
+
+def spot_residuals(plane="detector", weight=1.0):
+    """Residuals which are smallest when the rays at a plane meet in a point, e.g. to focus
+    the probe on the sample or correct astigmatism. Their sum of squares is the mean square
+    distance of the rays from their centre.
+
+    Parameters
+    ----------
+    plane : str or float, optional
+        Plane of the spot, by default 'detector'
+    weight : float, optional
+        Weight of the residuals, by default 1.0
+
+    Returns
+    -------
+    residuals : callable
+        Function of (model, parameters) which returns the residuals and their Jacobian of
+        shape (residuals, parameters), see least_squares()
+    """
+
+    def residuals(model, parameters):
+        rays, jacobian, alive = get_ray_jacobian(model, parameters, plane)
+        num_alive = max(np.count_nonzero(alive), 1)
+
+        positions = rays[[0, 2]][:, alive]
+        position_jacobian = jacobian[:, [0, 2]][:, :, alive]
+
+        centred = positions - positions.mean(axis=-1, keepdims=True)
+        centred_jacobian = position_jacobian - position_jacobian.mean(axis=-1, keepdims=True)
+
+        scale = weight / np.sqrt(num_alive)
+        return (
+            scale * centred.ravel(),
+            scale * centred_jacobian.reshape(len(jacobian), -1).T,
+        )
+
+    return residuals
+
+
+def centre_residuals(plane, x=0.0, y=0.0, weight=1.0):
+    """Residuals which are smallest when the centre of the rays at a plane is at a point, e.g.
+    to align the beam through the centre of an aperture
+
+    Parameters
+    ----------
+    plane : str or float
+        Plane to centre the rays at, e.g. the name of an aperture
+    x : float, optional
+        x position to centre the rays at, by default 0.0
+    y : float, optional
+        y position to centre the rays at, by default 0.0
+    weight : float, optional
+        Weight of the residuals, by default 1.0
+
+    Returns
+    -------
+    residuals : callable
+        Function of (model, parameters) which returns the residuals and their Jacobian of
+        shape (residuals, parameters), see least_squares()
+    """
+
+    def residuals(model, parameters):
+        rays, jacobian, alive = get_ray_jacobian(model, parameters, plane)
+
+        centre = rays[[0, 2]][:, alive].mean(axis=-1)
+        centre_jacobian = jacobian[:, [0, 2]][:, :, alive].mean(axis=-1)
+
+        return weight * (centre - [x, y]), weight * centre_jacobian.T
+
+    return residuals
+
+
+def crossover_residuals(z, start="gun", parallel=None, weight=1.0):
+    """Residuals which are smallest when the crossover of a plane nearest to z lies at z, e.g.
+    to set the probe crossover a given overfocus above the sample. These need no rays.
+
+    Parameters
+    ----------
+    z : float
+        z position to move the crossover to
+    start : str or float, optional
+        Plane to find the crossovers of, by default 'gun'
+    parallel : bool, optional
+        Find where parallel rays meet, see get_crossovers()
+    weight : float, optional
+        Weight of the residuals, by default 1.0
+
+    Returns
+    -------
+    residuals : callable
+        Function of (model, parameters) which returns the residuals and their Jacobian of
+        shape (residuals, parameters), see least_squares()
+    """
+
+    def residuals(model, parameters):
+        crossovers, jacobian = get_crossover_jacobian(
+            model, parameters, start, parallel=parallel
+        )
+        if len(crossovers) == 0:
+            raise ValueError(f"There is no crossover of plane {start!r} to move to z = {z}")
+
+        nearest = np.argmin(np.abs(crossovers - z))
+
+        return weight * (crossovers[[nearest]] - z), weight * jacobian[:, [nearest]].T
+
+    return residuals
+
+
+def least_squares(
+    model, parameters, residuals, max_iterations=20, tolerance=1e-10, damping=1e-3
+):
+    """Adjust the parameters of components to minimise the sum of squares of residuals with
+    the Levenberg-Marquardt method, using their analytic Jacobians. The components are left
+    with the best parameters found, e.g.
+
+        least_squares(model, ["Objective Lens.f"], [spot_residuals("Sample")])
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    parameters : list
+        List of "Component Name.attribute" or (component, "attribute") parameters
+    residuals : callable or list
+        Function, or list of functions, of (model, parameters) which return residuals and
+        their Jacobian of shape (residuals, parameters), such as spot_residuals(),
+        centre_residuals() and crossover_residuals()
+    max_iterations : int, optional
+        Most iterations to take, by default 20
+    tolerance : float, optional
+        Stop when an iteration lowers the sum of squares by less than this fraction of it,
+        by default 1e-10
+    damping : float, optional
+        Initial damping of the Levenberg-Marquardt steps, by default 1e-3
+
+    Returns
+    -------
+    result : dict
+        Dictionary with the final "values" of the parameters, the sum of squares "cost", its
+        "history" over the iterations, the number of "iterations" and "evaluations" of the
+        residuals, the "status", which is 1 if an iteration lowered the sum of squares by
+        less than the tolerance, 0 if max_iterations was reached first, and -1 if no step
+        lowered the sum of squares, and whether it "converged", i.e. the status is 1
+    """
+    keys = get_parameter_keys(model, parameters)
+    if callable(residuals):
+        residuals = [residuals]
+
+    def evaluate():
+        results = [function(model, keys) for function in residuals]
+        return (
+            np.concatenate([result[0] for result in results]),
+            np.concatenate([result[1] for result in results]),
+        )
+
+    def set_values(values):
+        for (component, attribute), value in zip(keys, values):
+            setattr(component, attribute, float(value))
+
+    values = np.array([getattr(component, attribute) for component, attribute in keys])
+    r, jacobian = evaluate()
+    cost = r @ r
+
+    history = [float(cost)]
+    evaluations = 1
+    status = 0
+    iteration = 0
+    while iteration < max_iterations and status == 0:
+        iteration += 1
+
+        gradient = jacobian.T @ r
+        normal = jacobian.T @ jacobian
+        scale = np.maximum(np.diag(normal), 1e-12 * max(np.max(np.diag(normal)), 1e-300))
+
+        # Raise the damping until a step lowers the cost
+        while True:
+            step = -np.linalg.solve(normal + damping * np.diag(scale), gradient)
+            set_values(values + step)
+            new_r, new_jacobian = evaluate()
+            evaluations += 1
+            new_cost = new_r @ new_r
+
+            if new_cost <= cost:
+                damping = max(damping / 10, 1e-12)
+                break
+
+            damping *= 10
+            if damping > 1e12:
+                break
+
+        if new_cost > cost:
+            set_values(values)
+            status = -1
+            break
+
+        if cost - new_cost <= tolerance * cost:
+            status = 1
+        values, r, jacobian, cost = values + step, new_r, new_jacobian, new_cost
+        history.append(float(cost))
+
+    return {
+        "values": {
+            f"{component.name}.{attribute}": float(value)
+            for (component, attribute), value in zip(keys, values)
+        },
+        "cost": float(cost),
+        "history": history,
+        "iterations": iteration,
+        "evaluations": evaluations,
+        "status": status,
+        "converged": status > 0,
+    }
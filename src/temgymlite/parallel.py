@@ -0,0 +1,156 @@
+"""Runs a 4DSTEM scan over many processes. Scan positions are independent, so the scan is split
+into tiles of scan rows, and every worker process forms the detector images of its tiles with its
+own copy of the model, writing them straight into a datacube in shared memory."""
+
+import numpy as np
+
+# State of each worker process, set once by _init_worker so that it is not pickled for every tile
+_worker = {}
+
+
+def _init_worker(model, sample_image, flip_y, shared_memory_name, shape, dtype):
+    """Set up a worker process with its own copy of the model, attached to the shared datacube
+
+    Parameters
+    ----------
+    model : Model
+        Pickled copy of the 4DSTEM model
+    sample_image : ndarray
+        Square image of the sample
+    flip_y : bool
+        Flip the y axis of the sample and detector
+    shared_memory_name : str
+        Name of the shared memory block of the datacube
+    shape : tuple
+        Shape of the datacube
+    dtype : data-type
+        Data type of the datacube
+    """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shared_memory_name)
+
+    _worker["model"] = model
+    _worker["sample_image"] = sample_image
+    _worker["flip_y"] = flip_y
+    _worker["shm"] = shm
+    _worker["datacube"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _scan_tile(tile):
+    """Form the detector images of one tile of scan rows in a worker process
+
+    Parameters
+    ----------
+    tile : tuple
+        First scan row of the tile, and the scan row after its last one
+
+    Returns
+    -------
+    tile : tuple
+        The tile that has been written to the datacube
+    """
+    row_start, row_stop = tile
+
+    _worker["model"].scan_4dstem_rows(
+        row_start,
+        row_stop,
+        _worker["sample_image"],
+        out=_worker["datacube"][row_start:row_stop],
+        flip_y=_worker["flip_y"],
+    )
+
+    return tile
+
+
+def run_4dstem_scan_parallel(
+    model,
+    sample_image=None,
+    max_workers=None,
+    tile_rows=4,
+    dtype=np.float32,
+    flip_y=True,
+    shm=None,
+):
+    """Simulate a whole 4DSTEM scan with a pool of worker processes. The model is pickled once
+    per worker, and the workers write their detector images directly into a datacube in shared
+    memory, so no images are sent back through pickles.
+
+    Parameters
+    ----------
+    model : Model
+        Model with experiment='4DSTEM'
+    sample_image : ndarray, optional
+        Square image of the sample. By default the image stored on the sample component is
+        used, or the test sample if there is none.
+    max_workers : int, optional
+        Number of worker processes, by default the number of CPUs
+    tile_rows : int, optional
+        Number of scan rows in each tile handed to a worker, by default 4
+    dtype : data-type, optional
+        Data type of the datacube, by default np.float32
+    flip_y : bool, optional
+        Flip the y axis of the sample and detector, as in get_image_from_rays, by default True
+    shm : multiprocessing.shared_memory.SharedMemory, optional
+        Shared memory block to write the datacube into, which must be at least as large as the
+        datacube. The returned datacube is then a view of this block, and the caller is
+        responsible for closing and unlinking it. By default a block is created, copied into a
+        regular array and released.
+
+    Returns
+    -------
+    datacube : ndarray
+        Detector images of shape (scan_pixels, scan_pixels, detector_pixels, detector_pixels),
+        indexed as [scan_y, scan_x, detector_y, detector_x]
+    """
+    # The process pool is only loaded when a scan is run, which keeps importing the package
+    # quick for short lived processes
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    sample_image = model.get_4dstem_sample_image(sample_image)
+
+    shape = (
+        model.scan_pixels,
+        model.scan_pixels,
+        model.detector_pixels,
+        model.detector_pixels,
+    )
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    owns_shm = shm is None
+    if owns_shm:
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    elif shm.size < nbytes:
+        raise ValueError(
+            f"Shared memory block of {shm.size} bytes is too small for a datacube of "
+            f"{nbytes} bytes"
+        )
+
+    datacube = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    try:
+        tiles = [
+            (row_start, min(row_start + tile_rows, model.scan_pixels))
+            for row_start in range(0, model.scan_pixels, tile_rows)
+        ]
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(model, sample_image, flip_y, shm.name, shape, dtype),
+        ) as executor:
+            # Consume the results so that any error in a worker is raised here
+            for _ in executor.map(_scan_tile, tiles):
+                pass
+
+        if owns_shm:
+            return datacube.copy()
+
+        return datacube
+    finally:
+        if owns_shm:
+            # The view of the block has to be released before the block can be closed
+            del datacube
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,361 @@
+"""Paraxial properties of a model found directly from the transfer matrices of its components and
+the propagation between them, without tracing any rays: the system matrix between two planes, its
+focal and principal planes, the magnification and rotation of the image, and the z position of
+every crossover. Each needs one matrix product per plane of the column, so they are cheap enough
+to evaluate inside an optimisation loop.
+
+The beam travels down the column towards smaller z, and focal lengths follow the sign convention
+of the lenses, where a converging lens has a negative focal length."""
+
+import numpy as np
+
+
+def get_plane_matrices(model):
+    """Get the transfer matrix of every ray plane of a model, with the current parameters of
+    its components
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+
+    Returns
+    -------
+    matrices : ndarray
+        Transfer matrices of shape (planes, 5, 5). The gun and detector planes have identity
+        matrices, and components which are not linear, such as biprisms, only contribute the
+        linear part of their matrix, as their deflection depends on the side of the ray.
+    """
+    model.update_z_positions()
+    model.update_component_matrix()
+
+    matrices = np.empty((len(model.z_positions), 5, 5))
+    matrices[0] = matrices[-1] = np.eye(5)
+    matrices[1:-1] = model.components_matrix
+
+    for idx, component in enumerate(model.components):
+        if not component.linear:
+            start, stop = model.component_plane_idcs[idx], model.component_plane_idcs[idx + 1]
+            matrices[start:stop, :4, 4] = 0
+
+    return matrices
+
+
+def find_plane(model, plane):
+    """Find where a plane lies in the column
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    plane : str or float
+        'gun', 'detector', the name of a component, or any z position between the gun and the
+        detector. The plane of a component lies just after it, after its last plane for a
+        double deflector.
+
+    Returns
+    -------
+    idx : int
+        Index of the last ray plane at or above the plane
+    dz : float
+        Distance in z from that ray plane to the plane, which is zero or negative
+    """
+    z_positions = model.z_positions
+
+    if isinstance(plane, str):
+        if plane == "gun":
+            return 0, 0.0
+        if plane == "detector":
+            return len(z_positions) - 1, 0.0
+
+        idx = model.components.index(model.find_component(plane))
+        return model.component_plane_idcs[idx + 1] - 1, 0.0
+
+    if not min(z_positions[0], z_positions[-1]) <= plane <= max(z_positions[0], z_positions[-1]):
+        raise ValueError(f"z = {plane} is outside of the column")
+
+    # The last plane at or above z, counting a plane at z itself
+    idx = 0
+    for plane_idx, z in enumerate(z_positions):
+        if z >= plane or np.isclose(z, plane):
+            idx = plane_idx
+
+    dz = plane - z_positions[idx]
+    if np.isclose(dz, 0):
+        dz = 0.0
+
+    return idx, dz
+
+
+def get_system_matrix(model, start="gun", end="detector"):
+    """Compose the transfer matrix which carries rays from one plane of the column to another
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    start : str or float, optional
+        Plane the rays start from, 'gun', 'detector', the name of a component or a z
+        position, by default 'gun'
+    end : str or float, optional
+        Plane the rays end at, which must not lie above start, by default 'detector'
+
+    Returns
+    -------
+    matrix : ndarray
+        Transfer matrix of shape (5, 5)
+    """
+    matrices = get_plane_matrices(model)
+    start_idx, start_dz = find_plane(model, start)
+    end_idx, end_dz = find_plane(model, end)
+
+    # Planes further down the column have larger indices, and larger distances below them
+    if (end_idx, -end_dz) < (start_idx, -start_dz):
+        raise ValueError(f"Plane {end!r} lies above plane {start!r}")
+
+    # Go back from the start to the ray plane above it, then through every plane to the end
+    matrix = model.propagate(-start_dz)
+    for idx in range(start_idx + 1, end_idx + 1):
+        matrix = matrices[idx] @ model.propagate(model.z_distances[idx - 1]) @ matrix
+
+    return model.propagate(end_dz) @ matrix
+
+
+def get_cardinal_planes(matrix, z_start, z_end):
+    """Find the focal length and the z position of the focal and principal planes of a system,
+    for the x and y axes separately
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Transfer matrix of the system, see get_system_matrix()
+    z_start : float
+        z position of the plane the system starts at
+    z_end : float
+        z position of the plane the system ends at
+
+    Returns
+    -------
+    cardinal_planes : dict
+        Dictionary of arrays of the (x, y) values of "focal_length", "front_focal_plane",
+        "back_focal_plane", "front_principal_plane" and "back_principal_plane". A system
+        without focusing power has an infinite focal length and NaN planes.
+    """
+    axes = [0, 2]
+    a = matrix[axes, axes]
+    c = matrix[[1, 3], axes]
+    d = matrix[[1, 3], [1, 3]]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        focal_length = -1 / c
+        front_focal_plane = z_start + d / c
+        back_focal_plane = z_end - a / c
+        front_principal_plane = z_start + (d - 1) / c
+        back_principal_plane = z_end + (1 - a) / c
+
+    no_power = c == 0
+    focal_length[no_power] = np.inf
+    for planes in (
+        front_focal_plane,
+        back_focal_plane,
+        front_principal_plane,
+        back_principal_plane,
+    ):
+        planes[no_power] = np.nan
+
+    return {
+        "focal_length": focal_length,
+        "front_focal_plane": front_focal_plane,
+        "back_focal_plane": back_focal_plane,
+        "front_principal_plane": front_principal_plane,
+        "back_principal_plane": back_principal_plane,
+    }
+
+
+def get_magnification(matrix):
+    """Split the positional part of a transfer matrix into a rotation about the optic axis and
+    a magnification along the rotated x and y axes. The magnification is only that of an image
+    if the system images its start plane onto its end plane, see get_crossovers().
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Transfer matrix of the system, see get_system_matrix()
+
+    Returns
+    -------
+    magnification : ndarray
+        Magnification along x and y, negative for an inverted image
+    rotation : float
+        Rotation of the image in degrees, between -90 and 90, as scan_rotation
+    """
+    position = matrix[np.ix_([0, 2], [0, 2])]
+
+    rotation = np.arctan2(position[1, 0] - position[0, 1], position[0, 0] + position[1, 1])
+
+    # An inverted image is a rotation by 180 degrees, which we count as negative magnification
+    if rotation > np.pi / 2:
+        rotation -= np.pi
+    elif rotation <= -np.pi / 2:
+        rotation += np.pi
+
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    unrotated = np.array([[cos, sin], [-sin, cos]]) @ position
+
+    return np.diag(unrotated).copy(), float(np.degrees(rotation))
+
+
+def _get_block_roots(block, slope_block):
+    """Find the distances d at which block + d * slope_block is singular
+
+    Parameters
+    ----------
+    block : ndarray
+        2x2 block of the positions at the start of a gap
+    slope_block : ndarray
+        2x2 block of the slopes at the start of a gap
+
+    Returns
+    -------
+    roots : list
+        Real distances, with a double root given once
+    """
+    # det(block + d * slope_block) is a quadratic in d
+    quadratic = np.linalg.det(slope_block)
+    linear = (
+        block[0, 0] * slope_block[1, 1]
+        + slope_block[0, 0] * block[1, 1]
+        - block[0, 1] * slope_block[1, 0]
+        - slope_block[0, 1] * block[1, 0]
+    )
+    constant = np.linalg.det(block)
+
+    scale = np.max(np.abs(slope_block)) ** 2
+    if abs(quadratic) <= 1e-12 * scale:
+        if linear == 0:
+            return []
+        return [-constant / linear]
+
+    discriminant = linear**2 - 4 * quadratic * constant
+
+    # A round crossover is a double root, which rounding can push slightly below zero
+    if abs(discriminant) <= 1e-9 * linear**2:
+        return [-linear / (2 * quadratic)]
+    if discriminant < 0:
+        return []
+
+    root = np.sqrt(discriminant)
+    return [(-linear - root) / (2 * quadratic), (-linear + root) / (2 * quadratic)]
+
+
+def get_crossovers(model, start="gun", end="detector", parallel=None):
+    """Find the z position of every crossover between two planes of the column, where rays
+    which leave one point of the start plane meet again, i.e. the planes conjugate to it. For
+    a parallel beam, the crossovers are where rays which are parallel at the start plane meet.
+
+    A round crossover is found once. An astigmatic crossover, e.g. after a quadrupole, is
+    found as two line crossovers, one where rays meet along x and one where they meet along y.
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    start : str or float, optional
+        Plane to find the crossovers of, by default 'gun'. The image planes of a sample are
+        the crossovers of its plane, e.g. start='Sample'.
+    end : str or float, optional
+        Plane to search down to, by default 'detector'
+    parallel : bool, optional
+        Find where parallel rays meet instead of rays from a point. By default this follows
+        the beam type of the model, for crossovers of the gun.
+
+    Returns
+    -------
+    crossovers : ndarray
+        z positions of the crossovers, from the top of the column down
+    """
+    if parallel is None:
+        parallel = start == "gun" and model.beam_type.startswith("paralell")
+
+    matrices = get_plane_matrices(model)
+    start_idx, start_dz = find_plane(model, start)
+    end_idx, end_dz = find_plane(model, end)
+
+    z_positions = model.z_positions
+    z_start = z_positions[start_idx] + start_dz
+    tolerance = 1e-9 * max(abs(z_positions[0] - z_positions[-1]), 1)
+
+    # Rays from a point differ only in slope, parallel rays only in position
+    columns = [0, 2] if parallel else [1, 3]
+
+    crossovers = []
+    matrix = model.propagate(-start_dz)
+    for idx in range(start_idx, end_idx + 1):
+        if idx > start_idx:
+            matrix = matrices[idx] @ model.propagate(model.z_distances[idx - 1]) @ matrix
+
+        # The gap below each plane is searched up to, but not including, the next plane,
+        # which starts the next gap. The last gap includes the end plane.
+        gap_start = start_dz if idx == start_idx else 0.0
+        if idx == end_idx:
+            gap_end = end_dz
+        else:
+            gap_end = model.z_distances[idx]
+
+        roots = _get_block_roots(
+            matrix[np.ix_([0, 2], columns)], matrix[np.ix_([1, 3], columns)]
+        )
+        for dz in roots:
+            z = z_positions[idx] + dz
+            if abs(z - z_start) <= tolerance and not parallel:
+                # Every ray from a point of the start plane meets there
+                continue
+            if idx != end_idx and abs(dz - gap_end) <= tolerance:
+                continue
+            if min(gap_start, gap_end) - tolerance <= dz <= max(gap_start, gap_end) + tolerance:
+                crossovers.append(z)
+
+    return np.array(sorted(crossovers, reverse=True))
+
+
+def solve_paraxial(model, start="gun", end="detector", parallel=None):
+    """Solve the paraxial properties of the column between two planes, without rays
+
+    Parameters
+    ----------
+    model : Model
+        Model of the column
+    start : str or float, optional
+        Plane the system starts at, by default 'gun'
+    end : str or float, optional
+        Plane the system ends at, by default 'detector'
+    parallel : bool, optional
+        Find the crossovers of parallel rays, see get_crossovers()
+
+    Returns
+    -------
+    solution : dict
+        Dictionary with the system "matrix", the (x, y) arrays of get_cardinal_planes(),
+        the "magnification" and "rotation" at the end plane, see get_magnification(), the
+        (x, y) "camera_length", which is the distance from the axis at the end plane per
+        unit angle at the start plane, and the z positions of the "crossovers"
+    """
+    matrix = get_system_matrix(model, start, end)
+
+    start_idx, start_dz = find_plane(model, start)
+    end_idx, end_dz = find_plane(model, end)
+    z_start = model.z_positions[start_idx] + start_dz
+    z_end = model.z_positions[end_idx] + end_dz
+
+    solution = {"matrix": matrix}
+    solution.update(get_cardinal_planes(matrix, z_start, z_end))
+
+    magnification, rotation = get_magnification(matrix)
+    solution["magnification"] = magnification
+    solution["rotation"] = rotation
+
+    # Slopes are taken along z, and the beam travels towards smaller z
+    solution["camera_length"] = -matrix[[0, 2], [1, 3]]
+    solution["crossovers"] = get_crossovers(model, start, end, parallel)
+
+    return solution
@@ -0,0 +1,200 @@
+"""Opt-in instrumentation of the tracer. While a Profiler is attached to a model, see
+Model.profile(), every step records the wall time of rebuilding each component matrix and of
+carrying the rays through each component, with the number of rays arriving at and leaving it and
+the memory allocated on the way. Without a profiler the tracer only checks that there is none."""
+
+import json
+import time
+import tracemalloc
+
+
+class Profiler:
+    """Events recorded while tracing a model, which can be summarised per component with
+    get_stats(), or exported with to_dict() or as a Chrome trace with to_chrome_trace().
+
+    Each event has a name, a category ("step", "matrix", "trace", "component", "compile" or
+    "stage"), a start time and duration in seconds, and where it applies, the number of rays
+    arriving (rays_in) and leaving (rays_out). With memory=True, numpy and Python allocations
+    are traced with tracemalloc, and every event also has the most bytes allocated at once
+    during it above what was allocated when it began (bytes), and the bytes still allocated
+    when it ended (retained_bytes). Tracing allocations slows down the tracer, so use
+    memory=False when only the times are needed.
+
+    Linear components between planes which are not recorded are folded into the next stage
+    of the trace, see Model.trace_planes(), so their rays are moved in the event of the
+    component at the end of the stage.
+    """
+
+    def __init__(self, memory=True):
+        """
+        Parameters
+        ----------
+        memory : bool, optional
+            Trace the memory allocated during each event, by default True
+        """
+        self.memory = memory
+        self.events = []
+        self.num_steps = 0
+        self.origin = time.perf_counter()
+
+        self._open_events = []
+        self._started_tracemalloc = False
+
+    def start(self):
+        """Start tracing allocations, if memory is set"""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        """Stop tracing allocations, if they were started by start()"""
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _update_peaks(self):
+        # The peak of tracemalloc is global, so fold it into every open event before it is
+        # reset for the next event
+        current, peak = tracemalloc.get_traced_memory()
+        for event in self._open_events:
+            event["peak_memory"] = max(event["peak_memory"], peak)
+        tracemalloc.reset_peak()
+
+        return current
+
+    def begin(self, name, category, **args):
+        """Begin an event
+
+        Parameters
+        ----------
+        name : str
+            Name of the event, e.g. the name of a component
+        category : str
+            Category of the event
+        **args
+            Extra values to store with the event, e.g. rays_in
+
+        Returns
+        -------
+        event : dict
+            Event to pass to end()
+        """
+        event = {"name": name, "category": category, "step": self.num_steps}
+        event.update(args)
+
+        if self.memory and tracemalloc.is_tracing():
+            event["start_memory"] = event["peak_memory"] = self._update_peaks()
+            self._open_events.append(event)
+
+        event["start"] = time.perf_counter() - self.origin
+
+        return event
+
+    def end(self, event, **args):
+        """End an event and record it
+
+        Parameters
+        ----------
+        event : dict
+            Event returned by begin()
+        **args
+            Extra values to store with the event, e.g. rays_out
+        """
+        event["duration"] = time.perf_counter() - self.origin - event["start"]
+        event.update(args)
+
+        if "start_memory" in event:
+            current = self._update_peaks()
+            self._open_events.remove(event)
+
+            start_memory = event.pop("start_memory")
+            event["bytes"] = event.pop("peak_memory") - start_memory
+            event["retained_bytes"] = current - start_memory
+
+        self.events.append(event)
+
+    def get_stats(self):
+        """Totals of the events of each name and category
+
+        Returns
+        -------
+        stats : dict
+            Dictionary of "category:name" keys, each with the number of calls and the total
+            time, rays in, rays out and bytes of its events
+        """
+        stats = {}
+        for event in self.events:
+            key = f"{event['category']}:{event['name']}"
+            totals = stats.setdefault(
+                key,
+                {
+                    "name": event["name"],
+                    "category": event["category"],
+                    "calls": 0,
+                    "time": 0.0,
+                    "rays_in": 0,
+                    "rays_out": 0,
+                    "bytes": 0,
+                },
+            )
+            totals["calls"] += 1
+            totals["time"] += event["duration"]
+            for counter in ("rays_in", "rays_out", "bytes"):
+                totals[counter] += event.get(counter, 0)
+
+        return stats
+
+    def to_dict(self):
+        """All of the recorded data as a dictionary which can be stored as JSON
+
+        Returns
+        -------
+        profile : dict
+            Number of steps, the totals of get_stats() and the list of events
+        """
+        return {
+            "num_steps": self.num_steps,
+            "stats": self.get_stats(),
+            "events": list(self.events),
+        }
+
+    def to_chrome_trace(self, path=None):
+        """Export the events in the trace event format of chrome://tracing and Perfetto
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of a JSON file to write the trace to
+
+        Returns
+        -------
+        trace : dict
+            Trace with one complete ("X") event per recorded event, in microseconds
+        """
+        trace_events = []
+        for event in self.events:
+            args = {
+                key: value
+                for key, value in event.items()
+                if key not in ("name", "category", "start", "duration")
+            }
+            trace_events.append(
+                {
+                    "name": event["name"],
+                    "cat": event["category"],
+                    "ph": "X",
+                    "ts": event["start"] * 1e6,
+                    "dur": event["duration"] * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": args,
+                }
+            )
+
+        trace = {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(trace, f)
+
+        return trace
@@ -1,9 +1,202 @@
+from contextlib import contextmanager
+
 import matplotlib as mpl
-import matplotlib.pyplot as plt
+import matplotlib.patches
 import numpy as np
+from matplotlib.collections import LineCollection, PolyCollection
+
+from temgymlite.backend import to_numpy
+
+# Style of the figures of the column, which is only applied while a figure is being created so
+# that the global rcParams of the user are left alone
+# "font.family": "Helvetica"
+PLOT_STYLE = {"axes.titlesize": 32, "axes.labelsize": 28}
+
+
+@contextmanager
+def plot_style():
+    """Context manager which applies the style of the figures of the column. Axes created
+    inside it keep the style after it exits."""
+    with mpl.rc_context(PLOT_STYLE):
+        yield
+
+
+def _get_segments(x, z, segment_idcs, ray_idcs):
+    # Line from each ray at the top of its segment to the same ray at the bottom
+    return np.stack(
+        [
+            np.stack([x[segment_idcs, ray_idcs], z[segment_idcs]], axis=-1),
+            np.stack([x[segment_idcs + 1, ray_idcs], z[segment_idcs + 1]], axis=-1),
+        ],
+        axis=1,
+    )
+
+
+def get_ray_segments(model, rays):
+    """Gather the lines of every ray between every pair of planes of the model, the lines of
+    the edges of the beam and the polygons that fill it, in one pass over the traced rays.
+    A ray is drawn down to the plane of the component which stopped it. The beam is split
+    into separate parts wherever a run of neighbouring rays has been stopped.
+
+    Parameters
+    ----------
+    model : class
+        Microscope Model
+    rays : ndarray
+        Ray positions and slopes at every plane of shape (steps, 5, num_rays)
+
+    Returns
+    -------
+    ray_segments : ndarray
+        Start and end (x, z) of every drawn ray line of shape (lines, 2, 2)
+    edge_segments : ndarray
+        Start and end (x, z) of the lines of the outermost rays of each part of the beam
+    fill_polygons : ndarray
+        Corners (x, z) of the polygon which fills each part of the beam between each pair
+        of planes, of shape (parts, 4, 2)
+    fill_part_counts : ndarray
+        Number of parts of the beam between the pair of planes of each polygon
+    fill_part_idcs : ndarray
+        Index of each polygon among the parts of the beam between its pair of planes
+    """
+    # Rays traced with another array namespace are drawn from a NumPy copy
+    x = to_numpy(rays)[:, 0, :]
+    z = np.asarray(model.z_positions, dtype=np.float64)
+
+    # Index of the component at the bottom of the segment between each pair of planes, where
+    # the detector counts as the component after the last one
+    segment_components = np.repeat(
+        np.arange(len(model.components) + 1),
+        [component.num_planes for component in model.components] + [1],
+    )
+
+    # Rays stopped by a component are drawn down to its plane and no further
+    if model.ray_fates is None:
+        drawn = np.ones((len(z) - 1, x.shape[-1]), dtype=bool)
+    else:
+        ray_fates = to_numpy(model.ray_fates)
+        drawn = (ray_fates < 0) | (ray_fates >= segment_components[:, None])
+
+    ray_segments = _get_segments(x, z, *np.nonzero(drawn))
+
+    # Each part of the beam is a run of neighbouring drawn rays, which starts at a drawn ray
+    # after one that is not drawn, and ends at a drawn ray before one that is not drawn
+    padded = np.pad(drawn, ((0, 0), (1, 1)))
+    run_starts = drawn & ~padded[:, :-2]
+    run_ends = drawn & ~padded[:, 2:]
+
+    edge_segments = _get_segments(x, z, *np.nonzero(run_starts | run_ends))
+
+    segment_idcs, first_rays = np.nonzero(run_starts)
+    _, last_rays = np.nonzero(run_ends)
+
+    fill_polygons = np.stack(
+        [
+            np.stack([x[segment_idcs, first_rays], z[segment_idcs]], axis=-1),
+            np.stack([x[segment_idcs + 1, first_rays], z[segment_idcs + 1]], axis=-1),
+            np.stack([x[segment_idcs + 1, last_rays], z[segment_idcs + 1]], axis=-1),
+            np.stack([x[segment_idcs, last_rays], z[segment_idcs]], axis=-1),
+        ],
+        axis=1,
+    )
+
+    part_counts = np.bincount(segment_idcs, minlength=len(z) - 1)
+    fill_part_counts = part_counts[segment_idcs]
+    fill_part_idcs = (
+        np.arange(len(segment_idcs)) - (np.cumsum(part_counts) - part_counts)[segment_idcs]
+    )
+
+    return ray_segments, edge_segments, fill_polygons, fill_part_counts, fill_part_idcs
+
+
+def get_fill_colors(fill_part_counts, fill_part_idcs, fill_color, fill_color_pair):
+    # A beam split in two parts is filled with a pair of colours
+    return np.where(
+        fill_part_counts[:, None] == 2,
+        mpl.colors.to_rgba_array(fill_color_pair)[np.minimum(fill_part_idcs, 1)],
+        mpl.colors.to_rgba(fill_color),
+    )
+
+
+def draw_rays(
+    ax,
+    model,
+    rays,
+    edge_lw=1,
+    ray_color="dimgray",
+    fill_color="aquamarine",
+    fill_color_pair=["khaki", "deepskyblue"],
+    plot_rays=True,
+    highlight_edges=True,
+    fill_between=True,
+    fill_alpha=1,
+    ray_alpha=1,
+    ray_lw=0.25,
+):
+    """Draw the rays of a model, the edges of the beam and the fill between them onto an
+    axis as one collection each, see get_ray_segments.
+
+    Parameters
+    ----------
+    ax : class
+        Matplotlib axis to draw onto
+    model : class
+        Microscope Model
+    rays : ndarray
+        Ray positions and slopes at every plane of shape (steps, 5, num_rays)
+
+    The remaining parameters are as for show_matplotlib.
+
+    Returns
+    -------
+    ray_lines : class
+        LineCollection of the rays, or None if plot_rays is False
+    edge_lines : class
+        LineCollection of the edges of the beam, or None if highlight_edges is False
+    fill_polygons : class
+        PolyCollection of the fill of the beam, or None if fill_between is False
+    """
+    (
+        ray_segments,
+        edge_segments,
+        fill_polygons,
+        fill_part_counts,
+        fill_part_idcs,
+    ) = get_ray_segments(model, rays)
+
+    ray_lines, edge_lines, fill_collection = None, None, None
+
+    if highlight_edges:
+        edge_lines = ax.add_collection(
+            LineCollection(
+                edge_segments, colors="k", linewidths=edge_lw, alpha=1, zorder=2
+            )
+        )
+    if fill_between:
+        fill_colors = get_fill_colors(
+            fill_part_counts, fill_part_idcs, fill_color, fill_color_pair
+        )
+        fill_collection = ax.add_collection(
+            PolyCollection(
+                fill_polygons,
+                facecolors=fill_colors,
+                edgecolors=fill_colors,
+                alpha=fill_alpha,
+                zorder=0,
+            )
+        )
+    if plot_rays:
+        ray_lines = ax.add_collection(
+            LineCollection(
+                ray_segments,
+                colors=ray_color,
+                linewidths=ray_lw,
+                alpha=ray_alpha,
+                zorder=1,
+            )
+        )
 
-# mpl.rcParams['font.family'] = 'Helvetica'
-mpl.rc("axes", titlesize=32, labelsize=28)
+    return ray_lines, edge_lines, fill_collection
 
 
 def show_matplotlib(
@@ -23,6 +216,7 @@ def show_matplotlib(
     fill_alpha=1,
     ray_alpha=1,
     ray_lw=0.25,
+    rays=None,
 ):
     """Code to show a matplotlib model
 
@@ -38,6 +232,9 @@ def show_matplotlib(
         Linewidth of highlight to edges, by default 1
     label_fontsize : int, optional
         Fontsize of labels, by default 20
+    rays : ndarray, optional
+        Ray positions at every plane from model.step_all_planes(), by default the model is
+        stepped to get them
 
     Returns
     -------
@@ -47,14 +244,19 @@ def show_matplotlib(
         Matplotlib axis object of the figure
     """
     # Step the rays through the model to get the ray positions throughout the column
-    rays = model.step()
+    if rays is None:
+        rays = model.step_all_planes()
 
-    # Collect their x, y & z coordinates
-    x, z = rays[:, 0, :], model.z_positions
+    # Collect the z coordinates of the planes to draw the components at
+    z = model.z_positions
 
     # Create a figure
     if figax is None:
-        fig, ax = plt.subplots(figsize=(12, 20))
+        # Only load pyplot when a figure is needed, so headless use never imports it
+        import matplotlib.pyplot as plt
+
+        with plot_style():
+            fig, ax = plt.subplots(figsize=(12, 20))
     else:
         fig, ax = figax
 
@@ -74,13 +276,27 @@ def show_matplotlib(
     ax.set_ylim([0, model.beam_z])
     ax.set_aspect("equal", adjustable="box")
 
-    # Set starting index of component so that we can plot rays from one component to the next
-    idx = 1
+    # Draw every ray, the edges of the beam and the fill between them as one collection each
+    if plot_rays or highlight_edges or fill_between:
+        draw_rays(
+            ax,
+            model,
+            rays,
+            edge_lw=edge_lw,
+            ray_color=ray_color,
+            fill_color=fill_color,
+            fill_color_pair=fill_color_pair,
+            plot_rays=plot_rays,
+            highlight_edges=highlight_edges,
+            fill_between=fill_between,
+            fill_alpha=fill_alpha,
+            ray_alpha=ray_alpha,
+            ray_lw=ray_lw,
+        )
 
-    # Generate a list of the allowed rays, so we can block them when they hit an aperture
-    allowed_rays = range(model.num_rays)
+    # Set starting index of component so that we can plot each component at its plane
+    idx = 1
 
-    edge_rays = [0, model.num_rays - 1]
     label_x = 0.30
 
     if show_labels:
@@ -88,55 +304,9 @@ def show_matplotlib(
             label_x, model.beam_z, "Electron Gun", fontsize=label_fontsize, zorder=1000
         )
 
-    # Loop through components, and for each type of component plot rays in the correct ray,
-    # and increment the index correctly
+    # Loop through components, and for each type of component plot it at its plane, and
+    # increment the index correctly
     for component in model.components:
-        if allowed_rays != []:
-            if highlight_edges:
-                ax.plot(
-                    x[idx - 1 : idx + 1, edge_rays],
-                    z[idx - 1 : idx + 1],
-                    color="k",
-                    linewidth=edge_lw,
-                    alpha=1,
-                    zorder=2,
-                )
-            if fill_between:
-                pair_idx = 0
-                for first, second in zip(edge_rays[::2], edge_rays[1::2]):
-                    if len(edge_rays) == 4:
-                        ax.fill_betweenx(
-                            z[idx - 1 : idx + 1],
-                            x[idx - 1 : idx + 1, first],
-                            x[idx - 1 : idx + 1, second],
-                            color=fill_color_pair[pair_idx],
-                            edgecolor=fill_color_pair[pair_idx],
-                            alpha=fill_alpha,
-                            zorder=0,
-                            lw=None,
-                        )
-                        pair_idx += 1
-                    else:
-                        ax.fill_betweenx(
-                            z[idx - 1 : idx + 1],
-                            x[idx - 1 : idx + 1, first],
-                            x[idx - 1 : idx + 1, second],
-                            color=fill_color,
-                            edgecolor=fill_color,
-                            alpha=fill_alpha,
-                            zorder=0,
-                            lw=None,
-                        )
-            if plot_rays:
-                ax.plot(
-                    x[idx - 1 : idx + 1, allowed_rays],
-                    z[idx - 1 : idx + 1],
-                    color=ray_color,
-                    linewidth=ray_lw,
-                    alpha=ray_alpha,
-                    zorder=1,
-                )
-
         if component.type == "Biprism":
             if show_labels:
                 ax.text(
@@ -157,7 +327,7 @@ def show_matplotlib(
                 )
             elif model.beam_type == "x_axial" and component.theta == np.pi / 2:
                 ax.add_patch(
-                    plt.Circle(
+                    mpl.patches.Circle(
                         (0, component.z),
                         component.width,
                         edgecolor="k",
@@ -302,48 +472,6 @@ def show_matplotlib(
             )
             idx += 1
 
-            if allowed_rays != []:
-                if highlight_edges:
-                    ax.plot(
-                        x[idx - 1 : idx + 1, edge_rays],
-                        z[idx - 1 : idx + 1],
-                        color="k",
-                        linewidth=edge_lw,
-                        alpha=1,
-                        zorder=2,
-                    )
-                if fill_between:
-                    pair_idx = 0
-                    for first, second in zip(edge_rays[::2], edge_rays[1::2]):
-                        if len(edge_rays) == 4:
-                            ax.fill_betweenx(
-                                z[idx - 1 : idx + 1],
-                                x[idx - 1 : idx + 1, first],
-                                x[idx - 1 : idx + 1, second],
-                                color=fill_color_pair[pair_idx],
-                                alpha=fill_alpha,
-                                zorder=1,
-                            )
-                            pair_idx += 1
-                        else:
-                            ax.fill_betweenx(
-                                z[idx - 1 : idx + 1],
-                                x[idx - 1 : idx + 1, first],
-                                x[idx - 1 : idx + 1, second],
-                                color=fill_color,
-                                alpha=fill_alpha,
-                                zorder=0,
-                            )
-                if plot_rays:
-                    ax.plot(
-                        x[idx - 1 : idx + 1, allowed_rays],
-                        z[idx - 1 : idx + 1],
-                        color=ray_color,
-                        linewidth=ray_lw,
-                        alpha=ray_alpha,
-                        zorder=1,
-                    )
-
             if show_labels:
                 ax.text(
                     label_x,
@@ -510,68 +638,6 @@ def show_matplotlib(
 
             idx += 1
 
-        allowed_rays = list(
-            set(allowed_rays).difference(set(component.blocked_ray_idcs))
-        )
-        allowed_rays.sort()
-
-        if len(allowed_rays) > 0:
-            edge_rays = [allowed_rays[0], allowed_rays[-1]]
-            new_edges = np.where(np.diff(allowed_rays) != 1)[0].tolist()
-
-            for new_edge in new_edges:
-                edge_rays.extend([allowed_rays[new_edge], allowed_rays[new_edge + 1]])
-
-            edge_rays.sort()
-
-        else:
-            break
-
-    # We need to repeat the code once more for the rays at the end
-    if allowed_rays != []:
-        if highlight_edges:
-            ax.plot(
-                x[idx - 1 : idx + 1, edge_rays],
-                z[idx - 1 : idx + 1],
-                color="k",
-                linewidth=edge_lw,
-                alpha=1,
-                zorder=2,
-            )
-        if fill_between:
-            pair_idx = 0
-            for first, second in zip(edge_rays[::2], edge_rays[1::2]):
-                if len(edge_rays) == 4:
-                    ax.fill_betweenx(
-                        z[idx - 1 : idx + 1],
-                        x[idx - 1 : idx + 1, first],
-                        x[idx - 1 : idx + 1, second],
-                        color=fill_color_pair[pair_idx],
-                        edgecolor=fill_color_pair[pair_idx],
-                        alpha=fill_alpha,
-                        zorder=1,
-                    )
-                    pair_idx += 1
-                else:
-                    ax.fill_betweenx(
-                        z[idx - 1 : idx + 1],
-                        x[idx - 1 : idx + 1, first],
-                        x[idx - 1 : idx + 1, second],
-                        color=fill_color,
-                        edgecolor=fill_color,
-                        alpha=fill_alpha,
-                        zorder=0,
-                    )
-        if plot_rays:
-            ax.plot(
-                x[idx - 1 : idx + 1, allowed_rays],
-                z[idx - 1 : idx + 1],
-                color=ray_color,
-                linewidth=ray_lw,
-                alpha=ray_alpha,
-                zorder=1,
-            )
-
     # Create the final labels and plot the detector shape
     if show_labels:
         ax.text(label_x, -0.01, "Detector", fontsize=label_fontsize, zorder=1000)
@@ -585,3 +651,158 @@ def show_matplotlib(
     )
 
     return fig, ax
+
+
+class ModelRenderer:
+    """Keeps a figure of a model from show_matplotlib open, and redraws only its rays when
+    the model changes, e.g. from a slider or in an animation. The component glyphs, labels
+    and detector are drawn once, so a component which is moved along the column needs a new
+    renderer, while any change that keeps the planes in place, such as the focal length of
+    a lens, only needs update().
+
+    With blit=True the ray artists are animated: the static column is cached as a
+    background after every full draw of the figure, and update() restores it and draws
+    only the rays on top.
+    """
+
+    def __init__(
+        self,
+        model,
+        figax=None,
+        blit=False,
+        edge_lw=1,
+        ray_color="dimgray",
+        fill_color="aquamarine",
+        fill_color_pair=["khaki", "deepskyblue"],
+        plot_rays=True,
+        highlight_edges=True,
+        fill_between=True,
+        fill_alpha=1,
+        ray_alpha=1,
+        ray_lw=0.25,
+        **kwargs,
+    ):
+        """
+        Parameters
+        ----------
+        model : class
+            Microscope Model
+        figax : tuple, optional
+            Figure and axis to draw onto, by default a new figure
+        blit : bool, optional
+            Redraw the rays over a cached background of the static column, by default False
+
+        The remaining parameters are as for show_matplotlib, which also takes any further
+        keyword arguments for the static column.
+        """
+        self.model = model
+        self.blit = blit
+        self.fill_color = fill_color
+        self.fill_color_pair = fill_color_pair
+
+        # Draw the static column without any rays, from the same step as the ray artists
+        rays = model.step_all_planes()
+        self.fig, self.ax = show_matplotlib(
+            model,
+            figax=figax,
+            plot_rays=False,
+            highlight_edges=False,
+            fill_between=False,
+            rays=rays,
+            **kwargs,
+        )
+
+        self.ray_lines, self.edge_lines, self.fill_polygons = draw_rays(
+            self.ax,
+            model,
+            rays,
+            edge_lw=edge_lw,
+            ray_color=ray_color,
+            fill_color=fill_color,
+            fill_color_pair=fill_color_pair,
+            plot_rays=plot_rays,
+            highlight_edges=highlight_edges,
+            fill_between=fill_between,
+            fill_alpha=fill_alpha,
+            ray_alpha=ray_alpha,
+            ray_lw=ray_lw,
+        )
+
+        self.background = None
+        if blit:
+            for artist in self.artists:
+                artist.set_animated(True)
+
+            self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+
+    @property
+    def artists(self):
+        """Ray artists which are updated with the model"""
+        return [
+            artist
+            for artist in (self.fill_polygons, self.ray_lines, self.edge_lines)
+            if artist is not None
+        ]
+
+    def on_draw(self, event):
+        """Cache the background of the static column after a full draw of the figure, and
+        draw the animated rays over it"""
+        canvas = self.fig.canvas
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self, draw=True):
+        """Trace the rays through the model again and replace the data of the ray artists
+
+        Parameters
+        ----------
+        draw : bool, optional
+            Redraw the figure, by blitting the rays over the cached background if blit is
+            set. Pass False when something else draws the figure, e.g. a FuncAnimation with
+            blit=True, by default True
+
+        Returns
+        -------
+        artists : list
+            Ray artists which have been updated
+        """
+        (
+            ray_segments,
+            edge_segments,
+            fill_polygons,
+            fill_part_counts,
+            fill_part_idcs,
+        ) = get_ray_segments(self.model, self.model.step_all_planes())
+
+        if self.ray_lines is not None:
+            self.ray_lines.set_segments(ray_segments)
+        if self.edge_lines is not None:
+            self.edge_lines.set_segments(edge_segments)
+        if self.fill_polygons is not None:
+            fill_colors = get_fill_colors(
+                fill_part_counts, fill_part_idcs, self.fill_color, self.fill_color_pair
+            )
+            self.fill_polygons.set_verts(fill_polygons)
+            self.fill_polygons.set_facecolor(fill_colors)
+            self.fill_polygons.set_edgecolor(fill_colors)
+
+        if draw:
+            self.draw()
+
+        return self.artists
+
+    def draw(self):
+        """Redraw the figure, or only the rays over the cached background if blit is set"""
+        canvas = self.fig.canvas
+
+        if self.blit and self.background is not None:
+            canvas.restore_region(self.background)
+            self.draw_artists()
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+        else:
+            canvas.draw_idle()
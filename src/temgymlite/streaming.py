@@ -0,0 +1,151 @@
+"""Accumulators for tracing rays through the model in chunks. Each chunk of rays is folded into
+running totals as soon as it has been traced, and then discarded, so the memory used by a trace is
+set by the size of a chunk rather than by the total number of rays."""
+
+import numpy as np
+
+from temgymlite.functions import bin_rays
+
+
+class StreamedTrace:
+    """Running totals of a trace of many chunks of rays: an image of the rays that reach the
+    detector, the number of rays that arrive at and pass each component, and statistics of the
+    rays at every plane of the column. A ray counts as blocked from the plane of the first
+    aperture or biprism that stops it onwards.
+    """
+
+    def __init__(self, model, flip_y=True):
+        """
+        Parameters
+        ----------
+        model : Model
+            Model the chunks of rays are traced through
+        flip_y : bool, optional
+            Flip the y axis of the detector image, as in get_image_from_rays, by default True
+        """
+        self.model = model
+        self.flip_y = flip_y
+
+        self.detector_size = model.detector_size
+        self.detector_pixels = model.detector_pixels
+        self.plane_z = np.array(model.z_positions, dtype=np.float64)
+
+        num_planes = len(self.plane_z)
+        num_components = len(model.components)
+
+        self.num_rays = 0
+        self.num_chunks = 0
+        self.detector_image = np.zeros(
+            (self.detector_pixels, self.detector_pixels), dtype=np.int64
+        )
+
+        # Number of unblocked rays that arrive at each component, and that leave it
+        self.arrived_counts = np.zeros(num_components, dtype=np.int64)
+        self.transmitted_counts = np.zeros(num_components, dtype=np.int64)
+
+        # Number of unblocked rays at each plane, and the sums, sums of squares and extent
+        # of their x, x slope, y and y slope
+        self.plane_counts = np.zeros(num_planes, dtype=np.int64)
+        self.plane_sums = np.zeros((num_planes, 4))
+        self.plane_sums_sq = np.zeros((num_planes, 4))
+        self.plane_min = np.full((num_planes, 4), np.inf)
+        self.plane_max = np.full((num_planes, 4), -np.inf)
+
+    def add_chunk(self, r, fates):
+        """Fold a traced chunk of rays into the running totals
+
+        Parameters
+        ----------
+        r : ndarray
+            Ray positions and slopes at every plane of shape (steps, 5, num_rays)
+        fates : ndarray
+            Index of the component which stopped each ray, or -1 for rays that reach the
+            detector, as returned by Model.trace_planes()
+        """
+        num_planes = len(self.plane_z)
+        plane_idcs = np.asarray(self.model.component_plane_idcs)
+
+        # The last plane each ray reaches is the plane of the component that stopped it
+        last_planes = np.where(fates < 0, num_planes - 1, plane_idcs[fates])
+        chunk_counts = np.zeros(num_planes, dtype=np.int64)
+
+        for plane in range(num_planes):
+            alive = last_planes >= plane
+            rays = r[plane, :4, :][:, alive]
+
+            chunk_counts[plane] = rays.shape[1]
+            if rays.shape[1]:
+                self.plane_sums[plane] += rays.sum(axis=1)
+                self.plane_sums_sq[plane] += (rays * rays).sum(axis=1)
+                np.minimum(self.plane_min[plane], rays.min(axis=1), out=self.plane_min[plane])
+                np.maximum(self.plane_max[plane], rays.max(axis=1), out=self.plane_max[plane])
+
+        self.plane_counts += chunk_counts
+
+        # Every ray arrives at the components above the one that stopped it
+        stopped_counts = np.bincount(fates[fates >= 0], minlength=len(self.arrived_counts))
+        arrived_counts = r.shape[-1] - (np.cumsum(stopped_counts) - stopped_counts)
+        self.arrived_counts += arrived_counts
+        self.transmitted_counts += arrived_counts - stopped_counts
+
+        self.num_rays += r.shape[-1]
+        self.num_chunks += 1
+
+        self.add_detector_rays(r[-1, 0, fates < 0], r[-1, 2, fates < 0])
+
+    def add_detector_rays(self, rays_x, rays_y):
+        """Add the rays that reach the detector to the detector image
+
+        Parameters
+        ----------
+        rays_x : ndarray
+            X position of the unblocked rays at the detector
+        rays_y : ndarray
+            Y position of the unblocked rays at the detector
+        """
+        bin_rays(
+            rays_x=rays_x,
+            rays_y=rays_y,
+            size=self.detector_size,
+            pixels=self.detector_pixels,
+            out=self.detector_image,
+            flip_y=self.flip_y,
+        )
+
+    @property
+    def transmission(self):
+        """Fraction of the unblocked rays arriving at each component that pass it"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.transmitted_counts / self.arrived_counts
+
+    @property
+    def plane_mean(self):
+        """Mean x, x slope, y and y slope of the unblocked rays at each plane"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.plane_sums / self.plane_counts[:, None]
+
+    @property
+    def plane_std(self):
+        """Standard deviation of the x, x slope, y and y slope of the unblocked rays at each
+        plane, e.g. the rms size and divergence of the beam"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = self.plane_sums_sq / self.plane_counts[:, None] - self.plane_mean**2
+
+        return np.sqrt(np.maximum(variance, 0))
+
+    def get_transmitted_count(self, name):
+        """Number of rays that pass the component with the given name
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+
+        Returns
+        -------
+        count : int
+            Number of unblocked rays leaving the first component with this name
+        """
+        component = self.model.find_component(name)
+
+        return int(self.transmitted_counts[self.model.components.index(component)])
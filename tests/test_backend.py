@@ -0,0 +1,101 @@
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+from temgymlite import components as comp
+from temgymlite.backend import to_numpy
+from temgymlite.model import Model
+
+xps = pytest.importorskip("array_api_strict")
+
+
+def make_model(array_namespace=None, **kwargs):
+    components = [
+        comp.DoubleDeflector(name="Deflector", z_up=0.9, z_low=0.85, updefx=0.01, lowdefx=-0.005),
+        comp.Lens(name="Lens", z=0.7, f=-0.2),
+        comp.Aperture(
+            name="Aperture", z=0.5, aperture_radius_inner=0.012, aperture_radius_outer=0.2
+        ),
+        comp.Biprism(name="Biprism", z=0.4, deflection=0.01, width=0.0005),
+        comp.Quadrupole(name="Quadrupole", z=0.35, fx=-1, fy=2),
+        comp.Lens(name="Projector", z=0.3, f=-0.1),
+    ]
+    kwargs = {"beam_type": "point_sobol", "gun_beam_semi_angle": 0.03, **kwargs}
+    return Model(
+        components, beam_z=1, num_rays=500, array_namespace=array_namespace, **kwargs
+    )
+
+
+MODEL_KWARGS = [
+    {},
+    {"record_planes": ["Lens", "detector"]},
+    {"compact_rays": True},
+    {"record_planes": "detector", "compact_rays": True},
+    {"beam_type": "paralell", "beam_radius": 0.05},
+]
+
+
+def assert_rays_close(rays, strict_rays, compact_rays):
+    assert type(strict_rays).__module__.startswith("array_api_strict")
+    tolerance = {"rtol": 1e-6, "atol": 1e-7} if compact_rays else {"rtol": 1e-12, "atol": 0}
+    np.testing.assert_allclose(to_numpy(strict_rays), rays, equal_nan=True, **tolerance)
+
+
+@pytest.mark.parametrize("kwargs", MODEL_KWARGS)
+def test_step_matches_numpy(kwargs):
+    model = make_model(**kwargs)
+    strict_model = make_model(xps, **kwargs)
+
+    # Step once, then again after changing a biprism and a lens below it
+    for changes in [{}, {"Biprism": 0.02}, {"Projector": -0.12}]:
+        for name, value in changes.items():
+            attribute = "deflection" if name == "Biprism" else "f"
+            setattr(model.find_component(name), attribute, value)
+            setattr(strict_model.find_component(name), attribute, value)
+
+        assert_rays_close(model.step(), strict_model.step(), model.compact_rays)
+        np.testing.assert_array_equal(to_numpy(strict_model.ray_fates), model.ray_fates)
+        for component, strict_component in zip(model.components, strict_model.components):
+            if not component.linear:
+                np.testing.assert_array_equal(
+                    strict_component.blocked_ray_idcs, component.blocked_ray_idcs
+                )
+
+
+@pytest.mark.parametrize("method", ["nearest", "bilinear"])
+@pytest.mark.parametrize("kwargs", [{}, {"record_planes": "detector", "compact_rays": True}])
+def test_detector_image_matches_numpy(kwargs, method):
+    model = make_model(**kwargs)
+    strict_model = make_model(xps, **kwargs)
+    model.step()
+    strict_model.step()
+
+    image = model.get_detector_image(method)
+    strict_image = strict_model.get_detector_image(method)
+
+    assert type(strict_image).__module__.startswith("array_api_strict")
+    # Compact rays give bilinear weights in float32
+    rtol = 1e-6 if model.compact_rays else 0
+    np.testing.assert_allclose(to_numpy(strict_image), image, rtol=rtol, atol=1e-9)
+
+
+@pytest.mark.parametrize("array_namespace", [None, xps, "array_api_strict"])
+def test_pickle_round_trip(array_namespace):
+    model = make_model(array_namespace)
+    model.step()
+
+    for copied in (pickle.loads(pickle.dumps(model)), copy.deepcopy(model)):
+        assert copied.xp is model.xp
+        np.testing.assert_array_equal(to_numpy(copied.step()), to_numpy(model.r))
+
+
+def test_numpy_only_methods_raise():
+    model = make_model(xps)
+    model.step()
+
+    with pytest.raises(TypeError, match="sweep"):
+        model.sweep({"Lens.f": [-0.2, -0.3]})
+    with pytest.raises(TypeError, match="step_compiled"):
+        model.step_compiled()
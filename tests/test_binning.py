@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from temgymlite.functions import bin_pixel_coords
+
+PIXEL_COORDS_X = np.array([3.0, 3.0, 3.0, 5.2])
+PIXEL_COORDS_Y = np.array([4.0, 4.0, 4.0, 6.7])
+
+
+def test_counts_every_ray_on_a_pixel():
+    image = bin_pixel_coords(PIXEL_COORDS_X, PIXEL_COORDS_Y, 8)
+
+    assert image.dtype == np.int64
+    assert image[4, 3] == 3
+    assert image[7, 5] == 1
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int32, np.float32, np.complex64])
+def test_accumulates_into_out(dtype):
+    out = np.zeros((8, 8), dtype=dtype)
+
+    for _ in range(2):
+        bin_pixel_coords(PIXEL_COORDS_X, PIXEL_COORDS_Y, 8, out=out)
+
+    assert out.dtype == dtype
+    assert out[4, 3] == 6
+    assert out.sum() == 8
+
+
+def test_complex_weights_need_complex_out():
+    with pytest.raises(TypeError):
+        bin_pixel_coords(
+            PIXEL_COORDS_X, PIXEL_COORDS_Y, 8, weights=1j * PIXEL_COORDS_X, out=np.zeros((8, 8))
+        )
@@ -0,0 +1,30 @@
+import pytest
+
+from temgymlite import components as comp
+from temgymlite.model import Model
+from temgymlite.optimize import spot_residuals
+
+
+def make_model():
+    return Model(
+        [comp.Lens(name="Lens", z=0.5, f=-0.3)],
+        beam_z=1,
+        beam_type="point",
+        gun_beam_semi_angle=0.01,
+        num_rays=64,
+    )
+
+
+def test_focus_converges():
+    result = make_model().optimize(["Lens.f"], spot_residuals("detector"))
+
+    assert result["converged"]
+    assert result["status"] == 1
+    assert result["values"]["Lens.f"] == pytest.approx(-0.25)
+
+
+def test_stopped_early_has_not_converged():
+    result = make_model().optimize(["Lens.f"], spot_residuals("detector"), max_iterations=1)
+
+    assert not result["converged"]
+    assert result["status"] == 0
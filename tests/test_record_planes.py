@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from temgymlite import components as comp
+from temgymlite.functions import convert_rays_to_line_vertices
+from temgymlite.model import Model
+
+
+def make_model(record_planes="all", compact_rays=False, f=-0.3):
+    components = [
+        comp.Lens(name="Lens", z=0.7, f=f),
+        comp.Aperture(name="Aperture", z=0.5, aperture_radius_inner=0.05),
+    ]
+    return Model(
+        components,
+        beam_z=1,
+        beam_type="point",
+        gun_beam_semi_angle=0.2,
+        num_rays=64,
+        record_planes=record_planes,
+        compact_rays=compact_rays,
+    )
+
+
+@pytest.mark.parametrize("compact_rays", [False, True])
+@pytest.mark.parametrize("record_planes", ["detector", ["gun", "detector"], ["Aperture"]])
+def test_step_all_planes_keeps_recorded_rays(record_planes, compact_rays):
+    model = make_model(record_planes, compact_rays)
+    model.step()
+    recorded = model.r.copy()
+
+    r = model.step_all_planes()
+
+    np.testing.assert_allclose(model.r, recorded, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(r[model.recorded_plane_idcs], recorded, rtol=0, atol=1e-12)
+
+
+def test_step_all_planes_keeps_detector_image():
+    model = make_model("detector")
+    model.step()
+    image = model.get_detector_image()
+
+    model.step_all_planes()
+
+    np.testing.assert_array_equal(model.get_detector_image(), image)
+
+
+def test_line_vertices_keep_detector_rays():
+    model = make_model("detector")
+    model.step()
+    detector_rays = model.get_plane_rays("detector").copy()
+
+    convert_rays_to_line_vertices(model)
+
+    np.testing.assert_allclose(
+        model.get_plane_rays("detector"), detector_rays, rtol=0, atol=1e-12
+    )
+    assert np.any(detector_rays[0] != 0)
+
+
+def test_step_after_step_all_planes():
+    model = make_model("detector")
+    model.step()
+    model.step_all_planes()
+
+    model.components[0].f = -0.25
+    model.step()
+
+    fresh = make_model("detector", f=-0.25)
+    fresh.step()
+    np.testing.assert_allclose(model.r, fresh.r, rtol=0, atol=1e-12)
+
+
+def test_compare_compact_rays_keeps_recorded_rays():
+    model = make_model("detector")
+    model.step()
+    recorded = model.r.copy()
+
+    model.compare_compact_rays()
+
+    np.testing.assert_allclose(model.r, recorded, rtol=0, atol=1e-12)